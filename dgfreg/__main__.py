@@ -0,0 +1,8 @@
+"""Run the dgfreg command line interface with python -m dgfreg."""
+
+import sys
+
+from dgfreg.cli import main
+
+if __name__ == "__main__":
+    sys.exit(main())
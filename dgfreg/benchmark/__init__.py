@@ -0,0 +1,4 @@
+"""Benchmarks of the analysis pipeline on synthetic data.
+
+Run them with `python -m dgfreg.benchmark`.
+"""
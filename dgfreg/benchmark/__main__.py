@@ -0,0 +1,89 @@
+"""Run the benchmarks from the command line.
+
+For example, to benchmark networks the size of the TECRDB data and ten times
+bigger without fitting any models:
+
+  python -m dgfreg.benchmark --scales 1 10 --stages prepare_data_equilibrator get_stan_input stanify_dict
+
+"""
+
+import argparse
+
+from dgfreg.benchmark.run import (
+    BENCHMARK_STAGES,
+    DEFAULT_BENCHMARK_FOLDS,
+    DEFAULT_BENCHMARK_SAMPLE_KWARGS,
+    RESULTS_FILE,
+    run_benchmark,
+    write_results,
+)
+from dgfreg.benchmark.synthetic import SyntheticNetworkConfig
+
+
+def main():
+    """Benchmark the pipeline on synthetic networks of some sizes."""
+    base = SyntheticNetworkConfig()
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--scales",
+        type=float,
+        nargs="+",
+        default=[1.0],
+        help="multiples of the default numbers of compounds, reactions and "
+        "groups",
+    )
+    parser.add_argument(
+        "--stages",
+        nargs="+",
+        default=BENCHMARK_STAGES,
+        choices=BENCHMARK_STAGES,
+    )
+    parser.add_argument(
+        "--measurements-per-reaction",
+        type=float,
+        default=base.measurements_per_reaction,
+    )
+    parser.add_argument(
+        "--compounds-per-reaction",
+        type=float,
+        default=base.compounds_per_reaction,
+    )
+    parser.add_argument(
+        "--groups-per-compound", type=float, default=base.groups_per_compound
+    )
+    parser.add_argument("--n-folds", type=int, default=DEFAULT_BENCHMARK_FOLDS)
+    parser.add_argument("--seed", type=int, default=base.seed)
+    parser.add_argument("--output", default=RESULTS_FILE)
+    parser.add_argument(
+        "--no-trace-memory",
+        action="store_true",
+        help="don't trace python memory, for more accurate timings",
+    )
+    args = parser.parse_args()
+    for scale in args.scales:
+        config = SyntheticNetworkConfig(
+            n_compound=round(scale * base.n_compound),
+            n_reaction=round(scale * base.n_reaction),
+            n_group=round(scale * base.n_group),
+            compounds_per_reaction=args.compounds_per_reaction,
+            groups_per_compound=args.groups_per_compound,
+            measurements_per_reaction=args.measurements_per_reaction,
+            seed=args.seed,
+        )
+        print(f"Benchmarking {config}...")
+        results = run_benchmark(
+            config,
+            stages=args.stages,
+            n_folds=args.n_folds,
+            trace_memory=not args.no_trace_memory,
+        )
+        for r in results:
+            seconds = "" if r.seconds is None else f" in {r.seconds:.2f}s"
+            print(f"\t{r.stage}: {r.status}{seconds}")
+        write_results(
+            results, config, DEFAULT_BENCHMARK_SAMPLE_KWARGS, args.output
+        )
+
+
+if __name__ == "__main__":
+    main()
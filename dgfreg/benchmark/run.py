@@ -0,0 +1,314 @@
+"""Time each stage of the analysis pipeline on a synthetic network.
+
+Each stage's wall time, peak python memory and peak resident memory are
+recorded, and the results of a run are appended to a json lines file, one
+line per network, for tracking performance regressions.
+
+"""
+
+import json
+import os
+import platform
+import resource
+import tempfile
+import time
+import tracemalloc
+from dataclasses import asdict, dataclass
+from datetime import datetime, timezone
+from typing import Any, Callable, List, Optional, Sequence
+
+import arviz as az
+import cmdstanpy
+import numpy as np
+import pandas as pd
+import xarray as xr
+from dgfreg.benchmark.synthetic import (
+    SyntheticNetworkConfig,
+    generate_synthetic_data,
+)
+from dgfreg.data_preparation import PreparedData, prepare_data_equilibrator
+from dgfreg.fitting_mode import fit_kfold, fit_posterior
+from dgfreg.model_cache import get_cached_model
+from dgfreg.profiling import RssSampler, get_max_rss_mb
+from dgfreg.stan_input_functions import get_stan_input
+from dgfreg.unobserved import get_reaction_samples
+from dgfreg.util import stanify_dict
+
+HERE = os.path.dirname(__file__)
+STAN_FILE = os.path.join(HERE, "..", "stan", "new.stan")
+RESULTS_FILE = os.path.join(HERE, "..", "..", "benchmarks", "results.jsonl")
+BENCHMARK_STAGES = [
+    "prepare_data_equilibrator",
+    "get_stan_input",
+    "stanify_dict",
+    "compile",
+    "fit_posterior",
+    "fit_kfold",
+    "idata",
+    "get_reaction_samples",
+]
+# small enough to finish quickly at TECRDB size, while still adapting
+DEFAULT_BENCHMARK_SAMPLE_KWARGS = {
+    "chains": 2,
+    "iter_warmup": 200,
+    "iter_sampling": 200,
+    "show_progress": False,
+}
+DEFAULT_BENCHMARK_FOLDS = 2
+# the same dims as the inferences in the inferences folder
+BENCHMARK_DIMS = {
+    "dgfG": ["group_id"],
+    "dgfC": ["compound_id"],
+    "dgr": ["reaction_id"],
+    "qC": ["compound_id"],
+    "qG": ["group_id"],
+}
+
+
+@dataclass
+class StageResult:
+    """Performance of one stage of the pipeline.
+
+    :param stage: the stage's name, one of BENCHMARK_STAGES
+
+    :param status: "ok", "error" or "skipped"
+
+    :param seconds: wall time
+
+    :param peak_python_mb: peak memory allocated by python and numpy during
+    the stage, from tracemalloc, or None if memory wasn't traced
+
+    :param peak_rss_mb: peak resident memory of this process during the
+    stage, or None if it couldn't be sampled
+
+    :param peak_child_rss_mb: peak total resident memory of this process's
+    running children during the stage, e.g. cmdstan, or None if it couldn't
+    be sampled
+
+    :param process_max_rss_so_far_mb: peak resident memory of this process
+    since it started
+
+    :param child_max_rss_so_far_mb: peak resident memory of any finished
+    child process so far
+
+    :param message: what went wrong, if the stage didn't run
+    """
+
+    stage: str
+    status: str
+    seconds: Optional[float] = None
+    peak_python_mb: Optional[float] = None
+    peak_rss_mb: Optional[float] = None
+    peak_child_rss_mb: Optional[float] = None
+    process_max_rss_so_far_mb: Optional[float] = None
+    child_max_rss_so_far_mb: Optional[float] = None
+    message: Optional[str] = None
+
+
+class Benchmark:
+    """Runs pipeline stages, recording how each one performs.
+
+    :param stages: which stages to run. Others are recorded as skipped.
+
+    :param trace_memory: whether to trace python memory allocations.
+    Tracing slows down stages that do a lot of small allocations, e.g. in
+    pandas, so turn it off for the most accurate timings.
+    """
+
+    def __init__(self, stages: Sequence[str], trace_memory: bool = True):
+        """Initialise a Benchmark."""
+        self.stages = stages
+        self.trace_memory = trace_memory
+        self.results: List[StageResult] = []
+        self.rss_sampler = RssSampler()
+
+    def run(
+        self, stage: str, func: Callable, *args, requires=(), **kwargs
+    ) -> Any:
+        """Run a stage, returning its output or None if it didn't finish.
+
+        :param stage: the stage's name
+
+        :param func: the function to run
+
+        :param requires: outputs of earlier stages that this stage needs. If
+        any of them is None, the stage is skipped.
+        """
+        if stage not in self.stages or any(r is None for r in requires):
+            self.results.append(
+                StageResult(
+                    stage, "skipped", message="not selected or missing input"
+                )
+            )
+            return None
+        if self.trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        with self.rss_sampler.track() as peak_rss:
+            try:
+                out, status, message = func(*args, **kwargs), "ok", None
+            except Exception as e:
+                out, status = None, "error"
+                message = f"{type(e).__name__}: {e}"
+        seconds = time.perf_counter() - start
+        peak = None
+        if self.trace_memory:
+            peak = tracemalloc.get_traced_memory()[1] / 2**20
+            tracemalloc.stop()
+        self.results.append(
+            StageResult(
+                stage,
+                status,
+                seconds=seconds,
+                peak_python_mb=peak,
+                peak_rss_mb=peak_rss.rss_mb,
+                peak_child_rss_mb=peak_rss.child_rss_mb,
+                process_max_rss_so_far_mb=get_max_rss_mb(resource.RUSAGE_SELF),
+                child_max_rss_so_far_mb=get_max_rss_mb(
+                    resource.RUSAGE_CHILDREN
+                ),
+                message=message,
+            )
+        )
+        return out
+
+
+def get_dense_matrices(prepped: PreparedData):
+    """Get S and G as DataFrames with the string ids of the idata coords."""
+    S, G = (
+        getattr(prepped, attr)
+        .set_index(["compound_id", col])["stoichiometric_coefficient"]
+        .unstack()
+        .fillna(0.0)
+        for attr, col in [("S", "reaction_id"), ("G", "group_id")]
+    )
+    S.index, G.index = S.index.astype(str), G.index.astype(str)
+    G.columns = G.columns.astype(str)
+    return S, G
+
+
+def sample_reactions(
+    idata: az.InferenceData, prepped: PreparedData
+) -> xr.DataArray:
+    """Get posterior samples of every reaction in some prepared data."""
+    return get_reaction_samples(idata, *get_dense_matrices(prepped))
+
+
+def save_idata(
+    posterior: cmdstanpy.CmdStanMCMC,
+    stan_input: dict,
+    prepped: PreparedData,
+    directory: str,
+) -> az.InferenceData:
+    """Convert a posterior fit to InferenceData and save it as json."""
+    idata = az.from_cmdstanpy(
+        posterior=posterior,
+        observed_data=stan_input,
+        log_likelihood="llik",
+        posterior_predictive="yrep",
+        coords=prepped.coords,
+        dims=BENCHMARK_DIMS,
+    )
+    idata.to_json(os.path.join(directory, "idata.json"))
+    return idata
+
+
+def run_benchmark(
+    config: SyntheticNetworkConfig,
+    stages: Sequence[str] = tuple(BENCHMARK_STAGES),
+    sample_kwargs: Optional[dict] = None,
+    n_folds: int = DEFAULT_BENCHMARK_FOLDS,
+    trace_memory: bool = True,
+) -> List[StageResult]:
+    """Run the pipeline's stages on a synthetic network.
+
+    Stages whose inputs failed are skipped, e.g. the fits if cmdstan isn't
+    installed.
+
+    :param config: the synthetic network
+
+    :param stages: which of BENCHMARK_STAGES to run
+
+    :param sample_kwargs: keyword arguments for CmdStanModel.sample
+
+    :param n_folds: number of folds for fit_kfold
+
+    :param trace_memory: whether to trace python memory allocations
+    """
+    if sample_kwargs is None:
+        sample_kwargs = DEFAULT_BENCHMARK_SAMPLE_KWARGS
+    raw_data = generate_synthetic_data(config).raw_data
+    bench = Benchmark(stages, trace_memory=trace_memory)
+    with tempfile.TemporaryDirectory() as directory:
+        prepped = bench.run(
+            "prepare_data_equilibrator", prepare_data_equilibrator, **raw_data
+        )
+        stan_input = bench.run(
+            "get_stan_input", get_stan_input, prepped, requires=[prepped]
+        )
+        bench.run(
+            "stanify_dict", stanify_dict, stan_input, requires=[stan_input]
+        )
+        model = bench.run("compile", get_cached_model, STAN_FILE)
+        posterior = bench.run(
+            "fit_posterior",
+            fit_posterior,
+            model,
+            stan_input,
+            sample_kwargs | {"output_dir": os.path.join(directory, "fit")},
+            requires=[model, stan_input],
+        )
+        bench.run(
+            "fit_kfold",
+            fit_kfold,
+            model,
+            stan_input,
+            sample_kwargs
+            | {
+                "n_folds": n_folds,
+                "generated_quantities": ["llik"],
+                "output_dir": os.path.join(directory, "kfold"),
+            },
+            requires=[model, stan_input],
+        )
+        idata = bench.run(
+            "idata",
+            save_idata,
+            posterior,
+            stan_input,
+            prepped,
+            directory,
+            requires=[posterior],
+        )
+        bench.run(
+            "get_reaction_samples",
+            sample_reactions,
+            idata,
+            prepped,
+            requires=[idata],
+        )
+    return bench.results
+
+
+def write_results(
+    results: List[StageResult],
+    config: SyntheticNetworkConfig,
+    sample_kwargs: dict,
+    path: str = RESULTS_FILE,
+):
+    """Append one benchmark run's results to a json lines file."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    record = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "config": config.model_dump(),
+        "sample_kwargs": sample_kwargs,
+        "versions": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "cmdstanpy": cmdstanpy.__version__,
+        },
+        "stages": [asdict(r) for r in results],
+    }
+    with open(path, "a") as f:
+        f.write(json.dumps(record) + "\n")
@@ -0,0 +1,224 @@
+"""Generate synthetic reaction networks from the model in new.stan.
+
+The networks are written as raw equilibrator tables, so they go through the
+same data preparation as the real data.
+
+"""
+
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+import numpy as np
+import pandas as pd
+from pydantic import BaseModel
+from dgfreg.collapsed import (
+    DGFG_PRIOR_MEAN,
+    DGFG_PRIOR_SD,
+    SIGMA_PRIOR_SD,
+    TAUC_PRIOR_SD,
+)
+from dgfreg.data_preparation import PreparedData, prepare_data_equilibrator
+
+# stoichiometric coefficients of synthetic reactions, and their probabilities
+COEFFICIENTS = [-2.0, -1.0, 1.0, 2.0]
+COEFFICIENT_PROBABILITIES = [0.1, 0.4, 0.4, 0.1]
+# fraction of compounds and reactions flagged as E. coli central metabolism
+CCM_FRACTION = 0.1
+
+
+class SyntheticNetworkConfig(BaseModel):
+    """Sizes and parameters of a synthetic reaction network.
+
+    The defaults are about the size of the equilibrator TECRDB data.
+
+    :param n_compound: number of compounds, i.e. NC
+
+    :param n_reaction: number of distinct reactions, i.e. NR
+
+    :param n_group: number of groups, i.e. NG
+
+    :param compounds_per_reaction: average number of compounds in a reaction,
+    which sets the sparsity of S. Every reaction has at least two compounds.
+
+    :param groups_per_compound: average number of groups in a compound, which
+    sets the sparsity of G. Every compound has at least one group.
+
+    :param measurements_per_reaction: average number of measurements of a
+    reaction. Every reaction has at least one measurement.
+
+    :param tauC: if set, the value of tauC. Otherwise it is drawn from the
+    prior.
+
+    :param sigma: if set, the value of sigma. Otherwise it is drawn from the
+    prior.
+
+    :param seed: seed for the random number generator
+    """
+
+    n_compound: int = 650
+    n_reaction: int = 1000
+    n_group: int = 160
+    compounds_per_reaction: float = 4.0
+    groups_per_compound: float = 4.0
+    measurements_per_reaction: float = 4.0
+    tauC: Optional[float] = None
+    sigma: Optional[float] = None
+    seed: int = 1234
+
+
+@dataclass
+class SyntheticData:
+    """Raw data for a synthetic network, and the parameters that made it.
+
+    :param raw_data: map from raw data names to tables, as expected by
+    dgfreg.data_preparation.prepare_data_equilibrator
+
+    :param parameters: the true values of new.stan's parameters, plus the
+    dense S (compounds x reactions) and G (compounds x groups)
+    """
+
+    raw_data: Dict[str, pd.DataFrame]
+    parameters: Dict[str, np.ndarray]
+
+
+def get_synthetic_G(
+    config: SyntheticNetworkConfig, rng: np.random.Generator
+) -> np.ndarray:
+    """Get a random compounds x groups matrix in which every group is used."""
+    NC, NG = config.n_compound, config.n_group
+    G = np.zeros((NC, NG))
+    n_groups = np.clip(
+        1 + rng.poisson(config.groups_per_compound - 1, size=NC), 1, NG
+    )
+    for c, n in enumerate(n_groups):
+        groups = rng.choice(NG, size=n, replace=False)
+        G[c, groups] = 1 + rng.poisson(0.5, size=n)
+    for g in np.flatnonzero(~G.any(axis=0)):
+        G[rng.integers(NC), g] = 1.0
+    return G
+
+
+def get_synthetic_S(
+    config: SyntheticNetworkConfig, rng: np.random.Generator
+) -> np.ndarray:
+    """Get a random compounds x reactions matrix.
+
+    Every compound is in at least one reaction and no two reactions have the
+    same stoichiometry, as data preparation would merge them.
+    """
+    NC, NR = config.n_compound, config.n_reaction
+    S = np.zeros((NC, NR))
+    seen = set()
+    r = 0
+    while r < NR:
+        n = np.clip(2 + rng.poisson(config.compounds_per_reaction - 2), 2, NC)
+        column = np.zeros(NC)
+        column[rng.choice(NC, size=n, replace=False)] = rng.choice(
+            COEFFICIENTS, size=n, p=COEFFICIENT_PROBABILITIES
+        )
+        if column.tobytes() not in seen:
+            seen.add(column.tobytes())
+            S[:, r] = column
+            r += 1
+    # put any unused compounds in random reactions
+    for c in np.flatnonzero(~S.any(axis=1)):
+        S[c, rng.integers(NR)] = rng.choice([-1.0, 1.0])
+    return S
+
+
+def generate_synthetic_data(config: SyntheticNetworkConfig) -> SyntheticData:
+    """Generate raw data for a synthetic network from new.stan's model.
+
+    :param config: a SyntheticNetworkConfig
+    """
+    rng = np.random.default_rng(config.seed)
+    NC, NR, NG = config.n_compound, config.n_reaction, config.n_group
+    tauC = (
+        config.tauC
+        if config.tauC is not None
+        else abs(rng.normal(0, TAUC_PRIOR_SD))
+    )
+    sigma = (
+        config.sigma
+        if config.sigma is not None
+        else abs(rng.normal(0, SIGMA_PRIOR_SD))
+    )
+    G = get_synthetic_G(config, rng)
+    S = get_synthetic_S(config, rng)
+    dgfG = rng.normal(DGFG_PRIOR_MEAN, DGFG_PRIOR_SD, size=NG)
+    qC = rng.normal(0, tauC, size=NC)
+    dgfC = G @ dgfG + qC
+    dgr = S.T @ dgfC
+    n_measurements = 1 + rng.poisson(
+        config.measurements_per_reaction - 1, size=NR
+    )
+    measurement_reaction = np.repeat(np.arange(NR), n_measurements)
+    y = rng.normal(dgr[measurement_reaction], sigma)
+    ids = np.arange(len(y))
+    compound_ids = np.arange(1, NC + 1)
+    inchi_keys = [f"SYNTHETIC{c}" for c in compound_ids]
+    ecs = [f"1.1.1.{r}" for r in range(NR)]
+    measurement_ecs = [ecs[r] for r in measurement_reaction]
+    n_ccm_compounds = max(1, int(CCM_FRACTION * NC))
+    n_ccm_reactions = max(1, int(CCM_FRACTION * NR))
+    raw_data = {
+        "e_coli_ccm_metabolites": pd.DataFrame(
+            {"inchi_key": inchi_keys[:n_ccm_compounds]}
+        ),
+        "e_coli_ccm_reactions": pd.DataFrame(
+            {"ec-code": ecs[:n_ccm_reactions]}
+        ),
+        "equilibrator_group_decomposition": pd.DataFrame(
+            G, columns=[f"g{g}" for g in range(NG)]
+        ).assign(compound_cc_id=compound_ids),
+        "equilibrator_stoichiometries": pd.concat(
+            [
+                pd.DataFrame({"compound_cc_id": compound_ids}),
+                pd.DataFrame(
+                    S[:, measurement_reaction], columns=ids.astype(str)
+                ),
+            ],
+            axis=1,
+        ),
+        "equilibrator_compounds": pd.DataFrame(
+            {"inchi_key": inchi_keys, "cc_id": compound_ids}
+        ),
+        "equilibrator_reactions": pd.DataFrame(
+            {
+                "Unnamed: 0": ids,
+                "description": [f"r{r}" for r in measurement_reaction],
+                "standard_dg(kilojoule / mole)": y,
+                "is_formation": False,
+            }
+        ),
+        "equilibrator_tecr": pd.DataFrame(
+            {
+                "reference": "synthetic",
+                "method": "synthetic",
+                "eval": "A",
+                "EC": measurement_ecs,
+                "reaction": [f"synthetic:r{r}" for r in measurement_reaction],
+                "description": [f"r{r}" for r in measurement_reaction],
+                "temperature": 298.15,
+                "ionic_strength": 0.1,
+                "p_h": 7.0,
+                "p_mg": 3.0,
+            },
+            index=ids,
+        ),
+    }
+    parameters = {
+        "tauC": tauC,
+        "sigma": sigma,
+        "dgfG": dgfG,
+        "qC": qC,
+        "dgfC": dgfC,
+        "S": S,
+        "G": G,
+    }
+    return SyntheticData(raw_data=raw_data, parameters=parameters)
+
+
+def generate_prepared_data(config: SyntheticNetworkConfig) -> PreparedData:
+    """Generate a synthetic network and prepare it like the real data."""
+    return prepare_data_equilibrator(**generate_synthetic_data(config).raw_data)
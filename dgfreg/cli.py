@@ -0,0 +1,167 @@
+"""The dgfreg command line interface.
+
+Each command only imports what it needs when it runs, so the commands that
+don't fit models, i.e. validate-config and predict, start quickly. For
+example:
+
+  dgfreg prepare --incremental
+  dgfreg validate-config inferences/*/config.toml
+  dgfreg sample --n-cores 8
+  dgfreg predict inferences/gaussian_approximation.npz reactions.csv
+
+"""
+
+import argparse
+import csv
+import sys
+from typing import Dict, List, Optional, Sequence, Tuple
+
+STOICHIOMETRY_COLUMNS = [
+    "reaction_id",
+    "compound_id",
+    "stoichiometric_coefficient",
+]
+
+
+def prepare(args: argparse.Namespace) -> int:
+    """Prepare the raw data."""
+    from dgfreg.data_preparation import prepare_data
+
+    prepare_data(incremental=args.incremental)
+    return 0
+
+
+def sample(args: argparse.Namespace) -> int:
+    """Fit all the inferences in the inferences folder."""
+    from dgfreg.sample import main
+
+    if args.n_cores is None:
+        main()
+    else:
+        main(n_cores=args.n_cores)
+    return 0
+
+
+def validate_config(args: argparse.Namespace) -> int:
+    """Check some inference configuration files, reporting any problems."""
+    from dgfreg.inference_configuration import load_inference_configuration
+
+    n_failed = 0
+    for path in args.paths:
+        try:
+            load_inference_configuration(path)
+        except Exception as e:
+            n_failed += 1
+            print(f"{path}: {type(e).__name__}: {e}")
+        else:
+            print(f"{path}: ok")
+    return int(n_failed > 0)
+
+
+def read_stoichiometry(path: str, compound_ids: Sequence[str]):
+    """Read reactions from a csv file, as a reactions x compounds matrix.
+
+    :param path: a csv file with the columns in STOICHIOMETRY_COLUMNS, i.e.
+    the same long format as a prepared stoichiometric matrix
+
+    :param compound_ids: the matrix's column ids
+    """
+    import numpy as np
+
+    compound_ix = {c: i for i, c in enumerate(compound_ids)}
+    reaction_ix: Dict[str, int] = {}
+    entries: List[Tuple[int, int, float]] = []
+    with open(path, newline="") as f:
+        reader = csv.DictReader(f)
+        missing = set(STOICHIOMETRY_COLUMNS) - set(reader.fieldnames or [])
+        if len(missing) > 0:
+            raise ValueError(f"{path} has no columns {sorted(missing)}.")
+        for row in reader:
+            if row["compound_id"] not in compound_ix.keys():
+                raise ValueError(
+                    f"Compound {row['compound_id']} is not in the posterior."
+                )
+            reaction_ix.setdefault(row["reaction_id"], len(reaction_ix))
+            entries.append(
+                (
+                    reaction_ix[row["reaction_id"]],
+                    compound_ix[row["compound_id"]],
+                    float(row["stoichiometric_coefficient"]),
+                )
+            )
+    S_t = np.zeros((len(reaction_ix), len(compound_ids)))
+    for r, c, coefficient in entries:
+        S_t[r, c] += coefficient
+    return list(reaction_ix.keys()), S_t
+
+
+def predict(args: argparse.Namespace) -> int:
+    """Predict reaction energies from a Gaussian approximation of dgfC."""
+    from dgfreg.gaussian_approximation import LowRankGaussian
+
+    approximation = LowRankGaussian.load(args.approximation)
+    reaction_ids, S_t = read_stoichiometry(
+        args.stoichiometry, approximation.ids.tolist()
+    )
+    mean, sd = approximation.get_linear_moments(S_t)
+    f = sys.stdout if args.output is None else open(args.output, "w")
+    try:
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(["reaction_id", "mean", "sd"])
+        writer.writerows(zip(reaction_ids, mean.tolist(), sd.tolist()))
+    finally:
+        if f is not sys.stdout:
+            f.close()
+    return 0
+
+
+def get_parser() -> argparse.ArgumentParser:
+    """Get the parser for the dgfreg command."""
+    parser = argparse.ArgumentParser(
+        prog="dgfreg", description=__doc__.splitlines()[0]
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    prepare_parser = commands.add_parser("prepare", help=prepare.__doc__)
+    prepare_parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only process new measurements if nothing else has changed",
+    )
+    prepare_parser.set_defaults(func=prepare)
+    sample_parser = commands.add_parser("sample", help=sample.__doc__)
+    sample_parser.add_argument(
+        "--n-cores",
+        type=int,
+        default=None,
+        help="how many cpu cores the jobs may use at once (default: all)",
+    )
+    sample_parser.set_defaults(func=sample)
+    validate_parser = commands.add_parser(
+        "validate-config", help=validate_config.__doc__
+    )
+    validate_parser.add_argument("paths", nargs="+", metavar="config.toml")
+    validate_parser.set_defaults(func=validate_config)
+    predict_parser = commands.add_parser("predict", help=predict.__doc__)
+    predict_parser.add_argument(
+        "approximation",
+        help="a Gaussian approximation of dgfC saved by LowRankGaussian.save",
+    )
+    predict_parser.add_argument(
+        "stoichiometry",
+        help="csv file with columns " + ", ".join(STOICHIOMETRY_COLUMNS),
+    )
+    predict_parser.add_argument(
+        "--output", default=None, help="csv file for the predictions"
+    )
+    predict_parser.set_defaults(func=predict)
+    return parser
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    """Run a dgfreg command, returning its exit status."""
+    args = get_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,357 @@
+"""An exact posterior for new.stan that doesn't need Stan.
+
+Given tauC and sigma, the model in new.stan is a linear regression of y on
+S'G dgfG + S' qC with Gaussian priors, so dgfG and qC can be integrated out.
+This module finds the marginal posterior of (log tauC, log sigma) on a grid
+around its mode, then for each draw of the hyperparameters draws dgfG and qC
+exactly from their Gaussian conditional posterior. Draws that share a grid
+point share a Cholesky factorisation.
+
+The only approximation is that the hyperparameter draws are restricted to the
+grid points, each with its marginal posterior probability.
+
+"""
+
+from dataclasses import dataclass
+from types import SimpleNamespace
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import xarray as xr
+from scipy import linalg, optimize, stats
+from scipy.sparse import csr_matrix
+from dgfreg.stan_input_functions import get_qr_reparameterisation
+
+# the priors in new.stan, which tests/test_unit/test_collapsed.py checks
+# against the Stan files in fitting_mode.COLLAPSED_STAN_FILES
+DGFG_PRIOR_MEAN = -500.0
+DGFG_PRIOR_SD = 1000.0
+TAUC_PRIOR_SD = 4.0
+SIGMA_PRIOR_SD = 4.0
+DEFAULT_N_GRID = 21
+# how many marginal posterior standard deviations the grid spans either side
+# of the mode
+DEFAULT_GRID_WIDTH = 4.0
+# step for the finite difference hessian at the mode, on the log scale
+HESSIAN_STEP = 1e-2
+# grid points with less than this fraction of the biggest weight are dropped
+MIN_GRID_WEIGHT = 1e-12
+RANK_TOL = 1e-10
+
+
+@dataclass
+class CollapsedModel:
+    """new.stan's regression, with its data arranged for integrating out.
+
+    The linear parameters are theta = (beta, qC), where dgfG = B beta and B is
+    an orthonormal basis for the row space of S'G. If S'G has full column rank
+    then B is square and beta is just a rotation of dgfG. Otherwise, as in
+    new.stan, dgfG can only vary in the row space of S'G.
+
+    :param St: the NR x NC matrix S'
+
+    :param G: the NC x NG matrix G
+
+    :param SG: the NR x NG matrix S'G
+
+    :param B: orthonormal basis for the row space of S'G
+
+    :param Rstar: new.stan's Rstar, for getting qG from dgfG
+
+    :param y: measurements for all reactions
+
+    :param nobs: number of measurements for each reaction
+
+    :param ix_train: zero-indexed positions of the training reactions
+
+    :param ix_test: zero-indexed positions of the test reactions
+
+    :param K: X' diag(nobs) X, where X is the training reactions' design
+
+    :param c: X' diag(nobs) y
+
+    :param yy: y' diag(nobs) y, over the training reactions
+    """
+
+    St: np.ndarray
+    G: np.ndarray
+    SG: np.ndarray
+    B: np.ndarray
+    Rstar: np.ndarray
+    y: np.ndarray
+    nobs: np.ndarray
+    ix_train: np.ndarray
+    ix_test: np.ndarray
+    K: np.ndarray
+    c: np.ndarray
+    yy: float
+
+    @property
+    def rank(self) -> int:
+        """Get the number of free dimensions of dgfG."""
+        return self.B.shape[1]
+
+    @property
+    def prior_mean(self) -> np.ndarray:
+        """Get the prior mean of theta."""
+        return np.concatenate(
+            [DGFG_PRIOR_MEAN * self.B.sum(axis=0), np.zeros(self.St.shape[1])]
+        )
+
+    def get_prior_variance(self, tauC: float) -> np.ndarray:
+        """Get the diagonal prior covariance of theta."""
+        return np.concatenate(
+            [
+                np.full(self.rank, DGFG_PRIOR_SD**2),
+                np.full(self.St.shape[1], tauC**2),
+            ]
+        )
+
+
+def get_St_and_G(input_dict: dict) -> Tuple[np.ndarray, np.ndarray]:
+    """Get dense S' and G from a dense or sparse Stan input."""
+    if "S" in input_dict.keys():
+        St = np.asarray(input_dict["S"], dtype=float).T
+        return St, np.asarray(input_dict["G"], dtype=float)
+    NR, NC, NG = (int(input_dict[k]) for k in ["NR", "NC", "NG"])
+    St, G = (
+        csr_matrix(
+            (
+                np.asarray(input_dict[f"{m}_w"], dtype=float),
+                np.asarray(input_dict[f"{m}_v"]) - 1,
+                np.asarray(input_dict[f"{m}_u"]) - 1,
+            ),
+            shape=shape,
+        ).toarray()
+        for m, shape in [("St", (NR, NC)), ("G", (NC, NG))]
+    )
+    return St, G
+
+
+def get_collapsed_model(input_dict: dict) -> CollapsedModel:
+    """Arrange a Stan input for new.stan for the collapsed posterior.
+
+    :param input_dict: a Stan input from one of the functions in
+    dgfreg.stan_input_functions
+    """
+    St, G = get_St_and_G(input_dict)
+    SG = St @ G
+    _, s, Vt = np.linalg.svd(SG, full_matrices=False)
+    B = Vt[s > RANK_TOL * s[0]].T
+    Qstar, _ = get_qr_reparameterisation(SG, cache_dir=None)
+    Rstar = Qstar.T @ SG / (len(SG) - 1)
+    y = np.asarray(input_dict["y"], dtype=float)
+    nobs = np.asarray(input_dict["nobs"], dtype=float)
+    ix_train = np.asarray(input_dict["ix_train"], dtype=int) - 1
+    ix_test = np.asarray(input_dict["ix_test"], dtype=int) - 1
+    X = np.hstack([SG[ix_train] @ B, St[ix_train]])
+    weighted = X * nobs[ix_train, np.newaxis]
+    return CollapsedModel(
+        St=St,
+        G=G,
+        SG=SG,
+        B=B,
+        Rstar=Rstar,
+        y=y,
+        nobs=nobs,
+        ix_train=ix_train,
+        ix_test=ix_test,
+        K=weighted.T @ X,
+        c=weighted.T @ y[ix_train],
+        yy=float(nobs[ix_train] @ y[ix_train] ** 2),
+    )
+
+
+def get_conditional_posterior(
+    model: CollapsedModel, tauC: float, sigma: float
+) -> Tuple[np.ndarray, np.ndarray, float]:
+    """Get the posterior of theta given tauC and sigma.
+
+    :return: the lower Cholesky factor L of the posterior precision, the
+    posterior mean, and the log marginal likelihood of the training
+    measurements
+    """
+    m0 = model.prior_mean
+    v0 = model.get_prior_variance(tauC)
+    precision = np.diag(1 / v0) + model.K / sigma**2
+    L = linalg.cholesky(precision, lower=True)
+    b = m0 / v0 + model.c / sigma**2
+    Linv_b = linalg.solve_triangular(L, b, lower=True)
+    mean = linalg.solve_triangular(L, Linv_b, lower=True, trans="T")
+    nobs_train = model.nobs[model.ix_train]
+    quadratic = model.yy / sigma**2 + m0 @ (m0 / v0) - Linv_b @ Linv_b
+    log_det = (
+        2 * np.log(np.diag(L)).sum()
+        + np.log(v0).sum()
+        + np.log(sigma**2 / nobs_train).sum()
+    )
+    log_marginal = -0.5 * (
+        len(nobs_train) * np.log(2 * np.pi) + log_det + quadratic
+    )
+    return L, mean, log_marginal
+
+
+def get_log_hyperposterior(model: CollapsedModel, u: np.ndarray) -> float:
+    """Get the unnormalised log posterior density of (log tauC, log sigma)."""
+    tauC, sigma = np.exp(u)
+    _, _, log_marginal = get_conditional_posterior(model, tauC, sigma)
+    return (
+        log_marginal
+        + stats.halfnorm.logpdf(tauC, scale=TAUC_PRIOR_SD)
+        + stats.halfnorm.logpdf(sigma, scale=SIGMA_PRIOR_SD)
+        + u.sum()
+    )
+
+
+def get_hyperparameter_grid(
+    model: CollapsedModel,
+    n_grid: int = DEFAULT_N_GRID,
+    grid_width: float = DEFAULT_GRID_WIDTH,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Get a grid of (log tauC, log sigma) values and their probabilities.
+
+    The grid is aligned with the eigenvectors of the marginal posterior's
+    hessian at its mode, and spans grid_width standard deviations either side
+    of the mode in each direction.
+
+    :return: an array of grid points with shape (points, 2), and their
+    normalised probabilities
+    """
+
+    def f(u):
+        return -get_log_hyperposterior(model, u)
+
+    mode = optimize.minimize(f, np.zeros(2), method="Nelder-Mead").x
+    hessian = np.empty((2, 2))
+    steps = np.eye(2) * HESSIAN_STEP
+    for i in range(2):
+        for j in range(2):
+            hessian[i, j] = (
+                f(mode + steps[i] + steps[j])
+                - f(mode + steps[i] - steps[j])
+                - f(mode - steps[i] + steps[j])
+                + f(mode - steps[i] - steps[j])
+            ) / (4 * HESSIAN_STEP**2)
+    eigenvalues, eigenvectors = np.linalg.eigh(hessian)
+    scale = eigenvectors / np.sqrt(np.clip(eigenvalues, 1e-8, None))
+    z = np.linspace(-grid_width, grid_width, n_grid)
+    zz = np.stack(np.meshgrid(z, z), axis=-1).reshape(-1, 2)
+    points = mode + zz @ scale.T
+    log_density = np.array([-f(u) for u in points])
+    weights = np.exp(log_density - log_density.max())
+    keep = weights > MIN_GRID_WEIGHT
+    return points[keep], weights[keep] / weights[keep].sum()
+
+
+def sample_collapsed(
+    model: CollapsedModel,
+    n_draws: int,
+    output_flags: Dict[str, int],
+    seed: Optional[int] = None,
+    n_grid: int = DEFAULT_N_GRID,
+    grid_width: float = DEFAULT_GRID_WIDTH,
+) -> Dict[str, np.ndarray]:
+    """Get posterior draws of all of new.stan's variables.
+
+    :param model: a CollapsedModel
+
+    :param n_draws: how many draws to make
+
+    :param output_flags: which optional generated quantities to output, as
+    from dgfreg.fitting_mode.get_output_flags. Skipped quantities have size
+    zero, as in Stan's output.
+
+    :param seed: seed for the random number generator
+
+    :param n_grid: number of grid points along each hyperparameter axis
+
+    :param grid_width: how many standard deviations the grid spans either side
+    of the mode
+
+    :return: a map from Stan variable names to arrays whose first axis is the
+    draw, in the order of new.stan's output
+    """
+    rng = np.random.default_rng(seed)
+    points, probabilities = get_hyperparameter_grid(model, n_grid, grid_width)
+    point_ix = rng.choice(len(points), size=n_draws, p=probabilities)
+    tauC, sigma = np.exp(points[point_ix]).T
+    theta = np.empty((n_draws, len(model.c)))
+    for i in np.unique(point_ix):
+        ix = np.flatnonzero(point_ix == i)
+        L, mean, _ = get_conditional_posterior(model, *np.exp(points[i]))
+        z = rng.standard_normal((len(mean), len(ix)))
+        theta[ix] = (
+            mean + linalg.solve_triangular(L, z, lower=True, trans="T").T
+        )
+    dgfG = theta[:, : model.rank] @ model.B.T
+    qC = theta[:, model.rank :]
+    dgfC = dgfG @ model.G.T + qC
+    dgr = dgfC @ model.St.T
+    dgr_test = dgr[:, model.ix_test]
+    y_test = model.y[model.ix_test]
+    sd_test = sigma[:, np.newaxis] / np.sqrt(model.nobs[model.ix_test])
+    yrep = rng.normal(dgr_test, sd_test)
+    empty = np.empty((n_draws, 0))
+    return {
+        "qC": qC,
+        "qG": dgfG @ model.Rstar.T,
+        "tauC": tauC,
+        "sigma": sigma,
+        "dgfG": dgfG,
+        "llik": stats.norm.logpdf(y_test, dgr_test, sd_test),
+        "dgfC": dgfC if output_flags["output_dgfC"] else empty,
+        "dgr": dgr if output_flags["output_dgr"] else empty,
+        "yrep": yrep if output_flags["output_yrep"] else empty,
+        "mae": np.abs(y_test - dgr_test).mean(axis=1),
+    }
+
+
+class CollapsedFit:
+    """Draws from the collapsed posterior, presented like a CmdStanMCMC.
+
+    The draws are independent, so they are split arbitrarily into chains
+    with no warmup.
+
+    :param draws: output of sample_collapsed
+
+    :param chains: how many chains to split the draws into
+    """
+
+    num_draws_warmup = 0
+    _save_warmup = False
+
+    def __init__(self, draws: Dict[str, np.ndarray], chains: int):
+        """Initialise a CollapsedFit."""
+        self.draws = draws
+        self.chains = chains
+        self.metadata = SimpleNamespace(
+            stan_vars={k: v.shape[1:] for k, v in draws.items()},
+            method_vars={},
+        )
+
+    def stan_variable(self, var: str, inc_warmup: bool = False) -> np.ndarray:
+        """Get the draws of a Stan variable, with draws as the first axis."""
+        return self.draws[var]
+
+    def method_variables(self) -> Dict[str, np.ndarray]:
+        """Get the method variables, of which there are none."""
+        return {}
+
+    def draws_xr(self, vars) -> xr.Dataset:
+        """Get draws of some Stan variables, like CmdStanMCMC.draws_xr."""
+        data_vars = {}
+        for var in vars:
+            draws = self.draws[var]
+            draws = draws.reshape(self.chains, -1, *draws.shape[1:])
+            dims = ["chain", "draw"] + [
+                f"{var}_dim_{i}" for i in range(draws.ndim - 2)
+            ]
+            data_vars[var] = (dims, draws)
+        n_draws = len(next(iter(self.draws.values()))) // self.chains
+        return xr.Dataset(
+            data_vars,
+            coords={
+                "chain": np.arange(1, self.chains + 1),
+                "draw": np.arange(n_draws),
+            },
+        )
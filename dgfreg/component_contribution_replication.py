@@ -2,25 +2,47 @@
 
 See https://gitlab.com/equilibrator/component-contribution/-/blob/develop/src/component_contribution/trainer.py for the target logic
 
+Component contribution's pseudo-inverses and projections all come from the
+Gram matrices S S' and GS GS'. Here each of these is factorised once as Q H Q',
+where Q is an orthonormal basis for the range. Cross-validation folds can then
+reuse the full data factorisation, removing their held-out reactions with a
+low rank downdate instead of refactorising.
+
+The covariance of the formation energies has one row and column per compound,
+so fits can skip it, or only compute the rows and columns of some compounds,
+when that is all they need.
+
 """
+
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
-from typing import List
+from typing import List, Optional, Sequence, Tuple
 
 import numpy as np
 import pandas as pd
-from component_contribution.linalg import LINALG
 from tqdm import tqdm
 
+# singular values at most this big count as zero, as in component
+# contribution's LINALG.invert_project
+RANK_TOL = 1e-10
+# downdates whose capacitance matrix has an eigenvalue smaller than this would
+# change the range, so the fold is refactorised instead
+DOWNDATE_TOL = 1e-6
+
 
 @dataclass
 class ComponentContributionFit:
-    """Result of fitting component contribution."""
+    """Result of fitting component contribution.
+
+    cov_dgf is None if the fit didn't compute the covariance, and only has the
+    chosen compounds if it was restricted.
+    """
 
     S: pd.DataFrame
     G: pd.DataFrame
     measurements: pd.DataFrame
     mu_dgf: pd.Series
-    cov_dgf: pd.DataFrame
+    cov_dgf: Optional[pd.DataFrame]
 
 
 @dataclass
@@ -32,13 +54,262 @@ class ComponentContributionReplication:
     splits: List[List[List[int]]]
 
 
+@dataclass
+class GramPinv:
+    """The pseudo-inverse Q H Q' of a Gram matrix A A'.
+
+    :param Q: orthonormal basis for the range of A
+
+    :param H: symmetric matrix with one row and column per column of Q
+    """
+
+    Q: np.ndarray
+    H: np.ndarray
+
+    @property
+    def rank(self) -> int:
+        """Get the rank of A."""
+        return self.Q.shape[1]
+
+    def dot(self, x: np.ndarray) -> np.ndarray:
+        """Multiply the pseudo-inverse by x."""
+        return self.Q @ (self.H @ (self.Q.T @ x))
+
+    def project(self, x: np.ndarray) -> np.ndarray:
+        """Project x onto the range of A."""
+        return self.Q @ (self.Q.T @ x)
+
+
+@dataclass
+class CrossValidationContext:
+    """What every cross-validation fold needs.
+
+    :param S: stoichiometric matrix with all reactions
+
+    :param G: group incidence matrix
+
+    :param b: measurements of all reactions
+
+    :param rc: if set, the factorisation of S S' to downdate
+
+    :param gc: if set, the factorisation of GS GS' to downdate
+
+    :param return_cov: whether to compute the covariance
+
+    :param cov_rows: if set, positions of the compounds to compute the
+    covariance of
+    """
+
+    S: np.ndarray
+    G: np.ndarray
+    b: np.ndarray
+    rc: Optional[GramPinv] = None
+    gc: Optional[GramPinv] = None
+    return_cov: bool = True
+    cov_rows: Optional[np.ndarray] = None
+
+
+# set in each cross-validation worker process by set_cv_context
+_cv_context: Optional[CrossValidationContext] = None
+
+
+def get_gram_pinv(A: np.ndarray) -> GramPinv:
+    """Get the pseudo-inverse of A A' from the singular values of A."""
+    U, s, _ = np.linalg.svd(A, full_matrices=False)
+    r = int((s > RANK_TOL).sum())
+    return GramPinv(Q=U[:, :r], H=np.diag(1 / s[:r] ** 2))
+
+
+def downdate_gram_pinv(pinv: GramPinv, C: np.ndarray) -> Optional[GramPinv]:
+    """Get the pseudo-inverse of A A' - C C', where C is some columns of A.
+
+    This uses the Woodbury identity within the range of A, so it costs
+    O(rank^2 x number of columns) rather than a new decomposition. It only
+    works if removing the columns keeps the range of A: if not, None is
+    returned.
+
+    :param pinv: the pseudo-inverse of A A'
+
+    :param C: the columns to remove
+    """
+    if C.shape[1] == 0:
+        return pinv
+    HW = pinv.H @ (pinv.Q.T @ C)
+    capacitance = np.eye(C.shape[1]) - (pinv.Q.T @ C).T @ HW
+    if np.linalg.eigvalsh(capacitance).min() < DOWNDATE_TOL:
+        return None
+    H = pinv.H + HW @ np.linalg.solve(capacitance, HW.T)
+    return GramPinv(Q=pinv.Q, H=H)
+
+
+def get_cov_rows(
+    compound_ids: pd.Index, cov_compounds: Optional[Sequence]
+) -> Optional[np.ndarray]:
+    """Get the positions of the compounds to compute the covariance of.
+
+    :param compound_ids: ids of all compounds
+
+    :param cov_compounds: ids of some compounds, or None for all of them
+    """
+    if cov_compounds is None:
+        return None
+    cov_rows = compound_ids.get_indexer(pd.Index(cov_compounds))
+    if (cov_rows == -1).any():
+        missing = pd.Index(cov_compounds)[cov_rows == -1].tolist()
+        raise ValueError(f"Compounds {missing} are not in S.")
+    return cov_rows
+
+
+def get_cc_estimates(
+    S: np.ndarray,
+    G: np.ndarray,
+    GS: np.ndarray,
+    b: np.ndarray,
+    rc: GramPinv,
+    gc: GramPinv,
+    return_cov: bool = True,
+    cov_rows: Optional[np.ndarray] = None,
+) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """Get component contribution's formation energy mean and covariance.
+
+    Only the rows and columns of the covariance for cov_rows are formed, so
+    the cost is quadratic in the number of chosen compounds rather than in
+    the number of all compounds.
+
+    :param S: stoichiometric matrix
+
+    :param G: group incidence matrix
+
+    :param GS: G' S
+
+    :param b: measurements
+
+    :param rc: pseudo-inverse of S S'
+
+    :param gc: pseudo-inverse of GS GS'
+
+    :param return_cov: whether to compute the covariance. If not, None is
+    returned instead.
+
+    :param cov_rows: if set, positions of the compounds to compute the
+    covariance of
+    """
+    # Linear regressions for the reactant (RC) and group (GC) layers
+    dG0_rc = rc.dot(S @ b)
+    dG0_gc = gc.dot(GS @ b)
+
+    # Calculate the contributions in the stoichiometric space
+    G_gc = G @ dG0_gc
+    dG0_cc = rc.project(dG0_rc) + G_gc - rc.project(G_gc)
+    if not return_cov:
+        return dG0_cc, None
+
+    # Calculate the residual error (unweighted squared error divided
+    # by N - rank)
+    e_rc = S.T @ dG0_rc - b
+    MSE_rc = (e_rc.T @ e_rc) / (S.shape[1] - rc.rank)
+
+    e_gc = GS.T @ dG0_gc - b
+    MSE_gc = (e_gc.T @ e_gc) / (S.shape[1] - gc.rank)
+
+    # Calculate the MSE of GC residuals for all reactions in ker(G).
+    kerG_inds = list(np.where(np.all(GS == 0, 0))[0].flat)
+
+    e_kerG = e_gc[kerG_inds]
+    MSE_kerG = (e_kerG.T @ e_kerG) / len(kerG_inds)
+
+    # Calculate the uncertainty covariance matrices, using P_N_rc G for the
+    # part of G outside the range of S
+    rows = slice(None) if cov_rows is None else cov_rows
+    Q_rc = rc.Q[rows]
+    N_rc_G = G[rows] - Q_rc @ (rc.Q.T @ G)
+    N_rc_G_Q = N_rc_G @ gc.Q
+    V_rc = Q_rc @ rc.H @ Q_rc.T
+    V_gc = N_rc_G_Q @ gc.H @ N_rc_G_Q.T
+    V_inf = N_rc_G @ N_rc_G.T - N_rc_G_Q @ N_rc_G_Q.T
+
+    return dG0_cc, MSE_rc * V_rc + MSE_gc * V_gc + MSE_kerG * V_inf
+
+
+def set_cv_context(context: CrossValidationContext):
+    """Give this process the data for fitting cross-validation folds."""
+    global _cv_context
+    _cv_context = context
+
+
+def fit_cv_fold(
+    ix_train: List[int],
+) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """Fit component contribution to the training reactions of a fold.
+
+    If the context has factorisations, they are downdated to remove the
+    other reactions. A factorisation is only recomputed if removing the
+    reactions changes its range.
+    """
+    context = _cv_context
+    assert context is not None, "set_cv_context must be called first"
+    S = context.S[:, ix_train]
+    GS = context.G.T @ S
+    rc, gc = None, None
+    if context.rc is not None and context.gc is not None:
+        n_reactions = context.S.shape[1]
+        C = context.S[:, np.setdiff1d(np.arange(n_reactions), ix_train)]
+        rc = downdate_gram_pinv(context.rc, C)
+        gc = downdate_gram_pinv(context.gc, context.G.T @ C)
+    if rc is None:
+        rc = get_gram_pinv(S)
+    if gc is None:
+        gc = get_gram_pinv(GS)
+    return get_cc_estimates(
+        S,
+        context.G,
+        GS,
+        context.b[ix_train],
+        rc,
+        gc,
+        return_cov=context.return_cov,
+        cov_rows=context.cov_rows,
+    )
+
+
+def to_cov_dgf(
+    cov: Optional[np.ndarray],
+    compound_ids: pd.Index,
+    cov_rows: Optional[np.ndarray],
+) -> Optional[pd.DataFrame]:
+    """Put a covariance matrix from get_cc_estimates in a DataFrame."""
+    if cov is None:
+        return None
+    ids = compound_ids if cov_rows is None else compound_ids[cov_rows]
+    return pd.DataFrame(cov, index=ids, columns=ids)
+
+
 def replicate_component_contribution(
     S_in: pd.DataFrame,
     G_in: pd.DataFrame,
     measurements_in: pd.DataFrame,
     splits: List[List[List[int]]],
+    n_workers: int = 1,
+    downdate: bool = False,
+    return_cov_cv: bool = True,
+    cov_compounds_cv: Optional[Sequence] = None,
 ) -> ComponentContributionReplication:
-    """Do the main analysis."""
+    """Do the main analysis.
+
+    :param splits: list of [ix_train, ix_test] pairs of reaction positions
+
+    :param n_workers: how many processes to fit the folds with
+
+    :param downdate: whether to reuse the full data factorisations for the
+    folds, rather than refactorising for each fold
+
+    :param return_cov_cv: whether to compute the covariance for each fold. If
+    not, the folds only have point estimates.
+
+    :param cov_compounds_cv: if set, ids of the compounds whose covariance
+    to compute for each fold, e.g. the ones where CompoundDF.is_e_coli_ccm is
+    true. The full data fit always has the full covariance.
+    """
     S = S_in.copy()
     G = G_in.copy()
     measurements = measurements_in.copy()
@@ -47,20 +318,65 @@ def replicate_component_contribution(
     G.index = map(int, G.index)  # type: ignore
     measurements.index = map(int, measurements.index)  # type: ignore
     fit = fit_component_contribution(S, G, measurements)
-    fits_cv = []
-    for ix_train, _ in tqdm(splits):
-        S_train = S.iloc[:, ix_train]
-        measurements_train = measurements.iloc[ix_train]
-        fits_cv.append(
-            fit_component_contribution(S_train, G, measurements_train)
+    cov_rows = get_cov_rows(
+        S.index,
+        None if cov_compounds_cv is None else list(map(int, cov_compounds_cv)),
+    )
+    context = CrossValidationContext(
+        S=S.values,
+        G=G.values,
+        b=measurements["y"].values,
+        return_cov=return_cov_cv,
+        cov_rows=cov_rows,
+    )
+    if downdate:
+        context.rc = get_gram_pinv(context.S)
+        context.gc = get_gram_pinv(context.G.T @ context.S)
+    train_ixs = [ix_train for ix_train, _ in splits]
+    if n_workers > 1:
+        chunksize = max(1, len(splits) // (4 * n_workers))
+        with ProcessPoolExecutor(
+            max_workers=n_workers,
+            initializer=set_cv_context,
+            initargs=(context,),
+        ) as executor:
+            estimates = list(
+                tqdm(
+                    executor.map(fit_cv_fold, train_ixs, chunksize=chunksize),
+                    total=len(splits),
+                )
+            )
+    else:
+        set_cv_context(context)
+        estimates = [fit_cv_fold(ix_train) for ix_train in tqdm(train_ixs)]
+    fits_cv = [
+        ComponentContributionFit(
+            S.iloc[:, ix_train],
+            G,
+            measurements.iloc[ix_train],
+            pd.Series(mu_dgf, index=S.index),
+            to_cov_dgf(cov_dgf, S.index, cov_rows),
         )
+        for ix_train, (mu_dgf, cov_dgf) in zip(train_ixs, estimates)
+    ]
     return ComponentContributionReplication(fit, fits_cv, splits)
 
 
 def fit_component_contribution(
-    S_in: pd.DataFrame, G_in: pd.DataFrame, measurements: pd.DataFrame
+    S_in: pd.DataFrame,
+    G_in: pd.DataFrame,
+    measurements: pd.DataFrame,
+    return_cov: bool = True,
+    cov_compounds: Optional[Sequence] = None,
 ) -> ComponentContributionFit:
-    """Copy the component contribution fitting logic."""
+    """Copy the component contribution fitting logic.
+
+    :param return_cov: whether to compute the covariance of the formation
+    energies. If not, the fit's cov_dgf is None.
+
+    :param cov_compounds: if set, ids of the compounds whose covariance to
+    compute
+    """
     b = measurements["y"].values
     S = S_in.values
     G = G_in.values
@@ -69,49 +385,17 @@ def fit_component_contribution(
     assert (G_in.index == S_in.index).all()
     assert (measurements.index == S_in.columns).all()
 
-    # Linear regression for the reactant layer (aka RC)
-    inv_S, r_rc, P_R_rc, P_N_rc = LINALG.invert_project(S)
-
-    # Linear regression for the group layer (aka GC)
-    inv_GS, r_gc, P_R_gc, P_N_gc = LINALG.invert_project(GS)
-
-    # calculate the group contributions
-    dG0_gc = inv_GS.T @ b
-
-    # Calculate the contributions in the stoichiometric space
-    dG0_rc = inv_S.T @ b
-    dG0_cc = P_R_rc @ dG0_rc + P_N_rc @ G @ dG0_gc
-
-    # Calculate the residual error (unweighted squared error divided
-    # by N - rank)
-    e_rc = S.T @ dG0_rc - b
-    MSE_rc = (e_rc.T @ e_rc) / (S.shape[1] - r_rc)
-
-    e_gc = GS.T @ dG0_gc - b
-    MSE_gc = (e_gc.T @ e_gc) / (S.shape[1] - r_gc)
-
-    # Calculate the MSE of GC residuals for all reactions in ker(G).
-    # This will help later to give an estimate of the uncertainty for such
-    # reactions, which otherwise would have a 0 uncertainty in the GC
-    # method.
-    kerG_inds = list(np.where(np.all(GS == 0, 0))[0].flat)
-
-    e_kerG = e_gc[kerG_inds]
-    MSE_kerG = (e_kerG.T @ e_kerG) / len(kerG_inds)
-
-    # Calculate the uncertainty covariance matrices
-    inv_SWS, _, _, _ = LINALG.invert_project(S @ S.T)
-    inv_GSWGS, _, _, _ = LINALG.invert_project(GS @ GS.T)
-
-    V_rc = P_R_rc @ inv_SWS @ P_R_rc
-    V_gc = P_N_rc @ G @ inv_GSWGS @ G.T @ P_N_rc
-    V_inf = P_N_rc @ G @ P_N_gc @ G.T @ P_N_rc
-
-    mu_dgf = pd.Series(dG0_cc, index=S_in.index)
-    cov_dgf = pd.DataFrame(
-        MSE_rc * V_rc + MSE_gc * V_gc + MSE_kerG * V_inf,
-        index=S_in.index,
-        columns=S_in.index,
+    cov_rows = get_cov_rows(S_in.index, cov_compounds)
+    mu, cov = get_cc_estimates(
+        S,
+        G,
+        GS,
+        b,
+        get_gram_pinv(S),
+        get_gram_pinv(GS),
+        return_cov=return_cov,
+        cov_rows=cov_rows,
     )
+    mu_dgf = pd.Series(mu, index=S_in.index)
+    cov_dgf = to_cov_dgf(cov, S_in.index, cov_rows)
     return ComponentContributionFit(S_in, G_in, measurements, mu_dgf, cov_dgf)
-
@@ -4,26 +4,26 @@ These functions should take in a dataframe of measurements and return a
 PreparedData object.
 
 """
+import hashlib
+import inspect
 import json
 import os
 
 from os.path import join as pjoin
+from typing import Callable, Dict, Optional, Tuple
 
+import numpy as np
 import pandas as pd
 import pandera as pa
+from pyarrow import feather
 from pandera.typing import DataFrame, Series
 from pydantic import BaseModel
 from dgfreg import util
 
-PREPARED_FILES = [
-    "name.txt",
-    "coords.json",
-    "measurements.csv",
-    "S.csv",
-    "G.csv",
-    "compounds.csv",
-    "reactions.csv",
-]
+PREPARED_TABLES = ["measurements", "S", "G", "compounds", "reactions"]
+PREPARED_FILE_FORMATS = ["arrow", "csv"]
+FINGERPRINT_FILE = "fingerprint.json"
+HASH_CHUNK_SIZE = 2 ** 20
 N_CV_FOLDS = 10
 HERE = os.path.dirname(__file__)
 DATA_DIR = pjoin(HERE, "..", "data")
@@ -41,6 +41,32 @@ RAW_DATA_FILES = {
     "equilibrator_group_definitions": pjoin(RAW_DIR, "group_definitions.csv"),
     "equilibrator_group_summary": pjoin(RAW_DIR, "group_summary.csv"),
 }
+# raw data that incremental data preparation can handle new rows of
+APPENDABLE_RAW_DATA = [
+    "equilibrator_reactions",
+    "equilibrator_stoichiometries",
+    "equilibrator_tecr",
+]
+EQUILIBRATOR_Y_COLS = [
+    "measurement_id",
+    "reaction_id",
+    "y",
+    "p_h",
+    "temperature",
+    "ionic_strength",
+    "p_mg",
+    "reference",
+    "method",
+    "eval",
+]
+EQUILIBRATOR_REACTION_COLS = [
+    "reaction_id",
+    "EC",
+    "is_formation",
+    "is_e_coli_ccm",
+    "description",
+    "reaction",
+]
 
 
 
@@ -101,97 +127,72 @@ class PreparedData(BaseModel, arbitrary_types_allowed=True):
     compounds: DataFrame[CompoundDF]
 
 
-def prepare_data_equilibrator(**raw_data) -> PreparedData:
-    ccm_ecs = raw_data["e_coli_ccm_reactions"]["ec-code"].unique()
-    ccm_inchi_keys = (
-        raw_data["e_coli_ccm_metabolites"]["inchi_key"].unique()
-    )
-    y_cols = [
-        "measurement_id",
-        "reaction_id",
-        "y",
-        "p_h",
-        "temperature",
-        "ionic_strength",
-        "p_mg",
-        "reference",
-        "method",
-        "eval",
-    ]
-    reaction_cols = [
-        "reaction_id",
-        "EC",
-        "is_formation",
-        "is_e_coli_ccm",
-        "description",
-        "reaction",
-    ]
-    G = (
-        raw_data["equilibrator_group_decomposition"]
-        .rename(columns={"compound_cc_id": "compound_id"})
-        .mask(lambda df: df == 0)
-        .set_index("compound_id")
-        .rename_axis("group_id", axis=1)
-        .stack()
-        .rename("stoichiometric_coefficient")
-        .reset_index()
-        .assign(
-            group_id=lambda df: df["group_id"].astype("string"),
-            compound_id=lambda df: df["compound_id"].astype(int),
-        )
-    )
-    S_full = (
-        raw_data["equilibrator_stoichiometries"]
+def get_stoichiometries_long(
+    raw_stoichiometries: pd.DataFrame, measurement_ids=None
+) -> pd.DataFrame:
+    """Get raw stoichiometries in long form, with zero entries ignored.
+
+    :param raw_stoichiometries: raw table with a column "compound_cc_id" and
+    one column per measurement.
+
+    :param measurement_ids: optional list of measurement ids to include.
+
+    """
+    S_raw = (
+        raw_stoichiometries
         .rename(columns={"compound_cc_id": "compound_id"})
         .set_index("compound_id")
-        .T
-        .drop_duplicates()
-        .T
-    )
-    S_full = (
-        S_full
-        .set_axis(range(1, len(S_full.columns) + 1), axis=1)
-        .rename_axis("reaction_id", axis=1)
     )
-    measurement_to_reaction = (
-        raw_data["equilibrator_stoichiometries"]
-        .set_index("compound_cc_id")
-        .T
-        .join(
-            S_full.T.reset_index().set_index([c for c in S_full.index])
-            ["reaction_id"], 
-            on=[c for c in S_full.index]
-        )
-        ["reaction_id"]
-    )
-    measurement_to_reaction.index = map(int, measurement_to_reaction.index)
-    S = (
-        S_full
+    if measurement_ids is not None:
+        S_raw = S_raw[[str(i) for i in measurement_ids]]
+    return (
+        S_raw
         .mask(lambda df: df == 0)
-        .rename_axis("reaction_id", axis=1)
+        .rename_axis("measurement_id", axis=1)
         .stack()
         .rename("stoichiometric_coefficient")
         .reset_index()
         .assign(
             compound_id=lambda df: df["compound_id"].astype(int),
-            reaction_id=lambda df: df["reaction_id"].astype(int)
-        )
-    )
-    reactions = (
-        raw_data["equilibrator_reactions"]
-        .rename(columns={"Unnamed: 0": "measurement_id"})
-        .join(
-            raw_data["equilibrator_tecr"], 
-            on="measurement_id", rsuffix="_tecr"
+            measurement_id=lambda df: df["measurement_id"].astype(int),
         )
-        .join(measurement_to_reaction, on="measurement_id")
-        .assign(is_e_coli_ccm=lambda df: df["EC"].isin(ccm_ecs))
-        .groupby("reaction_id")
-        .first()
-        .reset_index()
-        [reaction_cols]
     )
-    measurements = (
+
+
+def get_reaction_keys(S_long: pd.DataFrame, col: str) -> pd.Series:
+    """Get a 64-bit key identifying each column's stoichiometry.
+
+    Each non-zero (compound, coefficient) pair is hashed, and a column's key
+    is the sum of its pairs' hashes, wrapping around at 2 ** 64. The key
+    therefore doesn't depend on the order of the entries, and columns with the
+    same non-zero entries get the same key. Different stoichiometries could in
+    principle share a key, but with a 64-bit hash this is vanishingly unlikely
+    for any realistic number of reactions. A column with no entries would get
+    the key 0.
+
+    :param S_long: long-form stoichiometric matrix with columns "compound_id",
+    "stoichiometric_coefficient" and col.
+
+    :param col: name of the column identifying reactions or measurements.
+
+    """
+    entry_hashes = pd.util.hash_pandas_object(
+        S_long[["compound_id", "stoichiometric_coefficient"]].astype(
+            {"compound_id": "int64", "stoichiometric_coefficient": "float64"}
+        ),
+        index=False,
+    ).to_numpy()
+    codes, ids = pd.factorize(S_long[col], sort=True)
+    keys = np.zeros(len(ids), dtype=np.uint64)
+    np.add.at(keys, codes, entry_hashes)
+    return pd.Series(keys, index=pd.Index(ids, name=col), name="key")
+
+
+def get_measurements_equilibrator(
+    raw_data: dict, measurement_to_reaction: pd.Series
+) -> pd.DataFrame:
+    """Get an equilibrator measurements table."""
+    return (
         raw_data["equilibrator_reactions"]
         .rename(
             columns={
@@ -204,17 +205,39 @@ def prepare_data_equilibrator(**raw_data) -> PreparedData:
             on="measurement_id", rsuffix="_tecr"
         )
         .join(measurement_to_reaction, on="measurement_id")
-        [y_cols]
+        [EQUILIBRATOR_Y_COLS]
     )
-    compounds = (
-        raw_data["equilibrator_compounds"]
-        .rename(columns={"cc_id": "compound_id"})
-        .assign(
-            is_e_coli_ccm=lambda df: df["inchi_key"].isin(ccm_inchi_keys),
-            compound_id=lambda df: df["compound_id"].astype(int),
+
+
+def get_reactions_equilibrator(
+    raw_data: dict, measurement_to_reaction: pd.Series
+) -> pd.DataFrame:
+    """Get an equilibrator reactions table."""
+    ccm_ecs = raw_data["e_coli_ccm_reactions"]["ec-code"].unique()
+    return (
+        raw_data["equilibrator_reactions"]
+        .rename(columns={"Unnamed: 0": "measurement_id"})
+        .join(
+            raw_data["equilibrator_tecr"], 
+            on="measurement_id", rsuffix="_tecr"
         )
+        .join(measurement_to_reaction, on="measurement_id")
+        .assign(is_e_coli_ccm=lambda df: df["EC"].isin(ccm_ecs))
+        .groupby("reaction_id")
+        .first()
+        .reset_index()
+        [EQUILIBRATOR_REACTION_COLS]
     )
-    coords = {
+
+
+def get_coords_equilibrator(
+    compounds: pd.DataFrame,
+    G: pd.DataFrame,
+    measurements: pd.DataFrame,
+    reactions: pd.DataFrame,
+) -> util.CoordDict:
+    """Get coordinates for equilibrator prepared data."""
+    return {
         "compound_id": compounds["compound_id"].astype(str).tolist(),
         "group_id": (
             G.set_index(["compound_id", "group_id"])
@@ -227,9 +250,73 @@ def prepare_data_equilibrator(**raw_data) -> PreparedData:
         "measurement_id": measurements["measurement_id"].astype(str).tolist(),
         "reaction_id": reactions["reaction_id"].astype(str).tolist(),
     }
+
+
+def prepare_data_equilibrator(**raw_data) -> PreparedData:
+    ccm_inchi_keys = (
+        raw_data["e_coli_ccm_metabolites"]["inchi_key"].unique()
+    )
+    G = (
+        raw_data["equilibrator_group_decomposition"]
+        .rename(columns={"compound_cc_id": "compound_id"})
+        .mask(lambda df: df == 0)
+        .set_index("compound_id")
+        .rename_axis("group_id", axis=1)
+        .stack()
+        .rename("stoichiometric_coefficient")
+        .reset_index()
+        .assign(
+            group_id=lambda df: df["group_id"].astype("string"),
+            compound_id=lambda df: df["compound_id"].astype(int),
+        )
+    )
+    S_measurements = get_stoichiometries_long(
+        raw_data["equilibrator_stoichiometries"]
+    )
+    measurement_ids = [
+        int(c)
+        for c in raw_data["equilibrator_stoichiometries"].columns
+        if c != "compound_cc_id"
+    ]
+    measurement_keys = (
+        get_reaction_keys(S_measurements, "measurement_id")
+        .reindex(measurement_ids, fill_value=0)
+    )
+    # reactions are numbered in order of their first measurement
+    measurement_to_reaction = pd.Series(
+        pd.factorize(measurement_keys)[0] + 1,
+        index=measurement_keys.index,
+        name="reaction_id",
+    )
+    first_measurements = measurement_to_reaction.loc[
+        lambda s: ~s.duplicated()
+    ]
+    S = (
+        S_measurements
+        .loc[lambda df: df["measurement_id"].isin(first_measurements.index)]
+        .assign(
+            reaction_id=lambda df: df["measurement_id"].map(
+                measurement_to_reaction
+            )
+        )
+        [["compound_id", "reaction_id", "stoichiometric_coefficient"]]
+        .reset_index(drop=True)
+    )
+    reactions = get_reactions_equilibrator(raw_data, measurement_to_reaction)
+    measurements = get_measurements_equilibrator(
+        raw_data, measurement_to_reaction
+    )
+    compounds = (
+        raw_data["equilibrator_compounds"]
+        .rename(columns={"cc_id": "compound_id"})
+        .assign(
+            is_e_coli_ccm=lambda df: df["inchi_key"].isin(ccm_inchi_keys),
+            compound_id=lambda df: df["compound_id"].astype(int),
+        )
+    )
     return PreparedData(
         name="equilibrator",
-        coords=coords,
+        coords=get_coords_equilibrator(compounds, G, measurements, reactions),
         measurements=measurements,
         reactions=reactions,
         S=S,
@@ -238,33 +325,337 @@ def prepare_data_equilibrator(**raw_data) -> PreparedData:
     )
 
 
-def prepare_data():
-    """Run main function."""
-    print("Reading raw data...")
-    raw_data = {
-        k: pd.read_csv(v, index_col=None) for k, v in RAW_DATA_FILES.items()
+def prepare_data_equilibrator_incremental(
+    previous: PreparedData, **raw_data
+) -> PreparedData:
+    """Add any new measurements in the raw data to a previous PreparedData.
+
+    Only the new measurements' stoichiometries are processed. New measurements
+    of an existing reaction are given that reaction's id, and new reactions
+    get ids following on from the previous ones, in the order of their first
+    measurement. If new measurements are appended to the raw data, the result
+    is therefore the same as running prepare_data_equilibrator from scratch.
+
+    This assumes that the raw data other than the measurements, i.e. the
+    compounds, groups and E. coli central carbon metabolism tables, have not
+    changed, and that the previous measurements haven't been edited or
+    removed. prepare_data checks both with can_update_incrementally.
+
+    :param previous: PreparedData from running prepare_data_equilibrator on an
+    earlier version of the raw data.
+
+    """
+    raw_reactions = raw_data["equilibrator_reactions"]
+    is_new = ~raw_reactions["Unnamed: 0"].isin(
+        previous.measurements["measurement_id"]
+    )
+    if not is_new.any():
+        return previous
+    new_ids = raw_reactions.loc[is_new, "Unnamed: 0"].tolist()
+    S_new = get_stoichiometries_long(
+        raw_data["equilibrator_stoichiometries"], new_ids
+    )
+    new_keys = get_reaction_keys(S_new, "measurement_id").reindex(
+        new_ids, fill_value=0
+    )
+    previous_keys = get_reaction_keys(previous.S, "reaction_id")
+    key_to_reaction = dict(zip(previous_keys.values, previous_keys.index))
+    next_reaction_id = int(previous.reactions["reaction_id"].max()) + 1
+    measurement_to_reaction = {}
+    first_measurements = {}
+    for measurement_id, key in new_keys.items():
+        if key not in key_to_reaction.keys():
+            key_to_reaction[key] = next_reaction_id
+            first_measurements[next_reaction_id] = measurement_id
+            next_reaction_id += 1
+        measurement_to_reaction[measurement_id] = key_to_reaction[key]
+    measurement_to_reaction = pd.Series(
+        measurement_to_reaction, name="reaction_id"
+    ).rename_axis("measurement_id")
+    raw_data_new = raw_data | {"equilibrator_reactions": raw_reactions[is_new]}
+    S_added = (
+        S_new
+        .loc[lambda df: df["measurement_id"].isin(first_measurements.values())]
+        .assign(
+            reaction_id=lambda df: df["measurement_id"].map(
+                {m: r for r, m in first_measurements.items()}
+            )
+        )
+        [previous.S.columns]
+    )
+    reactions_added = get_reactions_equilibrator(
+        raw_data_new, measurement_to_reaction
+    ).loc[lambda df: df["reaction_id"].isin(first_measurements.keys())]
+    measurements = pd.concat(
+        [
+            previous.measurements,
+            get_measurements_equilibrator(
+                raw_data_new, measurement_to_reaction
+            ),
+        ],
+        ignore_index=True,
+    )
+    reactions = pd.concat(
+        [previous.reactions, reactions_added], ignore_index=True
+    )
+    return PreparedData(
+        name=previous.name,
+        coords=get_coords_equilibrator(
+            previous.compounds, previous.G, measurements, reactions
+        ),
+        measurements=measurements,
+        reactions=reactions,
+        S=pd.concat([previous.S, S_added], ignore_index=True),
+        G=previous.G,
+        compounds=previous.compounds,
+    )
+
+
+INCREMENTAL_FUNCTIONS = {
+    "prepare_data_equilibrator": prepare_data_equilibrator_incremental
+}
+
+
+def get_file_hash(path: str) -> str:
+    """Get the sha256 hash of a file's contents."""
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def get_fingerprint(dpf: Callable, raw_hashes: Dict[str, str]) -> dict:
+    """Get a fingerprint of a data preparation function's inputs.
+
+    The fingerprint includes a hash of the source code of the function's
+    module, so that changes to the preparation logic are detected as well as
+    changes to the raw data.
+
+    :param dpf: a data preparation function
+
+    :param raw_hashes: map from raw data names to hashes of the raw data files
+
+    """
+    source = inspect.getsource(inspect.getmodule(dpf))
+    return {
+        "function": dpf.__name__,
+        "source_hash": hashlib.sha256(source.encode()).hexdigest(),
+        "raw_data": raw_hashes,
     }
+
+
+def find_previous_fingerprint(
+    function_name: str,
+) -> Tuple[Optional[str], Optional[dict]]:
+    """Find the prepared data directory last written by a function.
+
+    Returns the directory and its fingerprint, or (None, None) if there isn't
+    one.
+    """
+    if not os.path.exists(PREPARED_DIR):
+        return None, None
+    for d in sorted(os.listdir(PREPARED_DIR)):
+        fingerprint_file = pjoin(PREPARED_DIR, d, FINGERPRINT_FILE)
+        if os.path.exists(fingerprint_file):
+            with open(fingerprint_file, "r") as f:
+                fingerprint = json.load(f)
+            if fingerprint.get("function") == function_name:
+                return pjoin(PREPARED_DIR, d), fingerprint
+    return None, None
+
+
+def get_appendable_size(raw_data: dict, name: str) -> int:
+    """Get the number of measurements in an appendable raw table."""
+    if name == "equilibrator_stoichiometries":
+        # one column per measurement, plus the compound ids
+        return raw_data[name].shape[1] - 1
+    return len(raw_data[name])
+
+
+def get_appendable_hash(raw_data: dict, name: str, size: int) -> str:
+    """Get a hash of the first size measurements of an appendable raw table.
+
+    The hash covers the column names and the values, so it changes if any of
+    these measurements are edited, removed or reordered.
+    """
+    df = raw_data[name]
+    if name == "equilibrator_stoichiometries":
+        df = df.iloc[:, : size + 1]
+    else:
+        df = df.iloc[:size]
+    sha = hashlib.sha256(",".join(map(str, df.columns)).encode())
+    sha.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+    return sha.hexdigest()
+
+
+def get_appendable_hashes(raw_data: dict) -> Dict[str, dict]:
+    """Get the size and a hash of each appendable raw table."""
+    out = {}
+    for name in APPENDABLE_RAW_DATA:
+        size = get_appendable_size(raw_data, name)
+        out[name] = {
+            "size": size,
+            "hash": get_appendable_hash(raw_data, name, size),
+        }
+    return out
+
+
+def is_up_to_date(previous: Optional[dict], current: dict) -> bool:
+    """Check if a previous fingerprint has the same inputs as a current one.
+
+    Only the keys of the current fingerprint are compared, so the appendable
+    raw data hashes that are written with prepared data are ignored.
+    """
+    return previous is not None and all(
+        previous.get(k) == v for k, v in current.items()
+    )
+
+
+def can_update_incrementally(
+    previous: dict, current: dict, raw_data: dict
+) -> bool:
+    """Check if raw data has only been appended to since a fingerprint.
+
+    Besides the raw data that isn't appendable being unchanged, the
+    measurements that the previous prepared data came from must be unchanged
+    and in the same order at the start of each appendable raw table.
+    Otherwise edited or deleted measurements would be kept from the previous
+    prepared data.
+
+    :param previous: the fingerprint of the previous prepared data
+
+    :param current: the fingerprint of the current raw data
+
+    :param raw_data: the current raw data
+    """
+    previous_appendable = previous.get("appendable_raw_data", {})
+    return (
+        previous["function"] in INCREMENTAL_FUNCTIONS.keys()
+        and previous["source_hash"] == current["source_hash"]
+        and previous["raw_data"].keys() == current["raw_data"].keys()
+        and all(
+            previous["raw_data"][k] == v
+            for k, v in current["raw_data"].items()
+            if k not in APPENDABLE_RAW_DATA
+        )
+        and all(
+            name in previous_appendable.keys()
+            and get_appendable_size(raw_data, name)
+            >= previous_appendable[name]["size"]
+            and get_appendable_hash(
+                raw_data, name, previous_appendable[name]["size"]
+            )
+            == previous_appendable[name]["hash"]
+            for name in APPENDABLE_RAW_DATA
+        )
+    )
+
+
+def prepare_data(incremental: bool = False):
+    """Run main function.
+
+    Data preparation functions whose inputs have the same fingerprint as when
+    they last wrote their output are skipped.
+
+    :param incremental: if True and new measurements have only been appended
+    to the raw data since a function last ran, only process the new
+    measurements. If any earlier measurements were edited or removed, all
+    the data is prepared again.
+
+    """
+    raw_hashes = {k: get_file_hash(v) for k, v in RAW_DATA_FILES.items()}
+    raw_data = None
     data_preparation_functions_to_run = [prepare_data_equilibrator]
     print("Preparing data...")
     for dpf in data_preparation_functions_to_run:
-        print(f"Running data preparation function {dpf.__name__}...")
-        prepared_data = dpf(**raw_data)
+        fingerprint = get_fingerprint(dpf, raw_hashes)
+        previous_dir, previous_fingerprint = find_previous_fingerprint(
+            dpf.__name__
+        )
+        if is_up_to_date(previous_fingerprint, fingerprint):
+            print(f"Prepared data in {previous_dir} is up to date, skipping "
+                  f"data preparation function {dpf.__name__}.")
+            continue
+        if raw_data is None:
+            print("Reading raw data...")
+            raw_data = {
+                k: pd.read_csv(v, index_col=None)
+                for k, v in RAW_DATA_FILES.items()
+            }
+        if (
+            incremental
+            and previous_fingerprint is not None
+            and can_update_incrementally(
+                previous_fingerprint, fingerprint, raw_data
+            )
+        ):
+            print(f"Updating {previous_dir} with new measurements...")
+            # don't memory-map files that are about to be overwritten
+            previous = load_prepared_data(previous_dir, memory_map=False)
+            prepared_data = INCREMENTAL_FUNCTIONS[dpf.__name__](
+                previous, **raw_data
+            )
+        else:
+            print(f"Running data preparation function {dpf.__name__}...")
+            prepared_data = dpf(**raw_data)
         output_dir = os.path.join(PREPARED_DIR, prepared_data.name)
         print(f"\twriting files to {output_dir}")
         if not os.path.exists(PREPARED_DIR):
             os.mkdir(PREPARED_DIR)
+        fingerprint_file = os.path.join(output_dir, FINGERPRINT_FILE)
+        if os.path.exists(fingerprint_file):
+            os.remove(fingerprint_file)
         write_prepared_data(prepared_data, output_dir)
+        with open(fingerprint_file, "w") as f:
+            json.dump(
+                fingerprint
+                | {"appendable_raw_data": get_appendable_hashes(raw_data)},
+                f,
+                indent=2,
+            )
+
+
+def read_prepared_table(
+    directory: str, table: str, memory_map: bool = True
+) -> pd.DataFrame:
+    """Read one of a PreparedData's tables from a file in directory.
+
+    Arrow IPC files are preferred, falling back to csv if there is no arrow
+    file.
+
+    :param directory: a prepared data directory
+
+    :param table: name of the table, e.g. "measurements"
+
+    :param memory_map: whether to memory-map arrow files. Numeric columns
+    without missing values are then loaded without copying.
+
+    """
+    arrow_file = os.path.join(directory, table + ".arrow")
+    if os.path.exists(arrow_file):
+        arrow_table = feather.read_table(arrow_file, memory_map=memory_map)
+        return arrow_table.to_pandas(split_blocks=memory_map)
+    return pd.read_csv(os.path.join(directory, table + ".csv"))
+
 
+def load_prepared_data(
+    directory: str, memory_map: bool = True
+) -> PreparedData:
+    """Load prepared data from files in directory.
 
-def load_prepared_data(directory: str) -> PreparedData:
-    """Load prepared data from files in directory."""
+    :param directory: a prepared data directory
+
+    :param memory_map: whether to memory-map any arrow files
+
+    """
     with open(os.path.join(directory, "coords.json"), "r") as f:
         coords = json.load(f)
     with open(os.path.join(directory, "name.txt"), "r") as f:
         name = f.read()
     dfs = {
-        "".join(f.split(".")[:-1]): pd.read_csv(os.path.join(directory, f))
-        for f in PREPARED_FILES if f.endswith(".csv")
+        table: read_prepared_table(directory, table, memory_map=memory_map)
+        for table in PREPARED_TABLES
     }
     return PreparedData(
         name=name,
@@ -277,17 +668,39 @@ def load_prepared_data(directory: str) -> PreparedData:
     )
 
 
-def write_prepared_data(prepped: PreparedData, directory):
-    """Write prepared data files to a directory."""
+def write_prepared_data(
+    prepped: PreparedData, directory, file_format: str = "arrow"
+):
+    """Write prepared data files to a directory.
+
+    :param prepped: a PreparedData object
+
+    :param directory: where to write the files
+
+    :param file_format: one of PREPARED_FILE_FORMATS. "arrow" writes
+    uncompressed Arrow IPC files, which keep their column types and can be
+    memory-mapped; "csv" is for exporting the tables as text. Any files of the
+    other format are removed so that they can't be loaded by mistake.
+
+    """
+    if file_format not in PREPARED_FILE_FORMATS:
+        raise ValueError(
+            f"file_format {file_format} not in {PREPARED_FILE_FORMATS}"
+        )
     if not os.path.exists(directory):
         os.mkdir(directory)
     with open(os.path.join(directory, "coords.json"), "w") as f:
         json.dump(prepped.coords, f)
     with open(os.path.join(directory, "name.txt"), "w") as f:
         f.write(prepped.name)
-    for attr in ["measurements", "S", "G", "compounds", "reactions"]:
-        getattr(prepped, attr).to_csv(
-            os.path.join(directory, attr + ".csv"), index=False
-        )
-
-
+    for attr in PREPARED_TABLES:
+        df = getattr(prepped, attr).reset_index(drop=True)
+        path = os.path.join(directory, f"{attr}.{file_format}")
+        if file_format == "arrow":
+            feather.write_feather(df, path, compression="uncompressed")
+        else:
+            df.to_csv(path, index=False)
+        for other_format in PREPARED_FILE_FORMATS:
+            other_path = os.path.join(directory, f"{attr}.{other_format}")
+            if other_format != file_format and os.path.exists(other_path):
+                os.remove(other_path)
@@ -1,14 +1,62 @@
-"""A general definition of a fitting mode, plus some mode instances."""
+"""A general definition of a fitting mode, plus some mode instances.
 
+arviz, xarray, cmdstanpy, scikit-learn and the collapsed posterior are only
+imported by the fit functions that use them, so that looking up modes, e.g. to
+validate a configuration, is quick.
+
+"""
+
+from __future__ import annotations
+
+import inspect
+import os
+import tempfile
 import textwrap
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
-from typing import Callable, Dict, Union
+from functools import lru_cache
+from typing import TYPE_CHECKING, Any, Callable, Dict
 
 import numpy as np
-import xarray as xr
-from cmdstanpy import CmdStanMCMC, CmdStanModel
 from pydantic import BaseModel
-from sklearn.model_selection import KFold
+from dgfreg.profiling import JobProfiler, Profiler
+from dgfreg.util import get_stan_input_file
+
+if TYPE_CHECKING:
+    import xarray as xr
+    from cmdstanpy import CmdStanMCMC, CmdStanModel
+    from dgfreg.collapsed import CollapsedFit
+
+KFOLD_OPTIONS = ["n_folds", "n_workers", "warm_start", "warm_start_warmup"]
+LOO_OPTIONS = ["pareto_k_threshold", "n_workers"]
+# reactions with a higher Pareto k than this are refitted in loo mode
+DEFAULT_PARETO_K_THRESHOLD = 0.7
+# burn-in iterations for warm-started folds, without adaptation
+DEFAULT_WARM_START_WARMUP = 100
+# generated quantities that models can be told not to output
+OPTIONAL_GENERATED_QUANTITIES = ["dgfC", "dgr", "yrep"]
+GENERATED_QUANTITIES = ["llik", "mae"] + OPTIONAL_GENERATED_QUANTITIES
+# options for the fit functions themselves, which cmdstanpy mustn't see
+FIT_OPTIONS = ["generated_quantities", "profiler", "stan_input_dir"]
+# map from approximation names to the CmdStanModel methods that run them
+APPROXIMATIONS = {
+    "pathfinder": "pathfinder",
+    "laplace": "laplace_sample",
+    "variational": "variational",
+}
+DEFAULT_KFOLD_APPROXIMATION = "pathfinder"
+COLLAPSED_MODES = ["collapsed", "kfold_collapsed"]
+# the models that the collapsed modes compute the posterior of
+COLLAPSED_STAN_FILES = [
+    "new.stan",
+    "new_qr.stan",
+    "new_sparse.stan",
+    "new_sparse_qr.stan",
+    "new_threaded.stan",
+]
+# defaults for the collapsed modes, matching CmdStanModel.sample
+DEFAULT_COLLAPSED_CHAINS = 4
+DEFAULT_COLLAPSED_DRAWS = 1000
 
 
 class IdataTarget(str, Enum):
@@ -40,11 +88,121 @@ class FittingMode(BaseModel):
     FittingMode class. This can also be changed, but must agree with the
     'sample' module.
 
+    The modes 'pathfinder', 'laplace' and 'variational' give quick approximate
+    posteriors, and 'kfold_approximate' does k-fold cross-validation with one
+    of these approximations for each fold. They are useful for screening
+    models before running the NUTS modes.
+
+    The 'loo' mode estimates leave-one-out log likelihoods from one posterior
+    fit, only refitting the model for reactions where importance sampling is
+    unreliable.
+
+    The modes 'collapsed' and 'kfold_collapsed' don't run Stan. They compute
+    the posterior of new.stan, whose linear parameters they integrate out
+    exactly, leaving only tauC and sigma to explore: see dgfreg.collapsed.
+    They can only be used with the models in COLLAPSED_STAN_FILES.
+
 
     """
     name: str
     idata_target: IdataTarget
-    fit: Callable[[CmdStanModel, Dict, Dict[str, str]], Union[CmdStanMCMC, xr.Dataset]]
+    # fit(model: CmdStanModel, input_dict: dict, kwargs: dict) returns a
+    # CmdStanMCMC, ApproximateFit, CollapsedFit or xr.DataArray
+    fit: Callable[[Any, Dict, Dict[str, Any]], Any]
+
+
+class ApproximateFit:
+    """Draws from an approximate posterior, presented like a CmdStanMCMC.
+
+    CmdStanPathfinder, CmdStanLaplace and CmdStanVB objects don't have chains
+    or warmup, so arviz.from_cmdstanpy can't read them directly. This class
+    makes their draws look like the output of a single chain with no saved
+    warmup.
+
+    :param fit: a CmdStanPathfinder, CmdStanLaplace or CmdStanVB
+    """
+
+    chains = 1
+    num_draws_warmup = 0
+    _save_warmup = False
+
+    def __init__(self, fit):
+        """Initialise an ApproximateFit."""
+        from cmdstanpy import CmdStanVB
+
+        self.fit = fit
+        if isinstance(fit, CmdStanVB):
+            self.draws = fit.variational_sample
+        else:
+            self.draws = fit.draws()
+
+    @property
+    def metadata(self):
+        """Get the wrapped fit's metadata."""
+        return self.fit.metadata
+
+    def stan_variable(self, var: str, inc_warmup: bool = False) -> np.ndarray:
+        """Get the draws of a Stan variable, with draws as the first axis."""
+        return self.metadata.stan_vars[var].extract_reshape(self.draws)
+
+    def method_variables(self) -> Dict[str, np.ndarray]:
+        """Get the draws of the method variables, with shape (draws, 1)."""
+        return {
+            name: var.extract_reshape(self.draws).reshape(-1, 1)
+            for name, var in self.metadata.method_vars.items()
+        }
+
+    def draws_xr(self, vars) -> xr.Dataset:
+        """Get draws of some Stan variables, like CmdStanMCMC.draws_xr."""
+        import xarray as xr
+
+        data_vars = {}
+        for var in vars:
+            draws = self.stan_variable(var)[np.newaxis]
+            dims = ["chain", "draw"] + [
+                f"{var}_dim_{i}" for i in range(draws.ndim - 2)
+            ]
+            data_vars[var] = (dims, draws)
+        return xr.Dataset(
+            data_vars,
+            coords={"chain": [1], "draw": np.arange(len(self.draws))},
+        )
+
+
+def get_output_flags(kwargs: dict) -> Dict[str, int]:
+    """Get Stan data flags saying which generated quantities to output.
+
+    :param kwargs: fitting options, optionally including a list
+    'generated_quantities'. If there is no such list, all generated quantities
+    are output. 'llik' and 'mae' are always output.
+
+    """
+    to_output = kwargs.get("generated_quantities", GENERATED_QUANTITIES)
+    return {
+        f"output_{gq}": int(gq in to_output)
+        for gq in OPTIONAL_GENERATED_QUANTITIES
+    }
+
+
+def get_sample_kwargs(kwargs: dict, other_options=()) -> dict:
+    """Get the keyword arguments for CmdStanModel.sample from some options."""
+    return {
+        k: v for k, v in kwargs.items()
+        if k not in FIT_OPTIONS and k not in other_options
+    }
+
+
+def get_method_kwargs(method: Callable, kwargs: dict) -> dict:
+    """Get the options that a CmdStanModel method accepts.
+
+    Approximate fitting modes share the inference's sample_kwargs with the
+    NUTS modes, so options that only make sense for sampling are dropped.
+    """
+    parameters = inspect.signature(method).parameters
+    return {
+        k: v for k, v in kwargs.items()
+        if k in parameters.keys() and k != "data"
+    }
 
 
 def fit_prior(model: CmdStanModel, input_dict: dict, kwargs) -> CmdStanMCMC:
@@ -58,11 +216,15 @@ def fit_prior(model: CmdStanModel, input_dict: dict, kwargs) -> CmdStanMCMC:
     :param input_dict: a Stan input dictionary. It doesn't need to have a
     'likelihood' entry: if it does, it will be overwritten.
 
-    :param kwargs: keyword arguments for CmdStanModel.sample
+    :param kwargs: keyword arguments for CmdStanModel.sample, optionally plus
+    a list 'generated_quantities'.
 
     """
-    input_dict_final = input_dict | {"likelihood": 0}
-    return model.sample(input_dict_final, **kwargs)
+    output_flags = get_output_flags(kwargs)
+    input_dict_final = input_dict | output_flags | {"likelihood": 0}
+    return model.sample(
+        write_stan_input(input_dict_final, kwargs), **get_sample_kwargs(kwargs)
+    )
 
 
 def fit_posterior(model: CmdStanModel, input_dict: dict, kwargs) -> CmdStanMCMC:
@@ -75,26 +237,64 @@ def fit_posterior(model: CmdStanModel, input_dict: dict, kwargs) -> CmdStanMCMC:
     :param input_dict: a Stan input dictionary. It doesn't need to have a
     'likelihood' entry: if it does, it will be overwritten.
 
-    :param kwargs: keyword arguments for CmdStanModel.sample
+    :param kwargs: keyword arguments for CmdStanModel.sample, optionally plus
+    a list 'generated_quantities'.
     """
-    input_dict_final = input_dict | {"likelihood": 1}
-    return model.sample(input_dict_final, **kwargs)
+    output_flags = get_output_flags(kwargs)
+    input_dict_final = input_dict | output_flags | {"likelihood": 1}
+    return model.sample(
+        write_stan_input(input_dict_final, kwargs), **get_sample_kwargs(kwargs)
+    )
 
 
-def fit_kfold(model: CmdStanModel, input_dict :dict, kwargs) -> xr.DataArray:
-    """Do k-fold cross validation, given a CmdStanModel, some data and config.
+def get_fold_parallel_chains(n_workers: int, sample_kwargs: dict) -> int:
+    """Get how many chains each fold should run at once.
 
-    :param model: a CmdStanModel. It must have a data variables called
-    'likelihood', 'N_train', 'N_test', 'ix_train' and 'ix_test'.
+    The available cpus are shared out evenly between the folds that run at the
+    same time, taking into account any within-chain threads.
 
-    :param input_dict: a Stan input dictionary. It doesn't need to have any of
-    the required variables set (they will be overwritten if they are set).
+    :param n_workers: how many folds run at the same time
 
-    :param kwargs: dictionary with an entry for 'n_folds' that specifies the
-    value of k for k-fold cross-validation, plus keyword arguments for
-    CmdStanModel.sample
+    :param sample_kwargs: keyword arguments for CmdStanModel.sample
+    """
+    n_cpus = os.cpu_count() or 1
+    threads_per_chain = int(sample_kwargs.get("threads_per_chain", 1))
+    return max(1, n_cpus // (n_workers * threads_per_chain))
+
+
+def get_warm_start_kwargs(mcmc: CmdStanMCMC, iter_warmup: int) -> dict:
+    """Get keyword arguments for starting a fit where an earlier one ended.
 
+    Each chain starts from the earlier chain's final draw, with its step size
+    and inverse metric. Adaptation is switched off, so any warmup iterations
+    are only burn-in.
+
+    :param mcmc: the earlier fit
+
+    :param iter_warmup: how many burn-in iterations to run
     """
+    draws = mcmc.draws(concat_chains=False)
+    inits = [
+        {
+            name: var.extract_reshape(draws[-1, chain])
+            for name, var in mcmc.metadata.stan_vars.items()
+        }
+        for chain in range(mcmc.chains)
+    ]
+    out = {
+        "inits": inits,
+        "step_size": mcmc.step_size.tolist(),
+        "iter_warmup": iter_warmup,
+        "adapt_engaged": False,
+    }
+    if mcmc.inv_metric is not None:
+        out["metric"] = mcmc.metric_type
+        out["inv_metric"] = list(mcmc.inv_metric)
+    return out
+
+
+def get_n_folds(kwargs: dict) -> int:
+    """Get the number of folds from some kfold options."""
     if "n_folds" not in kwargs.keys():
         msg = textwrap.dedent(
             """
@@ -105,34 +305,441 @@ def fit_kfold(model: CmdStanModel, input_dict :dict, kwargs) -> xr.DataArray:
             """
         )
         raise ValueError(msg)
+    return int(kwargs["n_folds"])
+
+
+def get_profiler(kwargs: dict) -> JobProfiler:
+    """Get the JobProfiler in some fitting options, or a throwaway one.
+
+    sample.main gives each job a JobProfiler as the option 'profiler', so
+    that fit functions can time their own stages.
+    """
+    profiler = kwargs.get("profiler")
+    return profiler if profiler is not None else JobProfiler(Profiler())
+
+
+@lru_cache(maxsize=None)
+def get_default_stan_input_dir() -> tempfile.TemporaryDirectory:
+    """Get a temporary directory for Stan inputs, removed when Python exits."""
+    return tempfile.TemporaryDirectory(prefix="dgfreg-stan-input-")
+
+
+def write_stan_input(input_dict: dict, kwargs: dict) -> str:
+    """Get a json file with a Stan input, in this run's input directory.
+
+    sample.main gives each job the option 'stan_input_dir', a temporary
+    directory that it removes when the run is finished. Without this option,
+    the file goes in a temporary directory that is removed when Python exits.
+    Fits with the same input share a file either way.
+    """
+    directory = kwargs.get("stan_input_dir")
+    if directory is None:
+        directory = get_default_stan_input_dir().name
+    return get_stan_input_file(input_dict, directory)
+
+
+def get_llik(fit) -> xr.DataArray:
+    """Get a fit's llik draws, with chains numbered from zero like arviz.
+
+    The draws of a CmdStanMCMC are read from its csv files a chunk at a time,
+    skipping warmup and all other variables.
+    """
+    from cmdstanpy import CmdStanMCMC
+    from dgfreg.stan_csv import read_stan_csv_variables
+
+    if isinstance(fit, CmdStanMCMC):
+        llik = read_stan_csv_variables(fit.runset.csv_files, ["llik"])["llik"]
     else:
-        n_folds = int(kwargs["n_folds"])
-    sample_kwargs = {k: v for k, v in kwargs.items() if k != "n_folds"}
-    kf = KFold(n_folds, shuffle=True, random_state=1234)
-    lliks_by_fold = []
+        llik = fit.draws_xr(vars=["llik"])["llik"]
+    return llik.assign_coords(
+        {"new_chain": ("chain", np.arange(llik.sizes["chain"]))}
+    ).set_index(chain="new_chain")
+
+
+def get_kfold_lliks(
+    fit_data: Callable,
+    input_dict: dict,
+    kwargs: dict,
+    fit_kwargs: dict,
+    splits=None,
+    write_input: bool = True,
+) -> xr.DataArray:
+    """Get out-of-sample log likelihoods by fitting each fold.
+
+    :param fit_data: a function that takes a Stan input file plus the keyword
+    arguments fit_kwargs and returns something with a 'draws_xr' method, e.g.
+    CmdStanModel.sample
+
+    :param input_dict: a Stan input dictionary
+
+    :param kwargs: kfold options, i.e. 'n_folds', optionally 'n_workers',
+    optionally a list 'generated_quantities' and optionally a 'profiler' that
+    times each fold's fit and log likelihood reading
+
+    :param fit_kwargs: keyword arguments for fit_data
+
+    :param splits: optional list of (train, test) pairs of positions in
+    input_dict["ix_train"]. If not given, these are chosen at random from
+    'n_folds' folds.
+
+    :param write_input: whether to give fit_data the path to a Stan input file
+    rather than the Stan input dictionary itself
+    """
+    import xarray as xr
+    from sklearn.model_selection import KFold
+
     full_ix = np.array(input_dict["ix_train"])
-    for fold, (ix_train, ix_test) in enumerate(kf.split(full_ix)):
-        input_dict_fold = input_dict | {
+    if splits is None:
+        kf = KFold(get_n_folds(kwargs), shuffle=True, random_state=1234)
+        splits = list(kf.split(full_ix))
+    n_workers = min(int(kwargs.get("n_workers", 1)), len(splits))
+    profiler = get_profiler(kwargs)
+
+    def fit_fold(fold: int, ix_train, ix_test) -> xr.DataArray:
+        input_dict_fold = input_dict | get_output_flags(kwargs) | {
             "likelihood": 1,
             "N_train": len(ix_train),
             "N_test": len(ix_test),
             "ix_train": full_ix[ix_train].tolist(),
             "ix_test": full_ix[ix_test].tolist(),
         }
-        mcmc = model.sample(data=input_dict_fold, **sample_kwargs)
-        llik_fold = mcmc.draws_xr(vars=["llik"])
-        # remember the fold
-        llik_fold["fold"] = fold
-        llik_fold = llik_fold.set_coords("fold")
-        # set value of index "chain" to zero to match arviz convention
-        llik_fold = llik_fold.assign_coords(
-            {"new_chain": ("chain", [0])}
-        ).set_index(chain="new_chain")
-        lliks_by_fold.append(llik_fold["llik"])
+        fold_kwargs = fit_kwargs
+        if "output_dir" in fit_kwargs.keys():
+            # concurrent folds must not share output files
+            fold_kwargs = fit_kwargs | {
+                "output_dir": os.path.join(
+                    fit_kwargs["output_dir"], f"fold_{fold}"
+                )
+            }
+        data = (
+            write_stan_input(input_dict_fold, kwargs)
+            if write_input
+            else input_dict_fold
+        )
+        with profiler.stage("fit", fold=fold):
+            fit = fit_data(data=data, **fold_kwargs)
+        profiler.record_fit(fit, fold=fold)
+        with profiler.stage("read_llik", fold=fold):
+            # remember the fold
+            return get_llik(fit).assign_coords(fold=fold)
+
+    if n_workers > 1:
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            lliks_by_fold = list(
+                executor.map(fit_fold, range(len(splits)), *zip(*splits))
+            )
+    else:
+        lliks_by_fold = [
+            fit_fold(fold, ix_train, ix_test)
+            for fold, (ix_train, ix_test) in enumerate(splits)
+        ]
     return xr.concat(lliks_by_fold, dim="llik_dim_0").sortby("llik_dim_0")
 
+
+def fit_kfold(model: CmdStanModel, input_dict :dict, kwargs) -> xr.DataArray:
+    """Do k-fold cross validation, given a CmdStanModel, some data and config.
+
+    Folds are fitted concurrently if the option 'n_workers' is greater than
+    one. Each fold's chains already run in their own cmdstan processes, so a
+    pool of threads is enough to keep n_workers folds running at the same
+    time. Unless 'parallel_chains' is set explicitly, the available cpus are
+    shared between the concurrent folds.
+
+    :param model: a CmdStanModel. It must have a data variables called
+    'likelihood', 'N_train', 'N_test', 'ix_train' and 'ix_test'.
+
+    :param input_dict: a Stan input dictionary. It doesn't need to have any of
+    the required variables set (they will be overwritten if they are set).
+
+    If the option 'warm_start' is true, the model is first fitted to all the
+    training data. Each fold then starts from this fit's final draws, step
+    sizes and inverse metrics, with 'warm_start_warmup' burn-in iterations
+    and no adaptation. As the folds' posteriors are close to the full-data
+    posterior, this is much quicker than fitting each fold from scratch.
+
+    :param kwargs: dictionary with an entry for 'n_folds' that specifies the
+    value of k for k-fold cross-validation, optionally an entry for
+    'n_workers' that specifies how many folds to run at the same time,
+    optionally entries 'warm_start' and 'warm_start_warmup', optionally a list
+    'generated_quantities', plus keyword arguments for CmdStanModel.sample.
+    Only llik is used, so setting generated_quantities to ["llik"] makes the
+    fits' output much smaller.
+
+    """
+    n_folds = get_n_folds(kwargs)
+    n_workers = min(int(kwargs.get("n_workers", 1)), n_folds)
+    sample_kwargs = get_sample_kwargs(kwargs, KFOLD_OPTIONS)
+    if kwargs.get("warm_start", False):
+        full_kwargs = sample_kwargs
+        if "output_dir" in sample_kwargs.keys():
+            full_kwargs = sample_kwargs | {
+                "output_dir": os.path.join(sample_kwargs["output_dir"], "full")
+            }
+        no_output = get_output_flags({"generated_quantities": []})
+        profiler = get_profiler(kwargs)
+        with profiler.stage("warm_start"):
+            full = model.sample(
+                data=write_stan_input(
+                    input_dict | no_output | {"likelihood": 1}, kwargs
+                ),
+                **full_kwargs,
+            )
+        profiler.record_fit(full)
+        iter_warmup = int(
+            kwargs.get("warm_start_warmup", DEFAULT_WARM_START_WARMUP)
+        )
+        sample_kwargs |= get_warm_start_kwargs(full, iter_warmup)
+    if n_workers > 1 and "parallel_chains" not in sample_kwargs.keys():
+        sample_kwargs["parallel_chains"] = get_fold_parallel_chains(
+            n_workers, sample_kwargs
+        )
+    return get_kfold_lliks(model.sample, input_dict, kwargs, sample_kwargs)
+
+
+def fit_approximate(
+    approximation: str, model: CmdStanModel, input_dict: dict, kwargs
+) -> ApproximateFit:
+    """Fit a model with an approximate method, in posterior mode.
+
+    :param approximation: one of the keys of APPROXIMATIONS
+
+    :param model: a CmdStanModel with a data variable called 'likelihood'
+
+    :param input_dict: a Stan input dictionary
+
+    :param kwargs: fitting options, optionally including a list
+    'generated_quantities'. Options that the approximate method doesn't accept,
+    e.g. 'iter_warmup', are ignored.
+    """
+    method = getattr(model, APPROXIMATIONS[approximation])
+    input_dict_final = input_dict | get_output_flags(kwargs) | {"likelihood": 1}
+    return ApproximateFit(
+        method(
+            data=write_stan_input(input_dict_final, kwargs),
+            **get_method_kwargs(method, kwargs),
+        )
+    )
+
+
+def fit_pathfinder(model: CmdStanModel, input_dict: dict, kwargs):
+    """Fit a model with Pathfinder, in posterior mode."""
+    return fit_approximate("pathfinder", model, input_dict, kwargs)
+
+
+def fit_laplace(model: CmdStanModel, input_dict: dict, kwargs):
+    """Fit a model with a Laplace approximation, in posterior mode."""
+    return fit_approximate("laplace", model, input_dict, kwargs)
+
+
+def fit_variational(model: CmdStanModel, input_dict: dict, kwargs):
+    """Fit a model with ADVI, in posterior mode."""
+    return fit_approximate("variational", model, input_dict, kwargs)
+
+
+def fit_kfold_approximate(
+    model: CmdStanModel, input_dict: dict, kwargs
+) -> xr.DataArray:
+    """Do k-fold cross validation, fitting each fold approximately.
+
+    :param model: a CmdStanModel, with the same requirements as for fit_kfold
+
+    :param input_dict: a Stan input dictionary
+
+    :param kwargs: the same options as for fit_kfold, optionally plus an
+    entry 'approximation' choosing one of the keys of APPROXIMATIONS (the
+    default is pathfinder). Options that the approximate method doesn't
+    accept are ignored.
+    """
+    approximation = kwargs.get("approximation", DEFAULT_KFOLD_APPROXIMATION)
+    method = getattr(model, APPROXIMATIONS[approximation])
+
+    def fit_data(data: str, **method_kwargs) -> ApproximateFit:
+        return ApproximateFit(method(data=data, **method_kwargs))
+
+    return get_kfold_lliks(
+        fit_data, input_dict, kwargs, get_method_kwargs(method, kwargs)
+    )
+
+
+def fit_loo(model: CmdStanModel, input_dict: dict, kwargs) -> xr.DataArray:
+    """Do PSIS leave-one-out cross validation, with refits where needed.
+
+    The model is fitted once with every training reaction in ix_test, and the
+    resulting llik draws are Pareto-smoothed to get importance weights for
+    leaving out each reaction. Reactions whose Pareto k is above the option
+    'pareto_k_threshold' are left out and refitted exactly, using
+    ix_train and ix_test as in kfold mode.
+
+    The output has the same meaning as the output of fit_kfold: for each
+    reaction, draws of its log likelihood given a posterior that didn't see
+    it. For the importance-sampled reactions these are the full posterior's
+    draws resampled with the smoothed weights. The coordinates 'pareto_k' and
+    'refit' record how each reaction was handled.
+
+    :param model: a CmdStanModel, with the same requirements as for fit_kfold
+
+    :param input_dict: a Stan input dictionary
+
+    :param kwargs: optionally 'pareto_k_threshold', optionally 'n_workers'
+    (how many refits to run at the same time), optionally a list
+    'generated_quantities', plus keyword arguments for CmdStanModel.sample.
+    The refits need the same number of chains and draws as the full fit.
+    """
+    import arviz as az
+    import xarray as xr
+
+    threshold = float(
+        kwargs.get("pareto_k_threshold", DEFAULT_PARETO_K_THRESHOLD)
+    )
+    sample_kwargs = get_sample_kwargs(kwargs, LOO_OPTIONS)
+    full_ix = np.array(input_dict["ix_train"])
+    input_dict_full = input_dict | get_output_flags(kwargs) | {
+        "likelihood": 1,
+        "N_train": len(full_ix),
+        "N_test": len(full_ix),
+        "ix_train": full_ix.tolist(),
+        "ix_test": full_ix.tolist(),
+    }
+    full_kwargs = sample_kwargs
+    if "output_dir" in sample_kwargs.keys():
+        full_kwargs = sample_kwargs | {
+            "output_dir": os.path.join(sample_kwargs["output_dir"], "full")
+        }
+    profiler = get_profiler(kwargs)
+    with profiler.stage("loo_full"):
+        full = model.sample(
+            data=write_stan_input(input_dict_full, kwargs), **full_kwargs
+        )
+    profiler.record_fit(full)
+    llik = get_llik(full)
+    n_chains, n_draws, n_obs = llik.shape
+    llik_flat = llik.values.reshape(n_chains * n_draws, n_obs)
+    log_weights, pareto_k = az.psislw(-llik_flat.T)
+    rng = np.random.default_rng(1234)
+    llik_loo = np.empty_like(llik_flat)
+    for i in range(n_obs):
+        weights = np.exp(log_weights[i])
+        ix = rng.choice(len(llik_flat), size=len(llik_flat), p=weights)
+        llik_loo[:, i] = llik_flat[ix, i]
+    refit = pareto_k > threshold
+    if refit.any():
+        all_positions = np.arange(n_obs)
+        splits = [
+            (np.delete(all_positions, i), np.array([i]))
+            for i in np.flatnonzero(refit)
+        ]
+        llik_refits = get_kfold_lliks(
+            model.sample, input_dict, kwargs, sample_kwargs, splits=splits
+        )
+        llik_loo[:, refit] = llik_refits.values.reshape(-1, len(splits))
+    return xr.DataArray(
+        llik_loo.reshape(n_chains, n_draws, n_obs),
+        dims=llik.dims,
+        coords={
+            "chain": llik.coords["chain"],
+            "draw": llik.coords["draw"],
+            "pareto_k": ("llik_dim_0", pareto_k),
+            "refit": ("llik_dim_0", refit),
+        },
+        name="llik",
+    )
+
+
+def fit_collapsed_data(data: dict, **kwargs) -> CollapsedFit:
+    """Fit new.stan to a Stan input dictionary with the collapsed posterior.
+
+    :param data: a Stan input dictionary for new.stan, including the output
+    flags
+
+    :param kwargs: optionally 'chains', 'iter_sampling', 'seed', 'n_grid' and
+    'grid_width'. Other options are ignored.
+    """
+    from dgfreg.collapsed import (
+        DEFAULT_GRID_WIDTH,
+        DEFAULT_N_GRID,
+        CollapsedFit,
+        get_collapsed_model,
+        sample_collapsed,
+    )
+
+    chains = int(kwargs.get("chains", DEFAULT_COLLAPSED_CHAINS))
+    iter_sampling = int(kwargs.get("iter_sampling", DEFAULT_COLLAPSED_DRAWS))
+    draws = sample_collapsed(
+        get_collapsed_model(data),
+        chains * iter_sampling,
+        {k: data[k] for k in get_output_flags({}).keys()},
+        seed=kwargs.get("seed"),
+        n_grid=int(kwargs.get("n_grid", DEFAULT_N_GRID)),
+        grid_width=float(kwargs.get("grid_width", DEFAULT_GRID_WIDTH)),
+    )
+    return CollapsedFit(draws, chains)
+
+
+def fit_collapsed(
+    model: CmdStanModel, input_dict: dict, kwargs
+) -> CollapsedFit:
+    """Fit new.stan in posterior mode without running Stan.
+
+    The model isn't used, but the output has the same variables as a fit of
+    new.stan, so it can stand in for a posterior mode fit.
+
+    :param model: a CmdStanModel, which is ignored
+
+    :param input_dict: a Stan input dictionary for new.stan
+
+    :param kwargs: fitting options, optionally including a list
+    'generated_quantities', 'chains', 'iter_sampling', 'seed', 'n_grid' and
+    'grid_width'. Other options, e.g. 'iter_warmup', are ignored.
+    """
+    input_dict_final = input_dict | get_output_flags(kwargs) | {"likelihood": 1}
+    return fit_collapsed_data(input_dict_final, **kwargs)
+
+
+def fit_kfold_collapsed(
+    model: CmdStanModel, input_dict: dict, kwargs
+) -> xr.DataArray:
+    """Do k-fold cross validation with the collapsed posterior.
+
+    The folds are the same as in fit_kfold.
+
+    :param model: a CmdStanModel, which is ignored
+
+    :param input_dict: a Stan input dictionary for new.stan
+
+    :param kwargs: the same options as for fit_collapsed, plus 'n_folds' and
+    optionally 'n_workers'
+    """
+    fit_kwargs = get_sample_kwargs(kwargs, KFOLD_OPTIONS)
+    return get_kfold_lliks(
+        fit_collapsed_data, input_dict, kwargs, fit_kwargs, write_input=False
+    )
+
+
 prior_mode = FittingMode(name="prior", idata_target="prior", fit=fit_prior)
 posterior_mode = FittingMode(
     name="posterior", idata_target="posterior", fit=fit_posterior
 )
 kfold_mode = FittingMode(name="kfold", idata_target="log_likelihood", fit=fit_kfold)
+pathfinder_mode = FittingMode(
+    name="pathfinder", idata_target="posterior", fit=fit_pathfinder
+)
+laplace_mode = FittingMode(
+    name="laplace", idata_target="posterior", fit=fit_laplace
+)
+variational_mode = FittingMode(
+    name="variational", idata_target="posterior", fit=fit_variational
+)
+loo_mode = FittingMode(name="loo", idata_target="log_likelihood", fit=fit_loo)
+kfold_approximate_mode = FittingMode(
+    name="kfold_approximate",
+    idata_target="log_likelihood",
+    fit=fit_kfold_approximate,
+)
+collapsed_mode = FittingMode(
+    name="collapsed", idata_target="posterior", fit=fit_collapsed
+)
+kfold_collapsed_mode = FittingMode(
+    name="kfold_collapsed",
+    idata_target="log_likelihood",
+    fit=fit_kfold_collapsed,
+)
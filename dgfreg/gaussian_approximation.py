@@ -0,0 +1,255 @@
+"""A compact Gaussian approximation of a posterior over formation energies.
+
+The approximation is computed from the draws in one pass, a chunk of draws at a
+time, so lazily loaded InferenceData never need to be read into memory all at
+once. The covariance is stored as a truncated eigendecomposition plus a
+diagonal residual, which is much smaller than a dense covariance matrix because
+the posterior covariance of dgfC is rank-deficient.
+
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Iterable, Optional, Tuple
+
+import numpy as np
+
+if TYPE_CHECKING:
+    import xarray as xr
+
+GAUSSIAN_APPROXIMATION_CHUNK_DRAWS = 100
+# eigenvalues smaller than this times the largest one count as zero
+EIGENVALUE_RTOL = 1e-10
+
+
+@dataclass
+class LowRankPlusDiagonal:
+    """A normal distribution with covariance F F' + L diag(d) L'.
+
+    This is the one representation of low rank Gaussians in dgfreg: Gaussian
+    approximations and the summaries of dgfreg.unobserved both use it, so
+    their moments are computed in the same way.
+
+    :param ids: one id per dimension
+
+    :param mean: the mean vector
+
+    :param factor: the low rank factor F, with one column per component
+
+    :param diag: the variances d of some independent components
+
+    :param diag_loadings: the matrix L, dense or scipy sparse, mapping the
+    independent components to the dimensions. If None, L is the identity.
+    """
+
+    ids: Any
+    mean: np.ndarray
+    factor: np.ndarray
+    diag: np.ndarray
+    diag_loadings: Any = None
+
+    @property
+    def variance(self) -> np.ndarray:
+        """Get the marginal variances."""
+        variance = np.einsum("ij,ij->i", self.factor, self.factor)
+        L = self.diag_loadings
+        if L is None:
+            return variance + self.diag
+        # scipy sparse matrices square elementwise with multiply
+        L_squared = L.multiply(L) if hasattr(L, "multiply") else L**2
+        return variance + np.asarray(L_squared @ self.diag).ravel()
+
+    @property
+    def sd(self) -> np.ndarray:
+        """Get the marginal standard deviations."""
+        return np.sqrt(self.variance)
+
+    def cov(self) -> np.ndarray:
+        """Get the full covariance matrix."""
+        cov = self.factor @ self.factor.T
+        L = self.diag_loadings
+        if L is None:
+            return cov + np.diag(self.diag)
+        if hasattr(L, "multiply"):
+            return cov + (L.multiply(self.diag) @ L.T).toarray()
+        return cov + (L * self.diag) @ L.T
+
+    def linear_map(self, A, ids) -> "LowRankPlusDiagonal":
+        """Get the distribution of A x, which is also low rank plus diagonal.
+
+        :param A: a dense or scipy sparse matrix with one column per
+        dimension, e.g. the transpose of a stoichiometric matrix
+
+        :param ids: one id per row of A
+        """
+        L = self.diag_loadings
+        return type(self)(
+            ids,
+            np.asarray(A @ self.mean).ravel(),
+            np.asarray(A @ self.factor),
+            self.diag,
+            A if L is None else A @ L,
+        )
+
+    def get_linear_moments(self, A) -> Tuple[np.ndarray, np.ndarray]:
+        """Get the means and standard deviations of A x.
+
+        :param A: as for linear_map
+        """
+        mapped = self.linear_map(A, None)
+        return mapped.mean, mapped.sd
+
+
+@dataclass
+class LowRankGaussian:
+    """A normal distribution with covariance U diag(eigenvalues) U' + diag(d).
+
+    :param ids: one id per dimension
+
+    :param mean: the mean vector
+
+    :param eigenvectors: matrix U with one column per kept eigenvector
+
+    :param eigenvalues: the kept eigenvalues, in decreasing order
+
+    :param residual: the diagonal d, i.e. the part of the variances that the
+    kept eigenvectors don't explain
+    """
+
+    ids: np.ndarray
+    mean: np.ndarray
+    eigenvectors: np.ndarray
+    eigenvalues: np.ndarray
+    residual: np.ndarray
+
+    @property
+    def rank(self) -> int:
+        """Get the number of kept eigenvectors."""
+        return len(self.eigenvalues)
+
+    @property
+    def factor(self) -> np.ndarray:
+        """Get a matrix F such that F F' is the low rank part."""
+        return self.eigenvectors * np.sqrt(self.eigenvalues)
+
+    def to_low_rank_plus_diagonal(self) -> LowRankPlusDiagonal:
+        """Get the approximation as a LowRankPlusDiagonal."""
+        return LowRankPlusDiagonal(
+            self.ids, self.mean, self.factor, self.residual
+        )
+
+    def cov(self) -> np.ndarray:
+        """Get the full covariance matrix."""
+        return self.to_low_rank_plus_diagonal().cov()
+
+    def get_linear_moments(self, A) -> Tuple[np.ndarray, np.ndarray]:
+        """Get the means and standard deviations of A x.
+
+        :param A: a matrix with one column per dimension, e.g. the transpose
+        of a stoichiometric matrix
+        """
+        return self.to_low_rank_plus_diagonal().get_linear_moments(A)
+
+    def save(self, path: str):
+        """Save the approximation in numpy's binary npz format."""
+        np.savez_compressed(
+            path,
+            ids=self.ids.astype(str),
+            mean=self.mean,
+            eigenvectors=self.eigenvectors,
+            eigenvalues=self.eigenvalues,
+            residual=self.residual,
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "LowRankGaussian":
+        """Load an approximation saved with LowRankGaussian.save."""
+        with np.load(path, allow_pickle=False) as f:
+            return cls(**{k: f[k] for k in f.files})
+
+
+def get_streaming_moments(
+    chunks: Iterable[np.ndarray],
+) -> Tuple[int, np.ndarray, np.ndarray]:
+    """Get the number of rows, mean and covariance of some chunks of rows.
+
+    Each chunk's moments are merged into the running moments with Chan et
+    al.'s pairwise update, so only one chunk is in memory at a time.
+
+    :param chunks: arrays with one row per draw and the same number of columns
+    """
+    n, mean, m2 = 0, None, None
+    for chunk in chunks:
+        chunk = np.asarray(chunk, dtype=np.float64)
+        n_chunk = len(chunk)
+        if n_chunk == 0:
+            continue
+        mean_chunk = chunk.mean(axis=0)
+        centered = chunk - mean_chunk
+        m2_chunk = centered.T @ centered
+        if mean is None:
+            n, mean, m2 = n_chunk, mean_chunk, m2_chunk
+            continue
+        delta = mean_chunk - mean
+        n_total = n + n_chunk
+        mean = mean + delta * n_chunk / n_total
+        m2 = m2 + m2_chunk + np.outer(delta, delta) * n * n_chunk / n_total
+        n = n_total
+    if mean is None or n < 2:
+        raise ValueError("At least two draws are needed.")
+    return n, mean, m2 / (n - 1)
+
+
+def iter_draw_chunks(
+    draws: xr.DataArray, chunk_draws: int = GAUSSIAN_APPROXIMATION_CHUNK_DRAWS
+) -> Iterable[np.ndarray]:
+    """Iterate over a chain x draw x n DataArray's draws a chunk at a time.
+
+    :param draws: a DataArray with dimensions chain, draw and one other
+    dimension. It can be lazily loaded.
+
+    :param chunk_draws: how many draws per chain to load at once
+    """
+    for start in range(0, draws.sizes["draw"], chunk_draws):
+        chunk = draws.isel(draw=slice(start, start + chunk_draws)).values
+        yield chunk.reshape(-1, chunk.shape[-1])
+
+
+def get_low_rank_gaussian(
+    draws: xr.DataArray,
+    rank: Optional[int] = None,
+    chunk_draws: int = GAUSSIAN_APPROXIMATION_CHUNK_DRAWS,
+) -> LowRankGaussian:
+    """Get a low rank Gaussian approximation of some draws.
+
+    :param draws: a DataArray with dimensions chain, draw and one other
+    dimension, e.g. idata.posterior["dgfC"]
+
+    :param rank: how many eigenvectors to keep. If not set, all eigenvectors
+    with non-negligible eigenvalues are kept, so the approximation's
+    covariance is the sample covariance.
+
+    :param chunk_draws: how many draws per chain to load at once
+    """
+    draws = draws.transpose("chain", "draw", ...)
+    (dim,) = [d for d in draws.dims if d not in ["chain", "draw"]]
+    _, mean, cov = get_streaming_moments(iter_draw_chunks(draws, chunk_draws))
+    eigenvalues, eigenvectors = np.linalg.eigh(cov)
+    order = np.argsort(eigenvalues)[::-1]
+    eigenvalues, eigenvectors = eigenvalues[order], eigenvectors[:, order]
+    n_nonzero = int((eigenvalues > EIGENVALUE_RTOL * eigenvalues[0]).sum())
+    rank = n_nonzero if rank is None else min(rank, n_nonzero)
+    eigenvalues, eigenvectors = eigenvalues[:rank], eigenvectors[:, :rank]
+    explained = np.einsum("ij,j,ij->i", eigenvectors, eigenvalues, eigenvectors)
+    return LowRankGaussian(
+        ids=(
+            draws.coords[dim].values
+            if dim in draws.coords
+            else np.arange(draws.sizes[dim])
+        ),
+        mean=mean,
+        eigenvectors=eigenvectors,
+        eigenvalues=eigenvalues,
+        residual=np.clip(np.diag(cov) - explained, 0, None),
+    )
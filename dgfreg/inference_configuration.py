@@ -1,16 +1,57 @@
-"""Definition of the InferenceConfiguration class."""
+"""Definition of the InferenceConfiguration class.
 
+Loading a configuration doesn't import the Stan input functions, or anything
+that the fitting modes need to fit a model, so validating configurations is
+quick.
+
+"""
+
+import ast
+import importlib
+import importlib.util
 import os
+from functools import lru_cache
 from typing import Callable, Dict, List, Optional
 
 import toml
 from pydantic import BaseModel, Field, field_validator, model_validator
-from dgfreg import fitting_mode, stan_input_functions
+from dgfreg import fitting_mode
+from dgfreg.util import IDATA_FILES
 
 HERE = os.path.dirname(os.path.abspath(__file__))
 STAN_DIR = os.path.join(HERE, "stan")
 DEFAULT_DIMS = {"llik": ["observation"], "yrep": ["observation"]}
 DEFAULT_SAMPLE_KWARGS = {"show_progress": False}
+STAN_INPUT_FUNCTIONS_MODULE = "dgfreg.stan_input_functions"
+
+
+@lru_cache
+def get_module_function_names(module_name: str) -> List[str]:
+    """Get the names of the functions in a module, without importing it."""
+    spec = importlib.util.find_spec(module_name)
+    if spec is None or spec.origin is None:
+        raise ValueError(f"Could not find module {module_name}.")
+    with open(spec.origin) as f:
+        tree = ast.parse(f.read())
+    return [n.name for n in tree.body if isinstance(n, ast.FunctionDef)]
+
+
+def get_stan_input_function(name: str) -> Callable:
+    """Get a Stan input function that is only imported when it is called.
+
+    :param name: the name of a function in dgfreg.stan_input_functions
+    """
+    if name not in get_module_function_names(STAN_INPUT_FUNCTIONS_MODULE):
+        raise ValueError(
+            f"{name} is not a function in {STAN_INPUT_FUNCTIONS_MODULE}."
+        )
+
+    def stan_input_function(*args, **kwargs):
+        module = importlib.import_module(STAN_INPUT_FUNCTIONS_MODULE)
+        return getattr(module, name)(*args, **kwargs)
+
+    stan_input_function.__name__ = name
+    return stan_input_function
 
 
 class InferenceConfiguration(BaseModel):
@@ -29,6 +70,9 @@ class InferenceConfiguration(BaseModel):
     :param stan_input_function: function from src.stan_input_functions used to
     get a Stan input dictionary from a PreparedData object.
 
+    :param stan_input_kwargs: keyword arguments for the stan input function,
+    e.g. grainsize for get_stan_input_threaded.
+
     :param sample_kwargs: dictionary of keyword arguments to
     cmdstanpy.CmdStanModel.sample.
 
@@ -41,31 +85,60 @@ class InferenceConfiguration(BaseModel):
 
     :param kfold_folds: How many kfold folds to run
 
+    :param generated_quantities: which of the generated quantities in
+    fitting_mode.GENERATED_QUANTITIES to output by default. A mode_options
+    table can override this with its own 'generated_quantities' list, e.g.
+    generated_quantities = ["llik"] for kfold mode. If not set, all generated
+    quantities are output.
+
     :param cpp_options: valid choices for the `cpp_options` argument to
     CmdStanModel
 
     :param stanc_options: valid choices for the `cpp_options` argument to
     CmdStanModel
 
+    :param output_format: how to save the InferenceData: one of "json",
+    "netcdf" and "zarr". The netcdf and zarr files are chunked and compressed,
+    and load lazily with dgfreg.util.load_idata.
+
+    :param output_float32: whether to save draws as 32 bit floats
+
+    :param output_thin: if set, only save every output_thin-th draw of the
+    predictive and log likelihood groups
+
+    :param output_warmup: whether to keep warmup draws in zarr output. zarr
+    output is copied from the Stan csv files a chunk at a time, so saving big
+    fits doesn't need much memory.
+
+    To use more than one thread per chain, e.g. with a model that uses
+    reduce_sum, set `threads_per_chain` in sample_kwargs or mode_options and
+    `STAN_THREADS = true` in cpp_options.
+
     """
 
     name: str
     stan_file: str
     prepared_data_dir: str
     stan_input_function: Callable
+    stan_input_kwargs: dict = Field(default_factory=dict)
     fitting_mode_names: List[str] = Field(alias="modes")
     fitting_modes: List[fitting_mode.FittingMode]
     sample_kwargs: dict = Field(default_factory=lambda: DEFAULT_SAMPLE_KWARGS)
     dims: Dict[str, List[str]] = Field(default_factory=lambda: DEFAULT_DIMS)
     mode_options: Optional[Dict[str, dict]] = None
     kfold_folds: Optional[int] = None
+    generated_quantities: Optional[List[str]] = None
     cpp_options: Optional[dict] = None
     stanc_options: Optional[dict] = None
+    output_format: str = "json"
+    output_float32: bool = False
+    output_thin: Optional[int] = None
+    output_warmup: bool = False
 
     def __init__(self, **data):
         """Initialise an InferenceConfiguration."""
-        data["stan_input_function"] = getattr(
-            stan_input_functions, data["stan_input_function"]
+        data["stan_input_function"] = get_stan_input_function(
+            data["stan_input_function"]
         )
         data["fitting_modes"] = [
             getattr(fitting_mode, mode + "_mode") for mode in data["modes"]
@@ -75,20 +148,100 @@ class InferenceConfiguration(BaseModel):
     @model_validator(mode="after")
     def check_folds(cls, m: "InferenceConfiguration"):
         """Check that there is a number of folds if required."""
-        if any(m == "kfold" for m in m.fitting_mode_names):
+        for mode in m.fitting_mode_names:
+            if not mode.startswith("kfold"):
+                continue
+            msg = f"Mode '{mode}' requires a mode_options.{mode} table."
             if m.mode_options is None:
-                raise ValueError("Mode 'kfold' requires a mode_options.kfold table.")
-            if "kfold" not in m.mode_options.keys():
-                raise ValueError("Mode 'kfold' requires a mode_options.kfold table.")
-            elif "n_folds" not in m.mode_options["kfold"].keys():
-                raise ValueError("Set 'n_folds' field in kfold mode options.")
+                raise ValueError(msg)
+            if mode not in m.mode_options.keys():
+                raise ValueError(msg)
+            elif "n_folds" not in m.mode_options[mode].keys():
+                raise ValueError(f"Set 'n_folds' field in {mode} mode options.")
             else:
-                assert int(m.mode_options["kfold"]["n_folds"]), (
+                assert int(m.mode_options[mode]["n_folds"]), (
                     f"Could not coerce n_folds choice "
-                    f"{m.mode_options['kfold']['n_folds']} to int."
+                    f"{m.mode_options[mode]['n_folds']} to int."
                 )
+                if "n_workers" in m.mode_options[mode].keys():
+                    assert int(m.mode_options[mode]["n_workers"]), (
+                        f"Could not coerce n_workers choice "
+                        f"{m.mode_options[mode]['n_workers']} to int."
+                    )
+            approximation = m.mode_options[mode].get("approximation")
+            if (
+                approximation is not None
+                and approximation not in fitting_mode.APPROXIMATIONS.keys()
+            ):
+                raise ValueError(
+                    f"{approximation} not in available approximations "
+                    f"{list(fitting_mode.APPROXIMATIONS.keys())}."
+                )
+        return m
+
+    @model_validator(mode="after")
+    def check_threads(cls, m: "InferenceConfiguration"):
+        """Check that the model is compiled with threads if they are used."""
+        option_tables = [m.sample_kwargs, *(m.mode_options or {}).values()]
+        uses_threads = any(
+            int(t.get("threads_per_chain", 1)) > 1 for t in option_tables
+        )
+        cpp_options = m.cpp_options or {}
+        if uses_threads and not cpp_options.get("STAN_THREADS", False):
+            raise ValueError(
+                "threads_per_chain > 1 requires STAN_THREADS = true in "
+                "cpp_options."
+            )
+        return m
+
+    @model_validator(mode="after")
+    def check_collapsed_modes(cls, m: "InferenceConfiguration"):
+        """Check that the collapsed modes are only used with new.stan."""
+        for mode in m.fitting_mode_names:
+            if (
+                mode in fitting_mode.COLLAPSED_MODES
+                and m.stan_file not in fitting_mode.COLLAPSED_STAN_FILES
+            ):
+                raise ValueError(
+                    f"Mode '{mode}' computes the posterior of new.stan, so "
+                    f"stan_file must be one of "
+                    f"{fitting_mode.COLLAPSED_STAN_FILES}, not {m.stan_file}."
+                )
+        return m
+
+    @model_validator(mode="after")
+    def check_generated_quantities(cls, m: "InferenceConfiguration"):
+        """Check that all chosen generated quantities exist."""
+        choices = [m.generated_quantities] + [
+            opts.get("generated_quantities")
+            for opts in (m.mode_options or {}).values()
+        ]
+        for gqs in choices:
+            for gq in gqs or []:
+                if gq not in fitting_mode.GENERATED_QUANTITIES:
+                    raise ValueError(
+                        f"{gq} not in available generated quantities "
+                        f"{fitting_mode.GENERATED_QUANTITIES}."
+                    )
         return m
 
+    @field_validator("output_format")
+    def check_output_format(cls, v):
+        """Check that the output format is available."""
+        if v not in IDATA_FILES.keys():
+            raise ValueError(
+                f"{v} not in available output formats "
+                f"{list(IDATA_FILES.keys())}."
+            )
+        return v
+
+    @field_validator("output_thin")
+    def check_output_thin(cls, v):
+        """Check that the thinning interval is positive."""
+        if v is not None and v < 1:
+            raise ValueError("output_thin must be at least 1.")
+        return v
+
     @field_validator("stan_file")
     def check_stan_file_exists(cls, v):
         """Check that the stan file exists."""
@@ -0,0 +1,232 @@
+"""A cache of compiled Stan models, keyed by everything that affects them.
+
+Each compiled model lives in its own directory in the cache, named after the
+Stan file and a hash of the Stan source (including any #included files), the
+cmdstan version, the platform and the compiler options. Models that differ in
+any of these, e.g. with and without STAN_THREADS, sit side by side, and the
+hash doesn't depend on where the source files are, so one cache can be shared
+between checkouts and CI workers by setting the environment variable
+DGFREG_MODEL_CACHE_DIR.
+
+Models are compiled in a temporary directory inside the cache and then
+renamed into place, so workers sharing a cache never see half-compiled
+models.
+
+"""
+
+import hashlib
+import json
+import os
+import platform
+import re
+import shutil
+import tempfile
+from typing import Dict, List, Optional
+
+import cmdstanpy
+from dgfreg.data_preparation import DATA_DIR
+
+MODEL_CACHE_DIR = os.path.join(DATA_DIR, "cache", "models")
+MODEL_CACHE_DIR_VARIABLE = "DGFREG_MODEL_CACHE_DIR"
+MANIFEST_FILE = "manifest.json"
+# characters of the hash in each cached model's directory name
+KEY_LENGTH = 16
+INCLUDE_PATTERN = re.compile(r'^\s*#include\s+[<"]?([^\s">]+)[">]?', re.M)
+EXE_SUFFIX = ".exe" if platform.system() == "Windows" else ""
+
+
+def get_model_cache_dir() -> str:
+    """Get the model cache directory, from the environment if it is set."""
+    return os.environ.get(MODEL_CACHE_DIR_VARIABLE, MODEL_CACHE_DIR)
+
+
+def get_include_paths(
+    stan_file: str, stanc_options: Optional[dict] = None
+) -> List[str]:
+    """Get the directories that a Stan file's #includes are looked up in.
+
+    As in cmdstanpy, these are the Stan file's own directory plus any
+    'include-paths' in the stanc options.
+    """
+    include_paths = (stanc_options or {}).get("include-paths", [])
+    if isinstance(include_paths, str):
+        include_paths = include_paths.split(",")
+    return [os.path.dirname(os.path.abspath(stan_file))] + list(include_paths)
+
+
+def get_stan_sources(
+    stan_file: str, include_paths: List[str]
+) -> Dict[str, str]:
+    """Get the text of a Stan file and every file it includes.
+
+    The output maps each file's name, as it is included, to its text. The Stan
+    file itself is under its base name.
+
+    :param stan_file: path to a Stan file
+
+    :param include_paths: directories to look for included files in
+    """
+    sources: Dict[str, str] = {}
+
+    def add_source(name: str, path: str):
+        if name in sources.keys():
+            return
+        with open(path) as f:
+            sources[name] = f.read()
+        for include in INCLUDE_PATTERN.findall(sources[name]):
+            candidates = [os.path.join(d, include) for d in include_paths]
+            found = [c for c in candidates if os.path.exists(c)]
+            if len(found) == 0:
+                raise ValueError(
+                    f"Could not find {include}, included in {path}, in any "
+                    f"of {include_paths}."
+                )
+            add_source(include, found[0])
+
+    add_source(os.path.basename(stan_file), stan_file)
+    return sources
+
+
+def get_cmdstan_version() -> str:
+    """Get the installed cmdstan's version, or "none" if there isn't one."""
+    try:
+        return os.path.basename(cmdstanpy.cmdstan_path())
+    except ValueError:
+        return "none"
+
+
+def get_cache_stanc_options(stanc_options: Optional[dict]) -> Optional[dict]:
+    """Get stanc options without include paths.
+
+    Cached models are compiled from copies of their included files, so the
+    original include paths aren't needed, and leaving them out means that the
+    key doesn't depend on where the source files are.
+    """
+    if stanc_options is None:
+        return None
+    return {k: v for k, v in stanc_options.items() if k != "include-paths"}
+
+
+def get_model_cache_key(
+    sources: Dict[str, str],
+    cpp_options: Optional[dict] = None,
+    stanc_options: Optional[dict] = None,
+    cmdstan_version: Optional[str] = None,
+) -> str:
+    """Get a hash of everything that affects a compiled model.
+
+    :param sources: output of get_stan_sources
+
+    :param cpp_options: the C++ compiler options
+
+    :param stanc_options: the stanc options, without include paths
+
+    :param cmdstan_version: the cmdstan version. If not given, the installed
+    version is used.
+    """
+    if cmdstan_version is None:
+        cmdstan_version = get_cmdstan_version()
+    description = {
+        "sources": sources,
+        "cpp_options": cpp_options or {},
+        "stanc_options": stanc_options or {},
+        "cmdstan_version": cmdstan_version,
+        "platform": f"{platform.system()}-{platform.machine()}",
+    }
+    return hashlib.sha256(
+        json.dumps(description, sort_keys=True).encode()
+    ).hexdigest()
+
+
+def compile_into_cache(
+    model_dir: str,
+    sources: Dict[str, str],
+    stan_name: str,
+    cpp_options: Optional[dict],
+    stanc_options: Optional[dict],
+    manifest: dict,
+):
+    """Compile a model in a temporary directory, then move it into place.
+
+    If another process puts the same model in place first, its model is kept
+    and this one is thrown away.
+    """
+    cache_dir = os.path.dirname(model_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(
+        prefix=f".{os.path.basename(model_dir)}-", dir=cache_dir
+    )
+    try:
+        for name, text in sources.items():
+            path = os.path.join(tmp_dir, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write(text)
+        cmdstanpy.CmdStanModel(
+            stan_file=os.path.join(tmp_dir, stan_name),
+            cpp_options=cpp_options,
+            stanc_options=stanc_options,
+        )
+        with open(os.path.join(tmp_dir, MANIFEST_FILE), "w") as f:
+            json.dump(manifest, f, indent=2)
+        # mkdtemp makes a private directory, but the cache may be shared
+        os.chmod(tmp_dir, 0o755)
+        try:
+            os.rename(tmp_dir, model_dir)
+        except OSError:
+            if not os.path.isdir(model_dir):
+                raise
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def get_cached_model(
+    stan_file: str,
+    cpp_options: Optional[dict] = None,
+    stanc_options: Optional[dict] = None,
+    cache_dir: Optional[str] = None,
+) -> cmdstanpy.CmdStanModel:
+    """Get a compiled CmdStanModel from the cache, compiling it if needed.
+
+    :param stan_file: path to a Stan file
+
+    :param cpp_options: cpp_options for CmdStanModel
+
+    :param stanc_options: stanc_options for CmdStanModel
+
+    :param cache_dir: the cache directory. If not given, this is the
+    environment variable DGFREG_MODEL_CACHE_DIR if it is set, otherwise
+    MODEL_CACHE_DIR.
+    """
+    if cache_dir is None:
+        cache_dir = get_model_cache_dir()
+    sources = get_stan_sources(
+        stan_file, get_include_paths(stan_file, stanc_options)
+    )
+    stanc_options = get_cache_stanc_options(stanc_options)
+    cmdstan_version = get_cmdstan_version()
+    key = get_model_cache_key(
+        sources, cpp_options, stanc_options, cmdstan_version
+    )
+    stan_name = os.path.basename(stan_file)
+    model_name = os.path.splitext(stan_name)[0]
+    model_dir = os.path.join(cache_dir, f"{model_name}-{key[:KEY_LENGTH]}")
+    exe_file = os.path.join(model_dir, model_name + EXE_SUFFIX)
+    if not os.path.exists(exe_file):
+        manifest = {
+            "key": key,
+            "stan_file": stan_name,
+            "included_files": sorted(set(sources.keys()) - {stan_name}),
+            "cpp_options": cpp_options,
+            "stanc_options": stanc_options,
+            "cmdstan_version": cmdstan_version,
+        }
+        compile_into_cache(
+            model_dir, sources, stan_name, cpp_options, stanc_options, manifest
+        )
+    return cmdstanpy.CmdStanModel(
+        stan_file=os.path.join(model_dir, stan_name),
+        exe_file=exe_file,
+        cpp_options=cpp_options,
+        stanc_options=stanc_options,
+    )
@@ -1,6 +1,12 @@
-"""Run the prepare_data function from the data_preparaion module."""
+"""Run the prepare_data function from the data_preparaion module.
+
+Pass the flag --incremental to only process new measurements when nothing else
+in the raw data has changed.
+"""
+
+import sys
 
 from dgfreg.data_preparation import prepare_data
 
 if __name__ == "__main__":
-    prepare_data()
+    prepare_data(incremental="--incremental" in sys.argv[1:])
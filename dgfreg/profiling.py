@@ -0,0 +1,399 @@
+"""Record how long each stage of sample.main takes, and how much it uses.
+
+Stages are timed with a Profiler, which is shared between the threads that
+run jobs. Each stage records its wall time, the cpu time of the thread that
+ran it, the cpu time of any child processes (e.g. cmdstan) that finished
+during it, and the peak resident memory of this process and of its running
+children during the stage. Fits from cmdstan also contribute each chain's
+warmup and sampling times and, if the model has profile blocks and was run
+with save_profile, Stan's profile output.
+
+Peak memory is sampled from /proc by a background thread while any stage is
+running, so it is only recorded on linux, and a child process that starts and
+finishes between samples is missed. The peak resident memory so far of this
+process and its finished children, from getrusage, is recorded too.
+
+Child cpu time and memory are process-wide, so when jobs overlap they are only
+upper bounds for any one stage.
+
+"""
+
+import csv
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, fields
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+# ru_maxrss is in kilobytes on linux but bytes on macos
+MAXRSS_BYTES = 1 if sys.platform == "darwin" else 1024
+PROFILE_JSON_FILE = "profile.json"
+PROFILE_CSV_FILE = "profile.csv"
+# how often to sample resident memory while stages are running
+RSS_SAMPLE_SECONDS = 0.05
+
+
+def get_max_rss_mb(who: int) -> float:
+    """Get the peak resident memory of this process or its children."""
+    return resource.getrusage(who).ru_maxrss * MAXRSS_BYTES / 2**20
+
+
+def read_rss_mb(pid: str = "self") -> Optional[float]:
+    """Get a process's current resident memory from /proc, if it can be read."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        return None
+    return None
+
+
+def get_child_pids() -> List[str]:
+    """Get the ids of this process's running children, from /proc."""
+    pids = []
+    try:
+        tids = os.listdir("/proc/self/task")
+    except OSError:
+        return pids
+    for tid in tids:
+        try:
+            with open(f"/proc/self/task/{tid}/children") as f:
+                pids.extend(f.read().split())
+        except OSError:
+            continue
+    return pids
+
+
+def get_rss_mb() -> Tuple[Optional[float], Optional[float]]:
+    """Get the current resident memory of this process and its children.
+
+    The children's memory is the total over the running children. Both are
+    None if /proc can't be read, e.g. on macos.
+    """
+    rss = read_rss_mb()
+    if rss is None:
+        return None, None
+    children = [read_rss_mb(pid) for pid in get_child_pids()]
+    return rss, sum(c for c in children if c is not None)
+
+
+def get_child_cpu_seconds() -> float:
+    """Get the cpu time used by this process's finished children."""
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+@dataclass
+class PeakRss:
+    """The peak resident memory during a stage, in MB.
+
+    :param rss_mb: peak resident memory of this process
+
+    :param child_rss_mb: peak total resident memory of this process's running
+    children
+    """
+
+    rss_mb: Optional[float] = None
+    child_rss_mb: Optional[float] = None
+
+    def update(self, rss_mb: Optional[float], child_rss_mb: Optional[float]):
+        """Update the peaks with a sample."""
+        if rss_mb is not None:
+            self.rss_mb = max(self.rss_mb or 0.0, rss_mb)
+        if child_rss_mb is not None:
+            self.child_rss_mb = max(self.child_rss_mb or 0.0, child_rss_mb)
+
+
+class RssSampler:
+    """Samples resident memory in a background thread while stages run.
+
+    Any number of stages, possibly in different threads, can be tracked at
+    once. Each gets the peak of the samples taken while it runs, including
+    one when it starts and one when it ends. The thread only runs while
+    some stage is being tracked.
+    """
+
+    def __init__(self, interval: float = RSS_SAMPLE_SECONDS):
+        """Initialise an RssSampler."""
+        self.interval = interval
+        self.peaks: Dict[int, PeakRss] = {}
+        self.lock = threading.Lock()
+        self.thread: Optional[threading.Thread] = None
+
+    def sample(self):
+        """Update every tracked stage's peaks with the current memory."""
+        rss_mb, child_rss_mb = get_rss_mb()
+        with self.lock:
+            for peak in self.peaks.values():
+                peak.update(rss_mb, child_rss_mb)
+
+    def run(self):
+        """Sample until no stages are being tracked."""
+        while True:
+            time.sleep(self.interval)
+            self.sample()
+            with self.lock:
+                if len(self.peaks) == 0:
+                    self.thread = None
+                    return
+
+    @contextmanager
+    def track(self):
+        """Track the peak memory during a with block, yielding a PeakRss."""
+        peak = PeakRss()
+        with self.lock:
+            self.peaks[id(peak)] = peak
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        self.sample()
+        try:
+            yield peak
+        finally:
+            self.sample()
+            with self.lock:
+                del self.peaks[id(peak)]
+
+
+@dataclass
+class StageRecord:
+    """Performance of one stage of sample.main.
+
+    :param stage: the stage's name, e.g. "compile" or "fit"
+
+    :param inference: the inference's name, or None for stages that
+    inferences share, e.g. compiling a model
+
+    :param mode: the fitting mode's name, if the stage belongs to a job
+
+    :param fold: the fold, for stages of cross-validation folds
+
+    :param target: what a shared stage worked on, e.g. a stan file
+
+    :param status: "ok" or "error"
+
+    :param wall_seconds: wall time
+
+    :param cpu_seconds: cpu time of the thread that ran the stage
+
+    :param child_cpu_seconds: cpu time of child processes that finished
+    during the stage
+
+    :param peak_rss_mb: peak resident memory of this process during the
+    stage, or None if it couldn't be sampled
+
+    :param peak_child_rss_mb: peak total resident memory of this process's
+    running children during the stage, or None if it couldn't be sampled
+
+    :param process_max_rss_so_far_mb: peak resident memory of this process
+    since it started
+
+    :param child_max_rss_so_far_mb: peak resident memory of any finished
+    child process so far
+    """
+
+    stage: str
+    inference: Optional[str] = None
+    mode: Optional[str] = None
+    fold: Optional[int] = None
+    target: Optional[str] = None
+    status: str = "ok"
+    wall_seconds: Optional[float] = None
+    cpu_seconds: Optional[float] = None
+    child_cpu_seconds: Optional[float] = None
+    peak_rss_mb: Optional[float] = None
+    peak_child_rss_mb: Optional[float] = None
+    process_max_rss_so_far_mb: Optional[float] = None
+    child_max_rss_so_far_mb: Optional[float] = None
+
+
+@dataclass
+class ChainTiming:
+    """cmdstan's timing of one chain, as reported in its csv file."""
+
+    inference: Optional[str]
+    mode: Optional[str]
+    fold: Optional[int]
+    chain: int
+    warmup_seconds: float
+    sampling_seconds: float
+    total_seconds: float
+
+
+class Profiler:
+    """Collects StageRecords, chain timings and Stan profiles from threads."""
+
+    def __init__(self):
+        """Initialise a Profiler."""
+        self.stages: List[StageRecord] = []
+        self.chains: List[ChainTiming] = []
+        self.stan_profiles: List[Dict[str, Any]] = []
+        self.lock = threading.Lock()
+        self.rss_sampler = RssSampler()
+
+    @contextmanager
+    def stage(
+        self,
+        stage: str,
+        inference: Optional[str] = None,
+        mode: Optional[str] = None,
+        fold: Optional[int] = None,
+        target: Optional[str] = None,
+    ):
+        """Time the code in a with block as a stage.
+
+        The stage is recorded even if the block raises an error.
+        """
+        record = StageRecord(stage, inference, mode, fold, target)
+        wall, cpu = time.perf_counter(), time.thread_time()
+        child_cpu = get_child_cpu_seconds()
+        try:
+            with self.rss_sampler.track() as peak:
+                yield record
+        except BaseException:
+            record.status = "error"
+            raise
+        finally:
+            record.wall_seconds = time.perf_counter() - wall
+            record.cpu_seconds = time.thread_time() - cpu
+            record.child_cpu_seconds = get_child_cpu_seconds() - child_cpu
+            record.peak_rss_mb = peak.rss_mb
+            record.peak_child_rss_mb = peak.child_rss_mb
+            record.process_max_rss_so_far_mb = get_max_rss_mb(
+                resource.RUSAGE_SELF
+            )
+            record.child_max_rss_so_far_mb = get_max_rss_mb(
+                resource.RUSAGE_CHILDREN
+            )
+            with self.lock:
+                self.stages.append(record)
+
+    def record_fit(
+        self,
+        fit,
+        inference: Optional[str] = None,
+        mode: Optional[str] = None,
+        fold: Optional[int] = None,
+    ):
+        """Record a fit's chain timings and Stan profiles, if it has any.
+
+        Only CmdStanMCMC fits have these: other fits are ignored.
+        """
+        import pandas as pd
+
+        chain_times = getattr(fit, "time", None)
+        runset = getattr(fit, "runset", None)
+        if chain_times is None or runset is None:
+            return
+        chains = [
+            ChainTiming(
+                inference,
+                mode,
+                fold,
+                chain,
+                t.get("warmup", float("nan")),
+                t.get("sampling", float("nan")),
+                t.get("total", float("nan")),
+            )
+            for chain, t in zip(runset.chain_ids, chain_times)
+        ]
+        stan_profiles = []
+        for chain, path in zip(runset.chain_ids, runset.profile_files):
+            if path and os.path.exists(path):
+                for row in pd.read_csv(path).to_dict(orient="records"):
+                    stan_profiles.append(
+                        {
+                            "inference": inference,
+                            "mode": mode,
+                            "fold": fold,
+                            "chain": chain,
+                        }
+                        | row
+                    )
+        with self.lock:
+            self.chains.extend(chains)
+            self.stan_profiles.extend(stan_profiles)
+
+    def job(self, inference: str, mode: str) -> "JobProfiler":
+        """Get a JobProfiler for one of an inference's modes."""
+        return JobProfiler(self, inference, mode)
+
+    def get_report(
+        self, inference: str, targets: Sequence[str] = ()
+    ) -> Dict[str, List[Dict[str, Any]]]:
+        """Get everything recorded about an inference.
+
+        :param inference: the inference's name
+
+        :param targets: the shared stages' targets that the inference used,
+        e.g. its stan file and prepared data directory
+        """
+        with self.lock:
+            return {
+                "stages": [
+                    asdict(r)
+                    for r in self.stages
+                    if r.inference == inference
+                    or (r.inference is None and r.target in targets)
+                ],
+                "chains": [
+                    asdict(c) for c in self.chains if c.inference == inference
+                ],
+                "stan_profiles": [
+                    p for p in self.stan_profiles if p["inference"] == inference
+                ],
+            }
+
+    def write_report(
+        self, directory: str, inference: str, targets: Sequence[str] = ()
+    ):
+        """Write an inference's report as json, and its stages as csv.
+
+        :param directory: where to write the report, e.g. next to the idata
+
+        :param inference: the inference's name
+
+        :param targets: as for get_report
+        """
+        report = self.get_report(inference, targets)
+        with open(os.path.join(directory, PROFILE_JSON_FILE), "w") as f:
+            json.dump(report, f, indent=2)
+        with open(os.path.join(directory, PROFILE_CSV_FILE), "w") as f:
+            writer = csv.DictWriter(
+                f, fieldnames=[field.name for field in fields(StageRecord)]
+            )
+            writer.writeheader()
+            writer.writerows(report["stages"])
+
+
+class JobProfiler:
+    """A Profiler that labels everything with an inference and mode.
+
+    Fit functions get one as the fitting option 'profiler', so that they can
+    time their own stages, e.g. each cross-validation fold.
+    """
+
+    def __init__(
+        self,
+        profiler: Profiler,
+        inference: Optional[str] = None,
+        mode: Optional[str] = None,
+    ):
+        """Initialise a JobProfiler."""
+        self.profiler = profiler
+        self.inference = inference
+        self.mode = mode
+
+    def stage(self, stage: str, fold: Optional[int] = None):
+        """Time the code in a with block as a stage of this job."""
+        return self.profiler.stage(stage, self.inference, self.mode, fold)
+
+    def record_fit(self, fit, fold: Optional[int] = None):
+        """Record a fit's chain timings and Stan profiles for this job."""
+        self.profiler.record_fit(fit, self.inference, self.mode, fold)
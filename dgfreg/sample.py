@@ -1,65 +1,402 @@
-"""Run all the inferences in the inferences folder."""
+"""Run all the inferences in the inferences folder.
 
+Each (inference, mode) pair is a separate job. Jobs only depend on their
+inference's compiled model and prepared data, so once these are available all
+jobs are run concurrently, subject to a budget of cpu cores. Each distinct
+model is compiled once and each prepared data directory is loaded once, no
+matter how many inferences use them. Compiled models are kept between runs in
+a cache: see dgfreg.model_cache. An inference's idata file is written as
+soon as all of its jobs are finished.
+
+Stan input files are written to a temporary directory that is removed at the
+end of the run.
+
+Every stage is timed with a dgfreg.profiling.Profiler, and each inference's
+timings are written next to its idata in the files profile.json and
+profile.csv.
+
+"""
+
+import json
 import os
+import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from typing import Dict, Optional, Tuple
 
 import arviz as az
 import cmdstanpy
-from dgfreg.data_preparation import load_prepared_data
+import numpy as np
+import xarray as xr
+import zarr
+from dgfreg.data_preparation import PreparedData, load_prepared_data
+from dgfreg.fitting_mode import FittingMode, get_output_flags
 from dgfreg.inference_configuration import (
+    InferenceConfiguration,
     load_inference_configuration,
 )
+from dgfreg.model_cache import get_cached_model
+from dgfreg.profiling import JobProfiler, Profiler
+from dgfreg.stan_csv import stan_csv_to_zarr
+from dgfreg.util import (
+    IDATA_FILES,
+    append_idata_zarr,
+    compact_idata,
+    remove_saved_idata,
+    write_idata,
+)
 
 HERE = os.path.dirname(__file__)
 RUNS_DIR = os.path.join(HERE, "..", "inferences")
 STAN_DIR = os.path.join(HERE, "stan")
+N_CORES = os.cpu_count() or 1
+DEFAULT_CHAINS = 4
+
+
+class CoreBudget:
+    """A fixed number of cpu cores that jobs can reserve while they run."""
+
+    def __init__(self, n_cores: int):
+        """Initialise a CoreBudget."""
+        self.n_cores = n_cores
+        self.n_free = n_cores
+        self.condition = threading.Condition()
+
+    @contextmanager
+    def reserve(self, n: int):
+        """Wait until n cores are free, then hold them until exiting.
+
+        Jobs needing more cores than the whole budget reserve the whole budget.
+        """
+        n = min(n, self.n_cores)
+        with self.condition:
+            self.condition.wait_for(lambda: self.n_free >= n)
+            self.n_free -= n
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.n_free += n
+                self.condition.notify_all()
+
+
+def get_fit_kwargs(ic: InferenceConfiguration, mode: FittingMode) -> dict:
+    """Get the keyword arguments for fitting an inference in a mode."""
+    fit_kwargs = ic.sample_kwargs.copy()
+    if ic.generated_quantities is not None:
+        fit_kwargs["generated_quantities"] = ic.generated_quantities
+    if ic.mode_options is not None and mode.name in ic.mode_options.keys():
+        fit_kwargs |= ic.mode_options[mode.name]
+    return fit_kwargs
+
 
-def main():
-    """Fit all inferences in all modes."""
-    run_dirs = [
+def get_n_cores_needed(fit_kwargs: dict) -> int:
+    """Get the number of cores that a job will use at once."""
+    chains = int(fit_kwargs.get("chains", DEFAULT_CHAINS))
+    parallel_chains = int(fit_kwargs.get("parallel_chains", chains))
+    threads_per_chain = int(fit_kwargs.get("threads_per_chain", 1))
+    n_workers = int(fit_kwargs.get("n_workers", 1))
+    return min(chains, parallel_chains) * threads_per_chain * n_workers
+
+
+def get_model_key(ic: InferenceConfiguration) -> Tuple[str, str, str]:
+    """Get a key identifying an inference's compiled model."""
+    return (
+        ic.stan_file,
+        json.dumps(ic.cpp_options, sort_keys=True),
+        json.dumps(ic.stanc_options, sort_keys=True),
+    )
+
+
+def get_model_target(model_key: Tuple[str, str, str]) -> str:
+    """Get a readable name for a compiled model, for profiling."""
+    return " ".join(model_key)
+
+
+def run_job(
+    mode: FittingMode,
+    model: cmdstanpy.CmdStanModel,
+    stan_input: dict,
+    fit_kwargs: dict,
+    budget: CoreBudget,
+    profiler: Optional[JobProfiler] = None,
+):
+    """Fit a model in a mode once enough cores are free.
+
+    The time spent waiting for cores and fitting are recorded as the stages
+    "wait_for_cores" and "fit". The fit function gets the profiler as the
+    option 'profiler', so it can time its own stages.
+    """
+    if profiler is None:
+        profiler = JobProfiler(Profiler())
+    with ExitStack() as stack:
+        with profiler.stage("wait_for_cores"):
+            stack.enter_context(budget.reserve(get_n_cores_needed(fit_kwargs)))
+        with profiler.stage("fit"):
+            output = mode.fit(
+                model, stan_input, fit_kwargs | {"profiler": profiler}
+            )
+    profiler.record_fit(output)
+    return output
+
+
+def save_idata(
+    run_dir: str,
+    ic: InferenceConfiguration,
+    prepared_data: PreparedData,
+    stan_input: dict,
+    outputs: Dict[str, Future],
+    profiler: Optional[Profiler] = None,
+):
+    """Collect an inference's outputs in an InferenceData and save it.
+
+    Generated quantities that a prior or posterior mode didn't output have no
+    dims, as their coordinates wouldn't match the empty output.
+
+    Draws in Stan csv files are read in the stage "read_csv", before the
+    stages "idata" (conversion to InferenceData) and "write".
+
+    Zarr output is streamed to disk by save_idata_zarr.
+    """
+    if profiler is None:
+        profiler = Profiler()
+    if ic.output_format == "zarr":
+        return save_idata_zarr(
+            run_dir, ic, prepared_data, stan_input, outputs, profiler
+        )
+    dims = ic.dims.copy()
+    idata_kwargs = {
+        "observed_data": stan_input,
+        "log_likelihood": "llik",
+        "coords": prepared_data.coords,
+        "dims": dims,
+    }
+    llik_outputs = {}
+    for mode in ic.fitting_modes:
+        output = outputs[mode.name].result()
+        if mode.idata_target in ["prior", "posterior"]:
+            output_flags = get_output_flags(get_fit_kwargs(ic, mode))
+            for gq, flag in output_flags.items():
+                if not flag:
+                    dims.pop(gq.removeprefix("output_"), None)
+            if isinstance(output, cmdstanpy.CmdStanMCMC):
+                with profiler.stage("read_csv", ic.name, mode.name):
+                    # cmdstanpy keeps the parsed draws for az.from_cmdstanpy
+                    output.draws()
+            idata_kwargs[mode.idata_target] = output
+            if output_flags["output_yrep"]:
+                predictive_group = f"{mode.idata_target.value}_predictive"
+                idata_kwargs[predictive_group] = "yrep"
+        elif mode.idata_target == "log_likelihood":
+            llik_outputs[f"llik_{mode.name}"] = output
+        else:
+            raise ValueError(
+                f"idata_target {mode.idata_target} is not yet supported"
+            )
+    with profiler.stage("idata", ic.name):
+        idata = az.from_cmdstanpy(**idata_kwargs)
+        for varname, output in llik_outputs.items():
+            idata.log_likelihood[varname] = output
+    idata_file = os.path.join(run_dir, IDATA_FILES[ic.output_format])
+    print(f"Saving idata to {idata_file}")
+    with profiler.stage("write", ic.name):
+        write_idata(
+            idata,
+            run_dir,
+            ic.output_format,
+            float32=ic.output_float32,
+            thin=ic.output_thin,
+        )
+
+
+def save_idata_zarr(
+    run_dir: str,
+    ic: InferenceConfiguration,
+    prepared_data: PreparedData,
+    stan_input: dict,
+    outputs: Dict[str, Future],
+    profiler: Optional[Profiler] = None,
+):
+    """Save an inference's outputs in a zarr store, one chunk at a time.
+
+    Draws from CmdStanMCMC fits are copied straight from their Stan csv files,
+    so they never need to fit in memory all at once. Warmup draws are dropped
+    unless ic.output_warmup is true. Other outputs are small enough to convert
+    in memory. Each mode's output is written in its own "write" stage.
+    """
+    if profiler is None:
+        profiler = Profiler()
+    store = os.path.join(run_dir, IDATA_FILES["zarr"])
+    print(f"Saving idata to {store}")
+    remove_saved_idata(run_dir)
+    for mode in ic.fitting_modes:
+        output = outputs[mode.name].result()
+        with profiler.stage("write", ic.name, mode.name):
+            save_output_zarr(store, ic, prepared_data, mode, output)
+    with profiler.stage("write", ic.name):
+        observed_data = az.dict_to_dataset(
+            {k: np.asarray(v) for k, v in stan_input.items()},
+            library=cmdstanpy,
+            coords=prepared_data.coords,
+            dims=ic.dims,
+            default_dims=[],
+        )
+        observed_data.to_zarr(
+            store, group="observed_data", mode="a", consolidated=False
+        )
+        zarr.consolidate_metadata(store)
+
+
+def save_output_zarr(
+    store: str,
+    ic: InferenceConfiguration,
+    prepared_data: PreparedData,
+    mode: FittingMode,
+    output,
+):
+    """Add one mode's output to an inference's zarr store."""
+    if mode.idata_target in ["prior", "posterior"]:
+        target = mode.idata_target.value
+        output_flags = get_output_flags(get_fit_kwargs(ic, mode))
+        dims = {
+            k: v
+            for k, v in ic.dims.items()
+            if output_flags.get(f"output_{k}", 1)
+        }
+        var_groups = {}
+        if target == "posterior":
+            var_groups["llik"] = "log_likelihood"
+        if output_flags["output_yrep"]:
+            var_groups["yrep"] = f"{target}_predictive"
+        if isinstance(output, cmdstanpy.CmdStanMCMC):
+            stan_csv_to_zarr(
+                output.runset.csv_files,
+                store,
+                target,
+                var_groups=var_groups,
+                dims=dims,
+                coords=prepared_data.coords,
+                float32=ic.output_float32,
+                thin=ic.output_thin,
+                inc_warmup=ic.output_warmup,
+            )
+        else:
+            idata_kwargs = {
+                target: output,
+                "coords": prepared_data.coords,
+                "dims": dims,
+            }
+            if "llik" in var_groups.keys():
+                idata_kwargs["log_likelihood"] = "llik"
+            if "yrep" in var_groups.keys():
+                idata_kwargs[f"{target}_predictive"] = "yrep"
+            idata = compact_idata(
+                az.from_cmdstanpy(**idata_kwargs),
+                float32=ic.output_float32,
+                thin=ic.output_thin,
+            )
+            append_idata_zarr(idata, store)
+    elif mode.idata_target == "log_likelihood":
+        llik = output.rename(f"llik_{mode.name}")
+        if "log_likelihood" in zarr.open_group(store, mode="a").keys():
+            # match the draws of the other log likelihoods, as when
+            # assigning to an InferenceData group
+            existing = xr.open_zarr(
+                store, group="log_likelihood", consolidated=False
+            )
+            llik = llik.reindex(chain=existing["chain"], draw=existing["draw"])
+        llik.to_dataset().to_zarr(
+            store, group="log_likelihood", mode="a", consolidated=False
+        )
+    else:
+        raise ValueError(
+            f"idata_target {mode.idata_target} is not yet supported"
+        )
+
+
+def main(n_cores: int = N_CORES):
+    """Fit all inferences in all modes.
+
+    :param n_cores: how many cpu cores the jobs may use at once
+    """
+    run_dirs = sorted(
         os.path.join(RUNS_DIR, d)
         for d in os.listdir(RUNS_DIR)
         if os.path.isdir(os.path.join(RUNS_DIR, d))
-    ]
-    for run_dir in sorted(run_dirs):
-        ic = load_inference_configuration(os.path.join(run_dir, "config.toml"))
-        stan_file = os.path.join(STAN_DIR, ic.stan_file)
-        prepared_data_dir = os.path.join(
-            "data", "prepared", ic.prepared_data_dir
+    )
+    configs = {
+        run_dir: load_inference_configuration(
+            os.path.join(run_dir, "config.toml")
+        )
+        for run_dir in run_dirs
+    }
+    profiler = Profiler()
+    models: Dict[Tuple[str, str, str], cmdstanpy.CmdStanModel] = {}
+    prepared_datas: Dict[str, PreparedData] = {}
+    for ic in configs.values():
+        model_key = get_model_key(ic)
+        if model_key not in models.keys():
+            with profiler.stage("compile", target=get_model_target(model_key)):
+                models[model_key] = get_cached_model(
+                    os.path.join(STAN_DIR, ic.stan_file),
+                    cpp_options=ic.cpp_options,
+                    stanc_options=ic.stanc_options,
+                )
+        if ic.prepared_data_dir not in prepared_datas.keys():
+            with profiler.stage("load_data", target=ic.prepared_data_dir):
+                prepared_datas[ic.prepared_data_dir] = load_prepared_data(
+                    os.path.join("data", "prepared", ic.prepared_data_dir)
+                )
+    stan_inputs = {}
+    for run_dir, ic in configs.items():
+        with profiler.stage("stan_input", ic.name):
+            stan_inputs[run_dir] = ic.stan_input_function(
+                prepared_datas[ic.prepared_data_dir], **ic.stan_input_kwargs
+            )
+    budget = CoreBudget(n_cores)
+    n_jobs = sum(len(ic.fitting_modes) for ic in configs.values())
+    with ExitStack() as stack:
+        # the jobs' Stan input files only last as long as this run
+        stan_input_dir = stack.enter_context(
+            tempfile.TemporaryDirectory(prefix="dgfreg-stan-input-")
         )
-        model = cmdstanpy.CmdStanModel(
-            stan_file=stan_file,
-            cpp_options=ic.cpp_options,
-            stanc_options=ic.stanc_options,
+        executor = stack.enter_context(
+            ThreadPoolExecutor(max_workers=max(1, n_jobs))
         )
-        prepared_data = load_prepared_data(prepared_data_dir)
-        stan_input_base = ic.stan_input_function(prepared_data)
-        idata_kwargs = {
-            "observed_data": stan_input_base,
-            "log_likelihood": "llik",
-            "coords": prepared_data.coords,
-            "dims": ic.dims,
-        }
-        llik_outputs = {}
-        for mode in ic.fitting_modes:
-            fit_kwargs = ic.sample_kwargs
-            if ic.mode_options is not None and mode.name in ic.mode_options.keys():
-                fit_kwargs |= ic.mode_options[mode.name]
-            output = mode.fit(model, stan_input_base, fit_kwargs)
-            if mode.idata_target in ["prior", "posterior"]:
-                idata_kwargs[mode.idata_target] = output
-                idata_kwargs[f"{mode.idata_target.value}_predictive"] = "yrep"
-            elif mode.idata_target == "log_likelihood":
-                llik_outputs[f"llik_{mode.name}"] = output
-            else:
-                raise ValueError(
-                    f"idata_target {mode.idata_target} is not yet supported"
+        futures = {
+            run_dir: {
+                mode.name: executor.submit(
+                    run_job,
+                    mode,
+                    models[get_model_key(ic)],
+                    stan_inputs[run_dir],
+                    get_fit_kwargs(ic, mode)
+                    | {"stan_input_dir": stan_input_dir},
+                    budget,
+                    profiler.job(ic.name, mode.name),
                 )
-        idata = az.from_cmdstanpy(**idata_kwargs)
-        for varname, output in llik_outputs.items():
-            idata.log_likelihood[varname] = output
-        idata_file = os.path.join(run_dir, "idata.json")
-        print(f"Saving idata to {idata_file}")
-        idata.to_json(idata_file)
+                for mode in ic.fitting_modes
+            }
+            for run_dir, ic in configs.items()
+        }
+        for run_dir, ic in configs.items():
+            save_idata(
+                run_dir,
+                ic,
+                prepared_datas[ic.prepared_data_dir],
+                stan_inputs[run_dir],
+                futures[run_dir],
+                profiler,
+            )
+            profiler.write_report(
+                run_dir,
+                ic.name,
+                [
+                    get_model_target(get_model_key(ic)),
+                    ic.prepared_data_dir,
+                ],
+            )
 
 
 if __name__ == "__main__":
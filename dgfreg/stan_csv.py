@@ -0,0 +1,293 @@
+"""Functions for reading Stan csv files a chunk of draws at a time.
+
+Reading a whole Stan csv file, as arviz.from_cmdstanpy does, needs memory
+proportional to chains x draws x columns. The functions here only ever hold
+one chunk of rows, so they work however big the output of a fit is.
+
+"""
+
+import math
+import re
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import zarr
+from stanio.reshape import Variable, parse_header
+from dgfreg.util import GENERATED_QUANTITY_GROUPS
+
+STAN_CSV_CHUNK_ROWS = 100
+# arviz's names for cmdstan's sampler diagnostics
+SAMPLE_STATS_NAMES = {
+    "lp__": "lp",
+    "accept_stat__": "acceptance_rate",
+    "stepsize__": "step_size",
+    "treedepth__": "tree_depth",
+    "n_leapfrog__": "n_steps",
+    "divergent__": "diverging",
+    "energy__": "energy",
+}
+
+
+def read_stan_csv_header(path: str) -> Tuple[Dict[str, str], List[str]]:
+    """Get the configuration and column names from a Stan csv file.
+
+    Only the lines before the column names are read.
+
+    :param path: path to a Stan csv file
+    """
+    config = {}
+    with open(path, "r") as f:
+        for line in f:
+            if not line.startswith("#"):
+                return config, line.strip().split(",")
+            match = re.match(r"#\s*(\w+) = (\S+)", line)
+            if match is not None:
+                config.setdefault(match[1], match[2])
+    raise ValueError(f"{path} has no column names.")
+
+
+def get_n_rows(config: Dict[str, str]) -> Tuple[int, int]:
+    """Get the number of saved warmup and sampling rows in a Stan csv file.
+
+    :param config: the configuration from read_stan_csv_header
+    """
+    thin = int(config.get("thin", 1))
+    save_warmup = config.get("save_warmup", "0") in ["1", "true"]
+    n_warmup = math.ceil(int(config["num_warmup"]) / thin) if save_warmup else 0
+    return n_warmup, math.ceil(int(config["num_samples"]) / thin)
+
+
+def iter_stan_csv_chunks(
+    path: str,
+    usecols: Sequence[int],
+    n_warmup: int,
+    chunk_rows: int = STAN_CSV_CHUNK_ROWS,
+) -> Iterator[Tuple[bool, int, np.ndarray]]:
+    """Iterate over the rows of some columns of a Stan csv file.
+
+    Yields tuples (is_warmup, start, rows), where start is the position of
+    the first row among the warmup or sampling rows.
+
+    :param path: path to a Stan csv file
+
+    :param usecols: positions of the columns to read. The yielded rows have
+    their columns in this order.
+
+    :param n_warmup: how many warmup rows the file starts with
+
+    :param chunk_rows: how many rows to read at a time
+    """
+    # pandas returns columns in file order, not usecols order
+    ranks = np.argsort(np.argsort(usecols))
+    reader = pd.read_csv(
+        path,
+        comment="#",
+        usecols=list(usecols),
+        chunksize=chunk_rows,
+        dtype=np.float64,
+    )
+    row = 0
+    with reader:
+        for chunk in reader:
+            rows = chunk.to_numpy()[:, ranks]
+            n_warmup_rows = min(max(n_warmup - row, 0), len(rows))
+            if n_warmup_rows > 0:
+                yield True, row, rows[:n_warmup_rows]
+            if n_warmup_rows < len(rows):
+                start = max(row - n_warmup, 0)
+                yield False, start, rows[n_warmup_rows:]
+            row += len(rows)
+
+
+def get_sub_variables(
+    variables: Dict[str, Variable], names: Sequence[str]
+) -> Tuple[List[int], Dict[str, Variable]]:
+    """Get the columns of some variables, and the variables within them.
+
+    :param variables: variables from stanio.reshape.parse_header
+
+    :param names: names of some of the variables
+
+    :return: the positions of the variables' columns in the csv file, and
+    copies of the variables whose positions are relative to these columns
+    """
+    usecols, sub_variables = [], {}
+    for name in names:
+        var = variables[name]
+        sub_variables[name] = Variable(
+            name=var.name,
+            start_idx=len(usecols),
+            end_idx=len(usecols) + var.num_elts(),
+            dimensions=var.dimensions,
+            type=var.type,
+            contents=var.contents,
+        )
+        usecols += list(range(var.start_idx, var.end_idx))
+    return usecols, sub_variables
+
+
+def read_stan_csv_variables(
+    csv_files: List[str],
+    names: List[str],
+    chunk_rows: int = STAN_CSV_CHUNK_ROWS,
+) -> xr.Dataset:
+    """Read some variables' sampling draws from Stan csv files.
+
+    Only the columns of the chosen variables are read, a chunk of rows at a
+    time, so the memory needed is about the size of the output.
+
+    :param csv_files: one Stan csv file per chain
+
+    :param names: names of Stan variables
+
+    :param chunk_rows: how many rows to read at a time
+    """
+    config, columns = read_stan_csv_header(csv_files[0])
+    n_warmup, n_draws = get_n_rows(config)
+    usecols, sub_variables = get_sub_variables(
+        parse_header(",".join(columns)), names
+    )
+    draws = np.empty((len(csv_files), n_draws, len(usecols)))
+    for chain, csv_file in enumerate(csv_files):
+        chunks = iter_stan_csv_chunks(csv_file, usecols, n_warmup, chunk_rows)
+        for is_warmup, start, rows in chunks:
+            if not is_warmup:
+                draws[chain, start : start + len(rows)] = rows
+    return xr.Dataset(
+        {
+            name: (
+                ["chain", "draw"]
+                + [f"{name}_dim_{i}" for i in range(len(var.dimensions))],
+                var.extract_reshape(draws),
+            )
+            for name, var in sub_variables.items()
+        },
+        coords={"chain": np.arange(len(csv_files)), "draw": np.arange(n_draws)},
+    )
+
+
+def get_group_and_name(
+    name: str, group: str, var_groups: Dict[str, str]
+) -> Tuple[str, str]:
+    """Get the InferenceData group and name of a Stan csv variable.
+
+    As in arviz, diagnostics of draws from the prior go in the group
+    'sample_stats_prior' rather than 'sample_stats'.
+    """
+    if name.endswith("__"):
+        stats_group = (
+            "sample_stats_prior" if group == "prior" else "sample_stats"
+        )
+        return stats_group, SAMPLE_STATS_NAMES.get(name, name[:-2])
+    return var_groups.get(name, group), name
+
+
+def stan_csv_to_zarr(
+    csv_files: List[str],
+    store: str,
+    group: str,
+    var_groups: Optional[Dict[str, str]] = None,
+    dims: Optional[Dict[str, List[str]]] = None,
+    coords: Optional[Dict[str, list]] = None,
+    float32: bool = False,
+    thin: Optional[int] = None,
+    inc_warmup: bool = False,
+    chunk_rows: int = STAN_CSV_CHUNK_ROWS,
+):
+    """Copy the draws in some Stan csv files to InferenceData groups in a store.
+
+    The csv files are read a chunk of rows at a time and each chunk is written
+    straight to the zarr store, so the memory needed doesn't depend on the
+    number of draws. Sampler diagnostics go in the group 'sample_stats', or
+    'sample_stats_prior' if group is 'prior', with arviz's names. Warmup draws
+    go in groups prefixed with 'warmup_' if inc_warmup is true, and are
+    otherwise dropped.
+
+    :param csv_files: one Stan csv file per chain
+
+    :param store: path to a zarr store. Existing groups are kept, but any
+    variables with the same names are overwritten.
+
+    :param group: the group for variables that aren't in var_groups, e.g.
+    'posterior'
+
+    :param var_groups: map from Stan variable names to groups, e.g. {'llik':
+    'log_likelihood'}
+
+    :param dims: map from Stan variable names to lists of dimension names
+
+    :param coords: map from dimension names to coordinates
+
+    :param float32: whether to store draws, but not sampler diagnostics, as 32
+    bit floats
+
+    :param thin: if set, only keep every thin-th draw in the groups in
+    dgfreg.util.GENERATED_QUANTITY_GROUPS
+
+    :param inc_warmup: whether to keep warmup draws
+
+    :param chunk_rows: how many rows to read and write at a time
+    """
+    var_groups, dims, coords = var_groups or {}, dims or {}, coords or {}
+    config, columns = read_stan_csv_header(csv_files[0])
+    n_warmup, n_draws = get_n_rows(config)
+    variables = parse_header(",".join(columns))
+    usecols, sub_variables = get_sub_variables(variables, list(variables))
+    root = zarr.open_group(store, mode="a")
+    arrays = {}
+    group_coords: Dict[str, dict] = {}
+    phases = {False: n_draws, True: n_warmup if inc_warmup else 0}
+    for is_warmup, n_rows in phases.items():
+        if n_rows == 0:
+            continue
+        for name, var in sub_variables.items():
+            group_name, array_name = get_group_and_name(name, group, var_groups)
+            is_draws = not group_name.startswith("sample_stats")
+            group_thin = (
+                thin
+                if thin is not None and group_name in GENERATED_QUANTITY_GROUPS
+                else 1
+            )
+            if is_warmup:
+                group_name = "warmup_" + group_name
+            var_dims = dims.get(
+                name, [f"{name}_dim_{i}" for i in range(len(var.dimensions))]
+            )
+            n_kept = math.ceil(n_rows / group_thin)
+            shape = (len(csv_files), n_kept, *var.dimensions)
+            dtype = "float32" if float32 and is_draws else "float64"
+            arrays[is_warmup, name] = group_thin, root.require_group(
+                group_name
+            ).create_array(
+                array_name,
+                shape=shape,
+                chunks=(1, min(chunk_rows, n_kept), *var.dimensions),
+                dtype=dtype,
+                fill_value=np.nan,
+                dimension_names=["chain", "draw", *var_dims],
+                overwrite=True,
+            )
+            gc = group_coords.setdefault(group_name, {})
+            gc["chain"] = np.arange(len(csv_files))
+            gc["draw"] = np.arange(n_rows)[::group_thin]
+            for dim, size in zip(var_dims, var.dimensions):
+                gc[dim] = coords.get(dim, np.arange(size))
+    for chain, csv_file in enumerate(csv_files):
+        chunks = iter_stan_csv_chunks(csv_file, usecols, n_warmup, chunk_rows)
+        for is_warmup, start, rows in chunks:
+            if is_warmup and not inc_warmup:
+                continue
+            for name, var in sub_variables.items():
+                group_thin, array = arrays[is_warmup, name]
+                first = -start % group_thin
+                values = var.extract_reshape(rows[first::group_thin])
+                if len(values) == 0:
+                    continue
+                target = (start + first) // group_thin
+                array[chain, target : target + len(values)] = values
+    for group_name, gc in group_coords.items():
+        xr.Dataset(coords=gc).to_zarr(
+            store, group=group_name, mode="a", consolidated=False
+        )
@@ -1,11 +1,53 @@
 """Functions for generating input to Stan from prepared data."""
 
 
-from typing import Dict, List
+import hashlib
+import os
+from typing import Dict, List, Optional, Tuple
 
 import numpy as np
 import pandas as pd
-from dgfreg.data_preparation import PreparedData
+from scipy.sparse import csr_matrix
+from dgfreg.data_preparation import DATA_DIR, PreparedData
+
+QR_CACHE_DIR = os.path.join(DATA_DIR, "cache", "qr")
+
+
+def get_csr(
+    long: pd.DataFrame,
+    row_col: str,
+    col_col: str,
+    row_ids: pd.Index,
+    col_ids: pd.Index,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Get Stan-style compressed sparse row arrays from a long-form matrix.
+
+    The output matches what Stan's function csr_extract would return for the
+    equivalent dense matrix, i.e. non-zero values w, 1-indexed column indices v
+    and 1-indexed row start indices u.
+
+    :param long: DataFrame with columns row_col, col_col and
+    "stoichiometric_coefficient", with one row per non-zero entry.
+
+    :param row_col: name of the column identifying rows
+
+    :param col_col: name of the column identifying columns
+
+    :param row_ids: ordered ids of the matrix's rows
+
+    :param col_ids: ordered ids of the matrix's columns
+
+    """
+    rows = pd.Categorical(long[row_col], categories=row_ids).codes
+    cols = pd.Categorical(long[col_col], categories=col_ids).codes
+    if (rows < 0).any() or (cols < 0).any():
+        raise ValueError(f"Found {row_col} or {col_col} values with no id.")
+    order = np.lexsort((cols, rows))
+    w = long["stoichiometric_coefficient"].to_numpy(dtype=float)[order]
+    v = cols[order].astype(int) + 1
+    row_counts = np.bincount(rows, minlength=len(row_ids))
+    u = np.concatenate([[1], np.cumsum(row_counts) + 1]).astype(int)
+    return w, v, u
 
 
 def get_stan_input(prepped: PreparedData) -> Dict:
@@ -38,28 +80,168 @@ def get_stan_input(prepped: PreparedData) -> Dict:
     }
 
 
-def get_stan_input_custom_holdback(prepped: PreparedData) -> Dict:
-    """Create a Stan input with a custom train/test split."""
+def get_stan_input_threaded(prepped: PreparedData, grainsize: int = 1) -> Dict:
+    """Create a Stan input for a model with a within-chain parallel likelihood.
+
+    This input suits models like new_threaded.stan, which use reduce_sum to
+    split the likelihood across the training reactions.
+
+    :param grainsize: the grainsize argument to reduce_sum. The default of 1
+    lets the scheduler choose how to split the work.
+
+    """
+    return get_stan_input(prepped) | {"grainsize": grainsize}
+
+
+def get_stan_input_sparse(prepped: PreparedData) -> Dict:
+    """Create a Stan input with S and G in compressed sparse row form.
+
+    The matrices S' (reactions x compounds) and G (compounds x groups) are
+    built directly from the long-form tables in prepped, without creating any
+    dense intermediates. Rows and columns have the same order as in the dense
+    matrices from get_stan_input. This input suits models like
+    new_sparse.stan that use csr_matrix_times_vector.
+
+    """
+    compound_ids = pd.Index(np.sort(prepped.S["compound_id"].unique()))
+    reaction_ids = pd.Index(np.sort(prepped.S["reaction_id"].unique()))
+    group_ids = pd.Index(np.sort(prepped.G["group_id"].unique()))
+    St_w, St_v, St_u = get_csr(
+        prepped.S, "reaction_id", "compound_id", reaction_ids, compound_ids
+    )
+    G_w, G_v, G_u = get_csr(
+        prepped.G, "compound_id", "group_id", compound_ids, group_ids
+    )
+    y = (
+        prepped.measurements
+        .groupby("reaction_id")
+        .agg({"y": ["mean", "count"]})
+        ["y"]
+    )
+    return {
+        "NR": len(prepped.reactions),
+        "NC": len(compound_ids),
+        "NG": len(group_ids),
+        "y": y["mean"],
+        "nobs": y["count"],
+        "N_train": len(y),
+        "N_test": len(y),
+        "ix_train": np.arange(len(y)) + 1,
+        "ix_test": np.arange(len(y)) + 1,
+        "N_St": len(St_w),
+        "St_w": St_w,
+        "St_v": St_v,
+        "St_u": St_u,
+        "N_G": len(G_w),
+        "G_w": G_w,
+        "G_v": G_v,
+        "G_u": G_u,
+    }
+
+
+def get_qr_reparameterisation(
+    SG: np.ndarray, cache_dir: Optional[str] = QR_CACHE_DIR
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Get the scaled thin QR reparameterisation of the matrix S'G.
+
+    This does the same calculation as the transformed data blocks in new.stan,
+    i.e. Qstar = qr_thin_Q(SG) * sqrt(NR - 1), Rstar = qr_thin_R(SG) /
+    sqrt(NR - 1) and Rstar_inverse = generalized_inverse(Rstar), following
+    Stan's convention that R has a non-negative diagonal.
+
+    Results are cached in cache_dir, in a file named after a hash of SG, so
+    that the decomposition is only done once for each distinct S'G.
+
+    :param SG: the NR x NG matrix S'G
+
+    :param cache_dir: directory for cached results, or None for no caching
+
+    """
+    SG = np.ascontiguousarray(SG, dtype=float)
+    cache_file = None
+    if cache_dir is not None:
+        sha = hashlib.sha256(str(SG.shape).encode())
+        sha.update(SG.data)
+        cache_file = os.path.join(cache_dir, sha.hexdigest() + ".npz")
+        if os.path.exists(cache_file):
+            with np.load(cache_file) as cached:
+                return cached["Qstar"], cached["Rstar_inverse"]
+    NR = SG.shape[0]
+    Q, R = np.linalg.qr(SG, mode="reduced")
+    signs = np.where(np.diag(R) < 0, -1.0, 1.0)
+    Qstar = Q * signs * np.sqrt(NR - 1)
+    Rstar = R * signs[:, np.newaxis] / np.sqrt(NR - 1)
+    Rstar_inverse = np.linalg.pinv(Rstar)
+    if cache_file is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_file = cache_file + f".{os.getpid()}.tmp.npz"
+        np.savez(tmp_file, Qstar=Qstar, Rstar_inverse=Rstar_inverse)
+        os.replace(tmp_file, cache_file)
+    return Qstar, Rstar_inverse
+
+
+def get_stan_input_qr(prepped: PreparedData) -> Dict:
+    """Create a Stan input including a precomputed QR reparameterisation.
+
+    This input suits models like new_qr.stan that take Qstar and Rstar_inverse
+    as data instead of computing them in transformed data.
+    """
+    full = get_stan_input(prepped)
+    Qstar, Rstar_inverse = get_qr_reparameterisation(full["S"].T @ full["G"])
+    return full | {"Qstar": Qstar, "Rstar_inverse": Rstar_inverse}
+
+
+def get_stan_input_sparse_qr(prepped: PreparedData) -> Dict:
+    """Create a sparse Stan input including a precomputed QR.
+
+    This input suits models like new_sparse_qr.stan.
+    """
+    full = get_stan_input_sparse(prepped)
+    St = csr_matrix(
+        (full["St_w"], full["St_v"] - 1, full["St_u"] - 1),
+        shape=(full["NR"], full["NC"]),
+    )
+    G = csr_matrix(
+        (full["G_w"], full["G_v"] - 1, full["G_u"] - 1),
+        shape=(full["NC"], full["NG"]),
+    )
+    Qstar, Rstar_inverse = get_qr_reparameterisation((St @ G).toarray())
+    return full | {"Qstar": Qstar, "Rstar_inverse": Rstar_inverse}
+
+
+def get_custom_holdback_ix(prepped: PreparedData, full: Dict) -> Dict:
+    """Get the train/test indexes for a custom train/test split.
+
+    :param prepped: a PreparedData object
+
+    :param full: a Stan input with all reactions in the training set
+
+    """
     excluded_compounds = [23, 70, 152]  # Acetyl CoA, PEP and G6P
     excluded_reactions = (
         prepped.S
-        .set_index(["compound_id", "reaction_id"])
-        ["stoichiometric_coefficient"]
-        .unstack()
-        .loc[excluded_compounds]
-        .replace(0, np.nan)
-        .stack()
-        .reset_index()
+        .loc[lambda df: df["compound_id"].isin(excluded_compounds)]
         ["reaction_id"]
         .unique()
     )
-    full = get_stan_input(prepped)
     ix_test = prepped.reactions.loc[
         lambda df: df["reaction_id"].isin(excluded_reactions)
     ].index + 1
     ix_train = [i for i in full["ix_train"] if i not in ix_test]
-    return full | {
+    return {
         "N_train": len(ix_train),
         "ix_train": ix_train,
     }
 
+
+def get_stan_input_custom_holdback(prepped: PreparedData) -> Dict:
+    """Create a Stan input with a custom train/test split."""
+    full = get_stan_input(prepped)
+    return full | get_custom_holdback_ix(prepped, full)
+
+
+def get_stan_input_custom_holdback_sparse(prepped: PreparedData) -> Dict:
+    """Create a sparse Stan input with a custom train/test split."""
+    full = get_stan_input_sparse(prepped)
+    return full | get_custom_holdback_ix(prepped, full)
+
@@ -3,50 +3,331 @@
 The new compounds must have known group composition (and the new reactions must
 only create and destroy such compounds).
 
+To answer many queries with the same InferenceData, make a PredictionEngine
+once and use its methods: each query is then one sparse matrix product over all
+draws. If only means, variances and quantiles are needed, the summarise methods
+give Gaussian summaries without making any per-draw arrays.
+
 """
 
+from dataclasses import dataclass
+from functools import cached_property
+from typing import Optional, Sequence, Union
+
 import numpy as np
 import pandas as pd
 import xarray as xr
 from arviz import InferenceData
+from scipy.sparse import csr_matrix, hstack, issparse, spmatrix
+from scipy.stats import norm
+from dgfreg.gaussian_approximation import LowRankPlusDiagonal
+
+Matrix = Union[pd.DataFrame, spmatrix, np.ndarray]
+
+
+def to_csr(
+    m: Matrix,
+    row_ids: Optional[Sequence] = None,
+    col_ids: Optional[Sequence] = None,
+) -> tuple[csr_matrix, pd.Index, pd.Index]:
+    """Get a sparse matrix and its row and column ids.
+
+    :param m: a DataFrame, or a scipy sparse matrix or numpy array together
+    with row_ids and col_ids. Ids given explicitly override a DataFrame's
+    index and columns.
+    """
+    if isinstance(m, pd.DataFrame):
+        row_ids = m.index if row_ids is None else row_ids
+        col_ids = m.columns if col_ids is None else col_ids
+        m = m.to_numpy(dtype=float)
+    if row_ids is None or col_ids is None:
+        raise ValueError("Row and column ids are needed for array input.")
+    out = csr_matrix(m, dtype=float) if not issparse(m) else m.tocsr()
+    return out, pd.Index(row_ids), pd.Index(col_ids)
+
+
+@dataclass
+class GaussianSummary(LowRankPlusDiagonal):
+    """A multivariate normal summary of some predicted energies.
+
+    The covariance is factor @ factor.T + L @ diag(diag) @ L.T, where L is
+    diag_loadings, or the identity if that is None, so it is never stored in
+    full. The diagonal part holds the independent deviations of compounds
+    that the model didn't see, which would otherwise need a factor column
+    each. The moments are computed by LowRankPlusDiagonal, as for a
+    LowRankGaussian.
+    """
+
+    ids: pd.Index
+
+    def cov(self) -> pd.DataFrame:
+        """Get the full covariance matrix."""
+        return pd.DataFrame(super().cov(), index=self.ids, columns=self.ids)
+
+    def quantiles(
+        self, qs: Sequence[float] = (0.01, 0.5, 0.99)
+    ) -> pd.DataFrame:
+        """Get marginal quantiles, with one column per quantile."""
+        return pd.DataFrame(
+            self.mean[:, np.newaxis] + np.outer(self.sd, norm.ppf(qs)),
+            index=self.ids,
+            columns=[f"q{q}" for q in qs],
+        )
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """Get the marginal means and standard deviations."""
+        return pd.DataFrame({"mean": self.mean, "sd": self.sd}, index=self.ids)
+
+
+class PredictionEngine:
+    """Predicts formation and reaction energies from one posterior.
+
+    The draws of dgfG, qC and tauC are extracted from the InferenceData once,
+    as arrays with one row per (chain, draw) pair. Each query is then a
+    single sparse matrix product over all draws.
+
+    Compounds that the model didn't see get a deviation from the group
+    contribution prediction drawn from N(0, tauC). Pass a seed to make these
+    draws reproducible.
+
+    :param idata: an InferenceData whose posterior has variables dgfG, qC and
+    tauC, with coordinates 'group_id' and 'compound_id'
+
+    :param seed: seed for the random number generator
+
+    :param rank: if set, the summarise methods use the top rank principal
+    components of the joint posterior of dgfG and qC. Otherwise the sample
+    covariance is used exactly.
+    """
+
+    def __init__(
+        self,
+        idata: InferenceData,
+        seed: Optional[int] = None,
+        rank: Optional[int] = None,
+    ):
+        """Initialise a PredictionEngine."""
+        posterior = idata.posterior  # type: ignore
+        self.chains = posterior.coords["chain"].values
+        self.draws = posterior.coords["draw"].values
+        self.group_ids = pd.Index(posterior.coords["group_id"].values)
+        self.compound_ids = pd.Index(posterior.coords["compound_id"].values)
+        n_samples = len(self.chains) * len(self.draws)
+        self.dgfG = (
+            posterior["dgfG"]
+            .transpose("chain", "draw", "group_id")
+            .values.reshape(n_samples, -1)
+        )
+        self.qC = (
+            posterior["qC"]
+            .transpose("chain", "draw", "compound_id")
+            .values.reshape(n_samples, -1)
+        )
+        self.tauC = posterior["tauC"].values.reshape(n_samples)
+        self.rng = np.random.default_rng(seed)
+        self.rank = rank
+
+    @cached_property
+    def moments(self) -> tuple[np.ndarray, np.ndarray, float]:
+        """Get the mean and a covariance factor of (dgfG, qC), and E[tauC^2].
+
+        The factor has one column per principal component, so its size is
+        at most (NG + NC) x samples.
+        """
+        x = np.hstack([self.dgfG, self.qC])
+        mean = x.mean(axis=0)
+        centered = (x - mean) / np.sqrt(len(x) - 1)
+        _, s, vt = np.linalg.svd(centered, full_matrices=False)
+        rank = len(s) if self.rank is None else min(self.rank, len(s))
+        factor = vt[:rank].T * s[:rank]
+        return mean, factor, float(np.mean(self.tauC**2))
+
+    def to_xarray(self, arr: np.ndarray, dim: str, ids) -> xr.DataArray:
+        """Turn a (samples, n) array into a chain x draw x dim DataArray."""
+        return xr.DataArray(
+            arr.reshape(len(self.chains), len(self.draws), -1),
+            coords={"chain": self.chains, "draw": self.draws, dim: ids},
+        )
+
+    def align(
+        self,
+        G: Matrix,
+        compound_ids: Optional[Sequence] = None,
+        group_ids: Optional[Sequence] = None,
+    ) -> tuple[csr_matrix, pd.Index, np.ndarray]:
+        """Match a query's groups and compounds to the posterior's.
+
+        See get_compound_array for the arguments.
+
+        :return: G with one column per posterior group, the compound ids and
+        each compound's position in the posterior's qC, or -1 if the model
+        didn't see it
+        """
+        G_csr, compound_ids, group_ids = to_csr(G, compound_ids, group_ids)
+        group_ix = self.group_ids.get_indexer(group_ids)
+        used_groups = np.diff(G_csr.tocsc().indptr) != 0
+        unknown = group_ids[(group_ix == -1) & used_groups]
+        assert len(unknown) == 0, f"{list(unknown)} not in coord 'group_id'."
+        G_aligned = csr_matrix(
+            (
+                G_csr.data,
+                np.where(group_ix == -1, 0, group_ix)[G_csr.indices],
+                G_csr.indptr,
+            ),
+            shape=(G_csr.shape[0], len(self.group_ids)),
+        )
+        compound_ix = self.compound_ids.get_indexer(compound_ids)
+        return G_aligned, compound_ids, compound_ix
+
+    def get_compound_array(
+        self,
+        G: Matrix,
+        compound_ids: Optional[Sequence] = None,
+        group_ids: Optional[Sequence] = None,
+    ) -> np.ndarray:
+        """Get a (samples, compounds) array of formation energy draws.
+
+        :param G: group composition of the query compounds, with one row per
+        compound and one column per group, as a DataFrame or as a sparse matrix
+        or array with compound_ids and group_ids
+
+        :param compound_ids: ids of G's rows, if G isn't a DataFrame
+
+        :param group_ids: ids of G's columns, if G isn't a DataFrame
+        """
+        G_aligned, _, compound_ix = self.align(G, compound_ids, group_ids)
+        out = (G_aligned @ self.dgfG.T).T
+        seen = compound_ix != -1
+        out[:, seen] += self.qC[:, compound_ix[seen]]
+        noise = self.rng.standard_normal((len(self.tauC), (~seen).sum()))
+        out[:, ~seen] += noise * self.tauC[:, np.newaxis]
+        return out
+
+    def get_compound_samples(
+        self,
+        G: Matrix,
+        compound_ids: Optional[Sequence] = None,
+        group_ids: Optional[Sequence] = None,
+    ) -> xr.DataArray:
+        """Get formation energy draws for the compounds in G.
+
+        See get_compound_array for the arguments.
+        """
+        _, compound_ids, _ = to_csr(G, compound_ids, group_ids)
+        arr = self.get_compound_array(G, compound_ids, group_ids)
+        return self.to_xarray(arr, "compound_id", compound_ids)
+
+    def get_reaction_samples(
+        self,
+        S: Matrix,
+        G: Matrix,
+        reaction_ids: Optional[Sequence] = None,
+        compound_ids: Optional[Sequence] = None,
+        group_ids: Optional[Sequence] = None,
+    ) -> xr.DataArray:
+        """Get reaction energy draws for the reactions in S.
+
+        :param S: stoichiometry of the query reactions, with one row per
+        compound and one column per reaction, as a DataFrame or as a sparse
+        matrix or array with compound_ids and reaction_ids
+
+        :param G: group composition of the compounds in S, in the same order,
+        as for get_compound_array
+
+        :param reaction_ids: ids of S's columns, if S isn't a DataFrame
+
+        :param compound_ids: ids of S's and G's rows, if they aren't
+        DataFrames
+
+        :param group_ids: ids of G's columns, if G isn't a DataFrame
+        """
+        S_csr, compound_ids, reaction_ids = to_csr(
+            S, compound_ids, reaction_ids
+        )
+        dgfC = self.get_compound_array(G, compound_ids, group_ids)
+        dgr = (S_csr.T @ dgfC.T).T
+        return self.to_xarray(dgr, "reaction_id", reaction_ids)
+
+    def get_compound_summary_parts(
+        self,
+        G: Matrix,
+        compound_ids: Optional[Sequence] = None,
+        group_ids: Optional[Sequence] = None,
+    ) -> tuple[pd.Index, np.ndarray, np.ndarray, np.ndarray]:
+        """Get the ids, mean, covariance factor and diagonal of some compounds.
+
+        The factor only covers the posterior of dgfG and qC. A compound that
+        the model didn't see gets its N(0, tauC) deviation as a diagonal
+        variance E[tauC^2], so the parts' size is linear in the number of
+        compounds.
+        """
+        G_aligned, compound_ids, compound_ix = self.align(
+            G, compound_ids, group_ids
+        )
+        mean, factor, tauC_sq = self.moments
+        seen = compound_ix != -1
+        Q = csr_matrix(
+            (np.ones(seen.sum()), (np.flatnonzero(seen), compound_ix[seen])),
+            shape=(len(compound_ids), len(self.compound_ids)),
+        )
+        A = hstack([G_aligned, Q]).tocsr()
+        diag = np.where(seen, 0.0, tauC_sq)
+        return compound_ids, A @ mean, A @ factor, diag
+
+    def summarise_compounds(
+        self,
+        G: Matrix,
+        compound_ids: Optional[Sequence] = None,
+        group_ids: Optional[Sequence] = None,
+    ) -> GaussianSummary:
+        """Get a Gaussian summary of the formation energies of some compounds.
+
+        See get_compound_array for the arguments.
+        """
+        return GaussianSummary(
+            *self.get_compound_summary_parts(G, compound_ids, group_ids)
+        )
+
+    def summarise_reactions(
+        self,
+        S: Matrix,
+        G: Matrix,
+        reaction_ids: Optional[Sequence] = None,
+        compound_ids: Optional[Sequence] = None,
+        group_ids: Optional[Sequence] = None,
+    ) -> GaussianSummary:
+        """Get a Gaussian summary of the energies of some reactions.
+
+        See get_reaction_samples for the arguments.
+        """
+        S_csr, compound_ids, reaction_ids = to_csr(
+            S, compound_ids, reaction_ids
+        )
+        compounds = self.summarise_compounds(G, compound_ids, group_ids)
+        return compounds.linear_map(S_csr.T.tocsr(), reaction_ids)
 
 
 def get_compound_samples(
-    idata: InferenceData, compounds: list[str], G: pd.DataFrame
+    idata: InferenceData,
+    compounds: list[str],
+    G: pd.DataFrame,
+    seed: Optional[int] = None,
 ) -> xr.DataArray:
     """Get formation energies for a list of compounds."""
     for cpd_id in compounds:
         assert cpd_id in G.index, f"{cpd_id} not in group composition matrix"
-    dgfg_samples = idata.posterior["dgfG"]  # type: ignore
-    for grp_id in G.columns:
-        assert (
-            grp_id in dgfg_samples.coords["group_id"]
-        ), f"{grp_id} not in InferenceData coord 'group_id'."
-    Gx = xr.DataArray(
-        G.values, coords={"compound_id": G.index, "group_id": G.columns}
-    )
-    gc_deviation_random = np.random.normal(
-        0,
-        scale=np.repeat(
-            idata.posterior["tauC"].values[:, :, np.newaxis],
-            len(compounds),
-            axis=2,
-        ),
-    )
-    gc_deviation = (
-        idata.posterior["qC"]
-        .reindex(compound_id=compounds)
-        .fillna(gc_deviation_random)
-    )
-    arr = Gx.loc[compounds] @ dgfg_samples.sel(group_id=G.columns)
-    return arr.transpose("chain", "draw", "compound_id") + gc_deviation
+    engine = PredictionEngine(idata, seed=seed)
+    return engine.get_compound_samples(G.loc[compounds])
 
 
 def get_reaction_samples(
-    idata: InferenceData, S: pd.DataFrame, G: pd.DataFrame
+    idata: InferenceData,
+    S: pd.DataFrame,
+    G: pd.DataFrame,
+    seed: Optional[int] = None,
 ) -> xr.DataArray:
-    dgfc_samples = get_compound_samples(idata, S.index.tolist(), G)
-    Sx = xr.DataArray(
-        S.values, coords={"compound_id": S.index, "reaction_id": S.columns}
-    )
-    return Sx.T @ dgfc_samples
+    """Get reaction energies for the reactions in a stoichiometric matrix."""
+    for cpd_id in S.index:
+        assert cpd_id in G.index, f"{cpd_id} not in group composition matrix"
+    engine = PredictionEngine(idata, seed=seed)
+    return engine.get_reaction_samples(S, G.loc[S.index])
@@ -1,12 +1,45 @@
-"""Some handy python functions."""
+"""Some handy python functions.
 
-from typing import Dict, List, NewType, Optional, Union
+pandas, arviz, xarray and zarr are only imported by the functions that use
+them, so that importing this module, e.g. to validate a configuration, is
+quick.
+
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from typing import IO, TYPE_CHECKING, Dict, List, NewType, Optional, Union
 
 import numpy as np
-import pandas as pd
+
+if TYPE_CHECKING:
+    import arviz as az
+    import pandas as pd
+    import xarray as xr
 
 CoordDict = NewType("CoordDict", Dict[str, List[str]])
 StanInputDict = Dict["str", Union[int, float, List]]
+# file names for each InferenceData output format, in order of preference
+IDATA_FILES = {
+    "netcdf": "idata.nc",
+    "zarr": "idata.zarr",
+    "json": "idata.json",
+}
+# InferenceData groups that only contain generated quantities
+GENERATED_QUANTITY_GROUPS = [
+    "prior_predictive",
+    "posterior_predictive",
+    "log_likelihood",
+]
+# InferenceData groups that are not draws
+DATA_GROUPS = ["observed_data", "constant_data", "predictions_constant_data"]
+IDATA_CHUNK_DRAWS = 100
+IDATA_COMPLEVEL = 4
 
 
 def one_encode(s: pd.Series) -> pd.Series:
@@ -15,6 +48,8 @@ def one_encode(s: pd.Series) -> pd.Series:
     :param s: a pandas Series that you want to factorise.
 
     """
+    import pandas as pd
+
     return pd.Series(pd.factorize(s)[0] + 1, index=s.index)
 
 
@@ -23,6 +58,8 @@ def make_columns_lower_case(df: pd.DataFrame) -> pd.DataFrame:
 
     :param df: a pandas DataFrame
     """
+    import pandas as pd
+
     new = df.copy()
     if isinstance(new.columns, pd.MultiIndex):
         new.columns = pd.MultiIndex.from_arrays(
@@ -38,6 +75,8 @@ def make_columns_lower_case(df: pd.DataFrame) -> pd.DataFrame:
 
 def check_is_df(maybe_df) -> pd.DataFrame:
     """Shut up the type checker."""
+    import pandas as pd
+
     assert isinstance(maybe_df, pd.DataFrame)
     return maybe_df
 
@@ -47,6 +86,8 @@ def stanify_dict(d: Dict) -> StanInputDict:
 
     :param d: input dictionary, possibly with wrong types
     """
+    import pandas as pd
+
     out: StanInputDict = {}
     for k, v in d.items():
         if not isinstance(k, str):
@@ -62,6 +103,312 @@ def stanify_dict(d: Dict) -> StanInputDict:
     return out
 
 
+def to_stan_array(v) -> Optional[np.ndarray]:
+    """Get a numeric numpy array from a Stan input value, if possible.
+
+    Returns None for values that aren't arrays, or that can't be written
+    straight from their buffer, i.e. non-numeric arrays and arrays with
+    non-finite values.
+    """
+    import pandas as pd
+
+    if isinstance(v, (pd.Series, pd.DataFrame, pd.Index)):
+        v = v.to_numpy()
+    if not isinstance(v, np.ndarray):
+        return None
+    if v.dtype == bool:
+        return v.astype(int)
+    if v.dtype.kind in "iu":
+        return v
+    if v.dtype.kind == "f" and np.isfinite(v).all():
+        return v
+    return None
+
+
+def write_array_json(arr: np.ndarray, f: IO):
+    """Write a numeric numpy array to a file as a (nested) json list.
+
+    The numbers are formatted straight from the array's buffer, so no Python
+    list is built. Integer-valued float arrays, like stoichiometric matrices,
+    are written as integers, which is much quicker and is still valid input
+    for real-valued Stan variables.
+    """
+    if arr.ndim == 0:
+        f.write(repr(arr.item()))
+        return
+    is_integer_valued = (
+        arr.dtype.kind == "f"
+        and (np.abs(arr) < 2 ** 53).all()
+        and (arr == np.trunc(arr)).all()
+    )
+    if is_integer_valued:
+        arr = arr.astype(np.int64)
+    f.write("[")
+    if arr.ndim > 2:
+        for i, sub in enumerate(arr):
+            if i > 0:
+                f.write(",")
+            write_array_json(sub, f)
+    elif arr.size == 0:
+        f.write(",".join(["[]"] * arr.shape[0]) if arr.ndim > 1 else "")
+    elif arr.dtype.kind == "f":
+        # each row of a 2d array ends with newline, so use it to close the row
+        # and open the next one
+        rows = arr.reshape(-1, arr.shape[-1])
+        ends = ("", "") if arr.ndim == 1 else ("[", "]")
+        f.write(ends[0])
+        np.savetxt(
+            f, rows[:-1], fmt="%.17g", delimiter=",", newline="],["
+        )
+        np.savetxt(f, rows[-1:], fmt="%.17g", delimiter=",", newline="")
+        f.write(ends[1])
+    elif arr.ndim == 1:
+        f.flush()
+        arr.tofile(f, sep=",")
+    else:
+        for i, row in enumerate(arr):
+            f.write(",[" if i > 0 else "[")
+            f.flush()
+            row.tofile(f, sep=",")
+            f.write("]")
+    f.write("]")
+
+
+def write_stan_json(d: Dict, path: str):
+    """Write a Stan input dictionary to a json file.
+
+    This is equivalent to writing the output of stanify_dict with json.dump,
+    but numeric arrays, Series and DataFrames are streamed from their buffers
+    instead of being converted to Python lists.
+
+    :param d: Stan input dictionary, possibly with numpy or pandas values
+
+    :param path: where to write the json file
+    """
+    with open(path, "w") as f:
+        f.write("{")
+        for i, (k, v) in enumerate(d.items()):
+            if not isinstance(k, str):
+                raise ValueError(f"key {str(k)} is not a string!")
+            f.write(("," if i > 0 else "") + json.dumps(k) + ":")
+            arr = to_stan_array(v)
+            if arr is not None:
+                write_array_json(arr, f)
+            else:
+                json.dump(stanify_dict({k: v})[k], f, default=to_json_default)
+        f.write("}")
+
+
+def to_json_default(o):
+    """Convert numpy scalars and arrays for json.dump."""
+    if isinstance(o, (np.generic, np.ndarray)):
+        return o.tolist()
+    raise TypeError(f"Object of type {type(o)} is not JSON serializable")
+
+
+def get_stan_input_hash(d: Dict) -> str:
+    """Get a hash of a Stan input dictionary's contents.
+
+    Numeric arrays are hashed from their buffers, without converting them to
+    Python objects.
+    """
+    sha = hashlib.sha256()
+    for k, v in d.items():
+        sha.update(str(k).encode())
+        arr = to_stan_array(v)
+        if arr is not None:
+            arr = np.ascontiguousarray(arr)
+            sha.update(f"{arr.dtype.str}{arr.shape}".encode())
+            sha.update(arr.data)
+        else:
+            sha.update(
+                json.dumps(stanify_dict({k: v})[k], default=to_json_default)
+                .encode()
+            )
+    return sha.hexdigest()
+
+
+def get_stan_input_file(d: Dict, directory: str) -> str:
+    """Get a json file with a Stan input, writing it only if necessary.
+
+    Files are named after a hash of the input, so fits with the same input,
+    e.g. the chains of one run or repeated runs of the same fold, share one
+    file.
+
+    :param d: Stan input dictionary, possibly with numpy or pandas values
+
+    :param directory: where to keep the json files, e.g. a temporary
+    directory that is removed at the end of the run
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, get_stan_input_hash(d) + ".json")
+    if not os.path.exists(path):
+        # write to a temporary file first so that concurrent fits never see a
+        # partly written input
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".json.tmp")
+        os.close(fd)
+        write_stan_json(d, tmp_path)
+        os.replace(tmp_path, path)
+    return path
+
+
+def compact_idata(
+    idata: az.InferenceData, float32: bool = False, thin: Optional[int] = None
+) -> az.InferenceData:
+    """Make an InferenceData smaller before saving it.
+
+    :param idata: an InferenceData
+
+    :param float32: whether to store draws as 32 bit floats
+
+    :param thin: if set, only keep every thin-th draw in the groups in
+    GENERATED_QUANTITY_GROUPS
+    """
+    import arviz as az
+
+    groups = {}
+    for group in idata.groups():
+        ds = idata[group]
+        if thin is not None and group in GENERATED_QUANTITY_GROUPS:
+            ds = ds.isel(draw=slice(None, None, thin))
+        if float32 and group not in DATA_GROUPS:
+            ds = ds.map(
+                lambda v: v.astype("float32") if v.dtype == "float64" else v,
+                keep_attrs=True,
+            )
+        groups[group] = ds
+    return az.InferenceData(**groups)
+
+
+def get_idata_encoding(ds: xr.Dataset, output_format: str) -> dict:
+    """Get chunked, compressed encodings for a dataset's draws.
+
+    Chunks hold IDATA_CHUNK_DRAWS draws of one chain, so reading a few
+    variables or a few draws doesn't mean reading the whole file.
+    """
+    encoding = {}
+    for name, v in ds.data_vars.items():
+        if v.dtype.kind not in "fiub":
+            continue
+        chunks = tuple(
+            min(IDATA_CHUNK_DRAWS, size) if dim == "draw"
+            else 1 if dim == "chain"
+            else size
+            for dim, size in v.sizes.items()
+        )
+        if output_format == "netcdf":
+            encoding[name] = {"zlib": True, "complevel": IDATA_COMPLEVEL}
+            if len(chunks) > 0 and all(c > 0 for c in chunks):
+                encoding[name]["chunksizes"] = chunks
+        elif len(chunks) > 0:
+            encoding[name] = {"chunks": tuple(max(c, 1) for c in chunks)}
+    return encoding
+
+
+def append_idata_zarr(idata: az.InferenceData, store: str):
+    """Add an InferenceData's groups to a zarr store, chunked and compressed.
+
+    Existing groups that aren't in the InferenceData are kept.
+    """
+    import zarr
+
+    for group in idata.groups():
+        ds = idata[group]
+        ds.to_zarr(
+            store,
+            mode="a",
+            group=group,
+            encoding=get_idata_encoding(ds, "zarr"),
+            consolidated=False,
+        )
+    zarr.consolidate_metadata(store)
+
+
+def remove_saved_idata(directory: str):
+    """Remove any InferenceData saved in a directory, in any format."""
+    for file_name in IDATA_FILES.values():
+        path = os.path.join(directory, file_name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+
+def write_idata(
+    idata: az.InferenceData,
+    directory: str,
+    output_format: str = "json",
+    float32: bool = False,
+    thin: Optional[int] = None,
+) -> str:
+    """Save an InferenceData in a directory, returning the path.
+
+    Any previously saved InferenceData is removed, so that load_idata never
+    finds a stale file.
+
+    :param idata: an InferenceData
+
+    :param directory: where to save it
+
+    :param output_format: a key of IDATA_FILES. The netcdf and zarr formats
+    are chunked and compressed, and can be loaded lazily.
+
+    :param float32: whether to store draws as 32 bit floats
+
+    :param thin: if set, only keep every thin-th draw of the groups in
+    GENERATED_QUANTITY_GROUPS
+    """
+    path = os.path.join(directory, IDATA_FILES[output_format])
+    remove_saved_idata(directory)
+    idata = compact_idata(idata, float32=float32, thin=thin)
+    if output_format == "json":
+        idata.to_json(path)
+    elif output_format == "netcdf":
+        mode = "w"
+        for group in idata.groups():
+            ds = idata[group]
+            ds.to_netcdf(
+                path,
+                mode=mode,
+                group=group,
+                engine="h5netcdf",
+                encoding=get_idata_encoding(ds, output_format),
+            )
+            mode = "a"
+    elif output_format == "zarr":
+        append_idata_zarr(idata, path)
+    else:
+        raise ValueError(
+            f"{output_format} is not one of {list(IDATA_FILES.keys())}."
+        )
+    return path
+
+
+def load_idata(directory: str) -> az.InferenceData:
+    """Load the InferenceData saved in a directory.
+
+    NetCDF and zarr files are loaded lazily, so only the variables that are
+    used are read from disk.
+
+    :param directory: a directory where write_idata has saved an InferenceData
+    """
+    import arviz as az
+    import xarray as xr
+
+    for output_format, file_name in IDATA_FILES.items():
+        path = os.path.join(directory, file_name)
+        if not os.path.exists(path):
+            continue
+        if output_format == "netcdf":
+            return az.from_netcdf(path)
+        elif output_format == "zarr":
+            tree = xr.open_datatree(path, engine="zarr")
+            return az.InferenceData.from_datatree(tree)
+        else:
+            return az.from_json(path)
+    raise FileNotFoundError(f"No InferenceData found in {directory}.")
+
+
 def standardise(
     s: pd.Series, mu: Optional[float] = None, std: Optional[float] = None
 ) -> pd.Series:
@@ -0,0 +1,47 @@
+"""Fixtures shared between unit tests."""
+
+import pandas as pd
+import pytest
+from dgfreg.data_preparation import PreparedData
+
+
+@pytest.fixture
+def prepped() -> PreparedData:
+    """A small PreparedData object."""
+    S = pd.DataFrame(
+        {
+            "compound_id": [1, 2, 2, 3, 1, 3],
+            "reaction_id": [1, 1, 2, 2, 3, 3],
+            "stoichiometric_coefficient": [-1.0, 1.0, -2.0, 1.0, 1.0, -1.0],
+        }
+    )
+    G = pd.DataFrame(
+        {
+            "compound_id": [1, 2, 2, 3],
+            "group_id": ["b", "a", "b", "c"],
+            "stoichiometric_coefficient": [1.0, 2.0, 1.0, 1.0],
+        }
+    )
+    measurements = pd.DataFrame(
+        {"reaction_id": [1, 1, 2, 3], "y": [1.0, 2.0, 3.0, 4.0]}
+    )
+    reactions = pd.DataFrame(
+        {"reaction_id": [1, 2, 3], "is_e_coli_ccm": [True, False, False]}
+    )
+    compounds = pd.DataFrame(
+        {"compound_id": [1, 2, 3], "is_e_coli_ccm": [True, False, False]}
+    )
+    return PreparedData(
+        name="test",
+        coords={
+            "compound_id": ["1", "2", "3"],
+            "group_id": ["a", "b", "c"],
+            "measurement_id": ["1", "2", "3", "4"],
+            "reaction_id": ["1", "2", "3"],
+        },
+        measurements=measurements,
+        reactions=reactions,
+        S=S,
+        G=G,
+        compounds=compounds,
+    )
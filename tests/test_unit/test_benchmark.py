@@ -0,0 +1,86 @@
+"""Unit tests for functions in src/benchmark."""
+
+import json
+import os
+
+import numpy as np
+from dgfreg import model_cache
+from dgfreg.benchmark.run import (
+    run_benchmark,
+    sample_reactions,
+    save_idata,
+    write_results,
+)
+from dgfreg.benchmark.synthetic import (
+    SyntheticNetworkConfig,
+    generate_synthetic_data,
+)
+from dgfreg.data_preparation import prepare_data_equilibrator
+from dgfreg.fitting_mode import fit_collapsed
+from dgfreg.stan_input_functions import get_stan_input
+
+CONFIG = SyntheticNetworkConfig(
+    n_compound=20, n_reaction=40, n_group=6, sigma=1e-6, seed=0
+)
+
+
+def test_generate_synthetic_data():
+    """Check that synthetic data is prepared with the configured sizes."""
+    synthetic = generate_synthetic_data(CONFIG)
+    prepped = prepare_data_equilibrator(**synthetic.raw_data)
+    stan_input = get_stan_input(prepped)
+    assert (stan_input["NC"], stan_input["NR"], stan_input["NG"]) == (20, 40, 6)
+    assert stan_input["G"].shape == (20, 6)
+    dgr = synthetic.parameters["S"].T @ synthetic.parameters["dgfC"]
+    np.testing.assert_allclose(stan_input["y"], dgr, atol=1e-4)
+
+
+def test_run_benchmark(tmp_path):
+    """Check that unselected stages are skipped and results are written."""
+    stages = ["prepare_data_equilibrator", "get_stan_input", "stanify_dict"]
+    results = run_benchmark(CONFIG, stages=stages, trace_memory=False)
+    assert [r.status for r in results[:3]] == ["ok"] * 3
+    assert all(r.status == "skipped" for r in results[3:])
+    path = tmp_path / "results.jsonl"
+    write_results(results, CONFIG, {}, str(path))
+    write_results(results, CONFIG, {}, str(path))
+    records = [json.loads(line) for line in path.read_text().splitlines()]
+    assert len(records) == 2
+    assert records[0]["config"]["n_compound"] == 20
+    assert records[0]["stages"][0]["stage"] == "prepare_data_equilibrator"
+
+
+def test_idata_stages(tmp_path):
+    """Check the stages after fitting, using a fit that doesn't need Stan."""
+    prepped = prepare_data_equilibrator(
+        **generate_synthetic_data(CONFIG).raw_data
+    )
+    stan_input = get_stan_input(prepped)
+    fit = fit_collapsed(
+        None, stan_input, {"chains": 1, "iter_sampling": 5, "n_grid": 3}
+    )
+    idata = save_idata(fit, stan_input, prepped, str(tmp_path))
+    assert (tmp_path / "idata.json").exists()
+    reaction_samples = sample_reactions(idata, prepped)
+    assert reaction_samples.shape == (1, 5, 40)
+
+
+def test_compile_stage_uses_model_cache(tmp_path, monkeypatch):
+    """Check that the compile stage gets its model from the model cache."""
+
+    class FakeCmdStanModel:
+        """Stands in for CmdStanModel, 'compiling' by writing the executable."""
+
+        def __init__(self, stan_file, exe_file=None, **kwargs):
+            if exe_file is None:
+                exe_file = os.path.splitext(stan_file)[0]
+                with open(exe_file, "w") as f:
+                    f.write("binary")
+            self.exe_file = exe_file
+
+    monkeypatch.setattr(model_cache.cmdstanpy, "CmdStanModel", FakeCmdStanModel)
+    monkeypatch.setattr(model_cache, "get_cmdstan_version", lambda: "2.36")
+    monkeypatch.setenv(model_cache.MODEL_CACHE_DIR_VARIABLE, str(tmp_path))
+    results = run_benchmark(CONFIG, stages=["compile"], trace_memory=False)
+    assert [r.status for r in results if r.stage == "compile"] == ["ok"]
+    assert len(os.listdir(tmp_path)) == 1
@@ -0,0 +1,103 @@
+"""Unit tests for functions in src/cli.py."""
+
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+from dgfreg.cli import main
+from dgfreg.gaussian_approximation import LowRankGaussian
+
+HERE = os.path.dirname(__file__)
+CONFIG = os.path.join(
+    HERE, "..", "..", "inferences", "equilibrator_component", "config.toml"
+)
+HEAVY_MODULES = ["arviz", "xarray", "cmdstanpy", "sklearn", "pandas"]
+
+
+def test_validate_config(tmp_path, capsys):
+    """Check that bad configurations are reported and fail the command."""
+    assert main(["validate-config", CONFIG]) == 0
+    bad = tmp_path / "config.toml"
+    with open(CONFIG) as f:
+        bad.write_text(f.read().replace('"get_stan_input"', '"get_stn_input"'))
+    assert main(["validate-config", CONFIG, str(bad)]) == 1
+    out = capsys.readouterr().out
+    assert f"{CONFIG}: ok" in out
+    assert "get_stn_input is not a function" in out
+
+
+def test_predict(tmp_path):
+    """Check predictions against the dense covariance."""
+    rng = np.random.default_rng(0)
+    eigenvectors = np.linalg.qr(rng.normal(size=(4, 2)))[0]
+    approximation = LowRankGaussian(
+        ids=np.array(["a", "b", "c", "d"]),
+        mean=rng.normal(size=4),
+        eigenvectors=eigenvectors,
+        eigenvalues=np.array([2.0, 0.5]),
+        residual=np.array([0.1, 0.2, 0.0, 0.3]),
+    )
+    approximation.save(tmp_path / "approximation.npz")
+    pd.DataFrame(
+        {
+            "reaction_id": ["r1", "r1", "r2", "r2", "r2"],
+            "compound_id": ["a", "b", "b", "c", "d"],
+            "stoichiometric_coefficient": [-1, 1, -2, 1, 1],
+        }
+    ).to_csv(tmp_path / "reactions.csv", index=False)
+    status = main(
+        [
+            "predict",
+            str(tmp_path / "approximation.npz"),
+            str(tmp_path / "reactions.csv"),
+            "--output",
+            str(tmp_path / "predictions.csv"),
+        ]
+    )
+    assert status == 0
+    predictions = pd.read_csv(tmp_path / "predictions.csv")
+    S_t = np.array([[-1, 1, 0, 0], [0, -2, 1, 1]])
+    assert predictions["reaction_id"].tolist() == ["r1", "r2"]
+    np.testing.assert_allclose(
+        predictions["mean"], S_t @ approximation.mean, rtol=1e-12
+    )
+    np.testing.assert_allclose(
+        predictions["sd"],
+        np.sqrt(np.diag(S_t @ approximation.cov() @ S_t.T)),
+        rtol=1e-12,
+    )
+    pd.DataFrame(
+        {
+            "reaction_id": ["r1"],
+            "compound_id": ["x"],
+            "stoichiometric_coefficient": [1],
+        }
+    ).to_csv(tmp_path / "unknown.csv", index=False)
+    with pytest.raises(ValueError):
+        main(
+            [
+                "predict",
+                str(tmp_path / "approximation.npz"),
+                str(tmp_path / "unknown.csv"),
+            ]
+        )
+
+
+def test_validate_config_imports_are_light():
+    """Check that validating a configuration doesn't import heavy modules."""
+    code = (
+        "import sys\n"
+        "from dgfreg.cli import main\n"
+        f"main(['validate-config', {CONFIG!r}])\n"
+        f"print([m for m in {HEAVY_MODULES!r} if m in sys.modules])\n"
+    )
+    out = subprocess.run(
+        [sys.executable, "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    assert out.splitlines()[-1] == "[]"
@@ -0,0 +1,126 @@
+"""Unit tests for functions in src/collapsed.py."""
+
+import os
+import re
+
+import arviz as az
+import numpy as np
+import pytest
+from scipy import stats
+from dgfreg import collapsed
+from dgfreg.collapsed import get_collapsed_model, get_conditional_posterior
+from dgfreg.fitting_mode import (
+    COLLAPSED_STAN_FILES,
+    fit_collapsed,
+    fit_kfold_collapsed,
+)
+from dgfreg.inference_configuration import STAN_DIR
+
+PRIOR_PATTERN = re.compile(
+    r"^\s*(\w+)\s*~\s*normal\(\s*([-\d.]+)\s*,\s*([-\d.]+)\s*\)\s*;", re.M
+)
+
+
+@pytest.fixture
+def input_dict() -> dict:
+    """A small Stan input for new.stan, simulated from its model."""
+    rng = np.random.default_rng(0)
+    NC, NR, NG = 6, 15, 3
+    S = rng.integers(-1, 2, size=(NC, NR)).astype(float)
+    G = rng.integers(0, 3, size=(NC, NG)).astype(float)
+    dgfC = G @ rng.normal(-5, 10, size=NG) + rng.normal(0, 0.5, size=NC)
+    nobs = rng.integers(1, 4, size=NR)
+    y = S.T @ dgfC + rng.normal(0, 1 / np.sqrt(nobs))
+    return {
+        "NR": NR,
+        "NC": NC,
+        "NG": NG,
+        "S": S,
+        "G": G,
+        "y": y,
+        "nobs": nobs,
+        "N_train": 12,
+        "N_test": 3,
+        "ix_train": np.arange(1, 13),
+        "ix_test": np.arange(13, 16),
+    }
+
+
+def test_get_conditional_posterior(input_dict):
+    """Check the conditional posterior against the dense formulas."""
+    model = get_collapsed_model(input_dict)
+    tauC, sigma = 0.7, 1.3
+    L, mean, log_marginal = get_conditional_posterior(model, tauC, sigma)
+    ix = model.ix_train
+    X = np.hstack([model.SG[ix] @ model.B, model.St[ix]])
+    m0, v0 = model.prior_mean, model.get_prior_variance(tauC)
+    noise = np.diag(sigma**2 / model.nobs[ix])
+    expected = stats.multivariate_normal.logpdf(
+        model.y[ix], X @ m0, X @ np.diag(v0) @ X.T + noise
+    )
+    np.testing.assert_allclose(log_marginal, expected)
+    cov = np.linalg.inv(np.diag(1 / v0) + X.T @ np.linalg.inv(noise) @ X)
+    np.testing.assert_allclose(np.linalg.inv(L @ L.T), cov, rtol=1e-6)
+    expected_mean = cov @ (m0 / v0 + X.T @ np.linalg.inv(noise) @ model.y[ix])
+    np.testing.assert_allclose(mean, expected_mean, rtol=1e-6)
+
+
+def test_fit_collapsed(input_dict):
+    """Check that the collapsed fit looks like a fit of new.stan."""
+    fit = fit_collapsed(
+        None,
+        input_dict,
+        {"chains": 2, "iter_sampling": 50, "seed": 1, "n_grid": 5},
+    )
+    idata = az.from_cmdstanpy(
+        posterior=fit,
+        log_likelihood="llik",
+        posterior_predictive="yrep",
+        dims={"dgfC": ["compound_id"], "dgr": ["reaction_id"]},
+    )
+    assert set(idata.posterior.data_vars) == {
+        "qC",
+        "qG",
+        "tauC",
+        "sigma",
+        "dgfG",
+        "dgfC",
+        "dgr",
+        "mae",
+    }
+    assert dict(idata.posterior.sizes)["chain"] == 2
+    assert idata.posterior["dgr"].shape == (2, 50, 15)
+    assert idata.log_likelihood["llik"].shape == (2, 50, 3)
+    model = get_collapsed_model(input_dict)
+    np.testing.assert_allclose(
+        idata.posterior["dgfG"].values @ model.Rstar.T,
+        idata.posterior["qG"].values,
+    )
+    dgr = idata.posterior["dgr"].mean(("chain", "draw")).values
+    np.testing.assert_allclose(dgr, input_dict["y"], atol=3)
+
+
+def test_fit_kfold_collapsed(input_dict):
+    """Check that collapsed kfold gives each reaction's llik once."""
+    llik = fit_kfold_collapsed(
+        None,
+        input_dict | {"ix_train": np.arange(1, 16)},
+        {"n_folds": 3, "chains": 1, "iter_sampling": 10, "n_grid": 3},
+    )
+    assert llik.shape == (1, 10, 15)
+    assert sorted(llik["fold"].values.tolist()) == sorted([0, 1, 2] * 5)
+
+
+@pytest.mark.parametrize("stan_file", COLLAPSED_STAN_FILES)
+def test_priors_match_stan_file(stan_file: str):
+    """Check that the collapsed posterior's priors are the Stan model's."""
+    with open(os.path.join(STAN_DIR, stan_file)) as f:
+        priors = {
+            name: (float(mean), float(sd))
+            for name, mean, sd in PRIOR_PATTERN.findall(f.read())
+        }
+    assert priors == {
+        "dgfG": (collapsed.DGFG_PRIOR_MEAN, collapsed.DGFG_PRIOR_SD),
+        "tauC": (0.0, collapsed.TAUC_PRIOR_SD),
+        "sigma": (0.0, collapsed.SIGMA_PRIOR_SD),
+    }
@@ -0,0 +1,124 @@
+"""Unit tests for functions in src/component_contribution_replication.py."""
+
+import numpy as np
+import pandas as pd
+import pytest
+from dgfreg.component_contribution_replication import (
+    fit_component_contribution,
+    replicate_component_contribution,
+)
+
+
+def invert_project(A, eps=1e-10):
+    """Component contribution's LINALG.invert_project."""
+    U, s, V_H = np.linalg.svd(A, full_matrices=True)
+    r = int((s > eps).sum())
+    inv_A = V_H[:r].T @ np.diag(1 / s[:r]) @ U[:, :r].T
+    return inv_A, r, U[:, :r] @ U[:, :r].T, U[:, r:] @ U[:, r:].T
+
+
+def fit_reference(S, G, b):
+    """Component contribution's trainer, without weights."""
+    GS = G.T @ S
+    inv_S, r_rc, P_R_rc, P_N_rc = invert_project(S)
+    inv_GS, r_gc, _, P_N_gc = invert_project(GS)
+    dG0_gc = inv_GS.T @ b
+    dG0_rc = inv_S.T @ b
+    dG0_cc = P_R_rc @ dG0_rc + P_N_rc @ G @ dG0_gc
+    e_rc = S.T @ dG0_rc - b
+    MSE_rc = (e_rc @ e_rc) / (S.shape[1] - r_rc)
+    e_gc = GS.T @ dG0_gc - b
+    MSE_gc = (e_gc @ e_gc) / (S.shape[1] - r_gc)
+    e_kerG = e_gc[np.all(GS == 0, 0)]
+    MSE_kerG = (e_kerG @ e_kerG) / len(e_kerG)
+    inv_SWS = invert_project(S @ S.T)[0]
+    inv_GSWGS = invert_project(GS @ GS.T)[0]
+    V_rc = P_R_rc @ inv_SWS @ P_R_rc
+    V_gc = P_N_rc @ G @ inv_GSWGS @ G.T @ P_N_rc
+    V_inf = P_N_rc @ G @ P_N_gc @ G.T @ P_N_rc
+    return dG0_cc, MSE_rc * V_rc + MSE_gc * V_gc + MSE_kerG * V_inf
+
+
+@pytest.fixture
+def cc_data():
+    """A small network with a rare compound and reactions in ker(G)."""
+    rng = np.random.default_rng(0)
+    n_compound, n_reaction = 9, 30
+    S = rng.integers(-2, 3, size=(n_compound, n_reaction)).astype(float)
+    # compound 8 is only in reaction 0
+    S[8] = 0
+    S[8, 0] = 1
+    # compounds 6 and 7 have the same groups, so reactions 1 and 2 are in ker(G)
+    S[:, 1:3] = 0
+    S[6, 1:3], S[7, 1:3] = 1, -1
+    G = rng.integers(0, 3, size=(n_compound, 4)).astype(float)
+    G[7] = G[6]
+    compound_ids = [str(i) for i in range(n_compound)]
+    reaction_ids = [str(i) for i in range(n_reaction)]
+    return (
+        pd.DataFrame(S, index=compound_ids, columns=reaction_ids),
+        pd.DataFrame(G, index=compound_ids),
+        pd.DataFrame({"y": rng.normal(size=n_reaction)}, index=reaction_ids),
+    )
+
+
+def test_fit_component_contribution(cc_data):
+    """Check that the fit matches component contribution's trainer."""
+    S, G, measurements = cc_data
+    fit = fit_component_contribution(S, G, measurements)
+    mu, cov = fit_reference(S.values, G.values, measurements["y"].values)
+    np.testing.assert_allclose(fit.mu_dgf, mu, atol=1e-8)
+    np.testing.assert_allclose(fit.cov_dgf, cov, atol=1e-8)
+
+
+def test_replicate_component_contribution(cc_data):
+    """Check that downdated parallel folds match refitting each fold."""
+    S, G, measurements = cc_data
+    n_reaction = S.shape[1]
+    # the first split removes the rare compound's reaction, so S loses rank
+    splits = [
+        [[i for i in range(n_reaction) if i not in test], test]
+        for test in [[0], [3], [4, 5, 6], [10, 20]]
+    ]
+    serial = replicate_component_contribution(S, G, measurements, splits)
+    downdated = replicate_component_contribution(
+        S, G, measurements, splits, n_workers=2, downdate=True
+    )
+    for (ix_train, _), fit_a, fit_b in zip(
+        splits, serial.fits_cv, downdated.fits_cv
+    ):
+        mu, cov = fit_reference(
+            S.values[:, ix_train],
+            G.values,
+            measurements["y"].values[ix_train],
+        )
+        np.testing.assert_allclose(fit_a.mu_dgf, mu, atol=1e-8)
+        np.testing.assert_allclose(fit_b.mu_dgf, mu, atol=1e-8)
+        np.testing.assert_allclose(fit_b.cov_dgf, cov, atol=1e-8)
+
+
+def test_fit_component_contribution_cov_options(cc_data):
+    """Check point estimates only and restricted covariances."""
+    S, G, measurements = cc_data
+    full = fit_component_contribution(S, G, measurements)
+    point = fit_component_contribution(S, G, measurements, return_cov=False)
+    assert point.cov_dgf is None
+    np.testing.assert_allclose(point.mu_dgf, full.mu_dgf)
+    subset = ["7", "2", "5"]
+    restricted = fit_component_contribution(
+        S, G, measurements, cov_compounds=subset
+    )
+    pd.testing.assert_frame_equal(
+        restricted.cov_dgf, full.cov_dgf.loc[subset, subset]
+    )
+    with pytest.raises(ValueError):
+        fit_component_contribution(S, G, measurements, cov_compounds=["x"])
+    replication = replicate_component_contribution(
+        S,
+        G,
+        measurements,
+        [[list(range(1, S.shape[1])), [0]]],
+        cov_compounds_cv=subset,
+    )
+    assert replication.fits_cv[0].cov_dgf.shape == (3, 3)
+    assert replication.fit.cov_dgf.shape == (9, 9)
@@ -0,0 +1,195 @@
+"""Unit tests for functions in src/data_preparation.py."""
+
+import os
+
+import pandas as pd
+import pytest
+from pandas.testing import assert_frame_equal
+from dgfreg import data_preparation
+from dgfreg.data_preparation import (
+    PREPARED_TABLES,
+    PreparedData,
+    get_reaction_keys,
+    load_prepared_data,
+    prepare_data_equilibrator,
+    prepare_data_equilibrator_incremental,
+    write_prepared_data,
+)
+
+
+@pytest.mark.parametrize("file_format", ["arrow", "csv"])
+def test_prepared_data_round_trip(
+    prepped: PreparedData, tmp_path, file_format: str
+):
+    """Check that prepared data is the same after writing and loading."""
+    directory = os.path.join(tmp_path, "prepared")
+    write_prepared_data(prepped, directory, file_format=file_format)
+    loaded = load_prepared_data(directory)
+    assert loaded.name == prepped.name
+    assert loaded.coords == prepped.coords
+    for table in PREPARED_TABLES:
+        assert_frame_equal(getattr(loaded, table), getattr(prepped, table))
+
+
+def test_write_prepared_data_removes_other_format(
+    prepped: PreparedData, tmp_path
+):
+    """Check that stale files of the other format are removed."""
+    directory = os.path.join(tmp_path, "prepared")
+    write_prepared_data(prepped, directory, file_format="csv")
+    write_prepared_data(prepped, directory, file_format="arrow")
+    files = os.listdir(directory)
+    assert not any(f.endswith(".csv") for f in files)
+    assert all(f"{table}.arrow" in files for table in PREPARED_TABLES)
+
+
+def get_raw_data(n_measurements: int) -> dict:
+    """Get some raw data with the first n_measurements measurements."""
+    S = pd.DataFrame(
+        {
+            "compound_cc_id": [1, 2, 3],
+            "0": [-1.0, 1.0, 0.0],
+            "1": [0.0, -1.0, 1.0],
+            "2": [-1.0, 1.0, 0.0],
+            "3": [-1.0, 0.0, 1.0],
+            "4": [0.0, -1.0, 1.0],
+            "5": [-2.0, 0.0, 1.0],
+        }
+    )
+    ids = list(range(n_measurements))
+    return {
+        "e_coli_ccm_metabolites": pd.DataFrame({"inchi_key": ["A"]}),
+        "e_coli_ccm_reactions": pd.DataFrame({"ec-code": ["1.1.1.1"]}),
+        "equilibrator_group_decomposition": pd.DataFrame(
+            {
+                "compound_cc_id": [1, 2, 3],
+                "g1": [1.0, 0.0, 2.0],
+                "g2": [0.0, 1.0, 1.0],
+            }
+        ),
+        "equilibrator_stoichiometries": S[
+            ["compound_cc_id"] + [str(i) for i in ids]
+        ],
+        "equilibrator_compounds": pd.DataFrame(
+            {"inchi_key": ["A", "B", "C"], "cc_id": [1, 2, 3]}
+        ),
+        "equilibrator_reactions": pd.DataFrame(
+            {
+                "Unnamed: 0": ids,
+                "description": [f"r{i}" for i in ids],
+                "standard_dg(kilojoule / mole)": [float(i) for i in ids],
+                "is_formation": [False] * n_measurements,
+            }
+        ),
+        "equilibrator_tecr": pd.DataFrame(
+            {
+                "reference": [f"ref{i}" for i in ids],
+                "method": ["spectrophotometry"] * n_measurements,
+                "eval": ["A"] * n_measurements,
+                "EC": [
+                    "1.1.1.1",
+                    "2.2.2.2",
+                    "1.1.1.1",
+                    "3.3.3.3",
+                    "2.2.2.2",
+                    "4.4.4.4",
+                ][:n_measurements],
+                "reaction": [f"kegg:r{i}" for i in ids],
+                "description": [f"r{i}" for i in ids],
+                "temperature": [298.15] * n_measurements,
+                "ionic_strength": [0.1] * n_measurements,
+                "p_h": [7.0] * n_measurements,
+                "p_mg": [3.0] * n_measurements,
+            }
+        ),
+    }
+
+
+def test_prepare_data_equilibrator_incremental():
+    """Check that incremental and full data preparation agree."""
+    full = prepare_data_equilibrator(**get_raw_data(6))
+    previous = prepare_data_equilibrator(**get_raw_data(3))
+    incremental = prepare_data_equilibrator_incremental(
+        previous, **get_raw_data(6)
+    )
+    assert incremental.coords == full.coords
+    for table, sort_cols in [
+        ("measurements", ["measurement_id"]),
+        ("reactions", ["reaction_id"]),
+        ("S", ["reaction_id", "compound_id"]),
+    ]:
+        assert_frame_equal(
+            getattr(incremental, table)
+            .sort_values(sort_cols)
+            .reset_index(drop=True),
+            getattr(full, table).sort_values(sort_cols).reset_index(drop=True),
+        )
+
+
+def test_prepare_data_skips_unchanged_raw_data(tmp_path, monkeypatch, capsys):
+    """Check that prepare_data only reruns when the raw data changes."""
+    raw_files = {k: os.path.join(tmp_path, k + ".csv") for k in get_raw_data(3)}
+    prepared_dir = os.path.join(tmp_path, "prepared")
+    monkeypatch.setattr(data_preparation, "RAW_DATA_FILES", raw_files)
+    monkeypatch.setattr(data_preparation, "PREPARED_DIR", prepared_dir)
+
+    def write_raw_data(n_measurements: int):
+        for k, df in get_raw_data(n_measurements).items():
+            df.to_csv(raw_files[k], index=False)
+
+    write_raw_data(3)
+    data_preparation.prepare_data()
+    data_preparation.prepare_data()
+    assert "up to date" in capsys.readouterr().out
+    write_raw_data(6)
+    data_preparation.prepare_data(incremental=True)
+    assert "new measurements" in capsys.readouterr().out
+    loaded = load_prepared_data(os.path.join(prepared_dir, "equilibrator"))
+    assert len(loaded.measurements) == 6
+    data_preparation.prepare_data(incremental=True)
+    assert "up to date" in capsys.readouterr().out
+
+
+def test_prepare_data_incremental_edited_measurement(
+    tmp_path, monkeypatch, capsys
+):
+    """Check that editing an old measurement makes a full run."""
+    raw_files = {k: os.path.join(tmp_path, k + ".csv") for k in get_raw_data(3)}
+    prepared_dir = os.path.join(tmp_path, "prepared")
+    monkeypatch.setattr(data_preparation, "RAW_DATA_FILES", raw_files)
+    monkeypatch.setattr(data_preparation, "PREPARED_DIR", prepared_dir)
+    for k, df in get_raw_data(3).items():
+        df.to_csv(raw_files[k], index=False)
+    data_preparation.prepare_data()
+    edited = get_raw_data(6)
+    edited["equilibrator_reactions"].loc[0, "standard_dg(kilojoule / mole)"] = 9
+    for k, df in edited.items():
+        df.to_csv(raw_files[k], index=False)
+    capsys.readouterr()
+    data_preparation.prepare_data(incremental=True)
+    assert "new measurements" not in capsys.readouterr().out
+    loaded = load_prepared_data(os.path.join(prepared_dir, "equilibrator"))
+    full = prepare_data_equilibrator(
+        **{k: pd.read_csv(v) for k, v in raw_files.items()}
+    )
+    assert loaded.coords == full.coords
+    for table in PREPARED_TABLES:
+        assert_frame_equal(getattr(loaded, table), getattr(full, table))
+    assert loaded.measurements["y"].iloc[0] == 9
+    data_preparation.prepare_data(incremental=True)
+    assert "up to date" in capsys.readouterr().out
+
+
+def test_get_reaction_keys():
+    """Check that reaction keys only depend on the non-zero entries."""
+    S_long = pd.DataFrame(
+        {
+            "compound_id": [1, 2, 2, 1, 1, 2],
+            "measurement_id": [0, 0, 1, 1, 2, 2],
+            "stoichiometric_coefficient": [-1.0, 1.0, 1.0, -1.0, -1.0, 2.0],
+        }
+    )
+    keys = get_reaction_keys(S_long, "measurement_id")
+    assert keys.index.tolist() == [0, 1, 2]
+    assert keys[0] == keys[1]
+    assert keys[0] != keys[2]
@@ -0,0 +1,280 @@
+"""Unit tests for functions in src/fitting_mode.py."""
+
+import json
+import os
+import threading
+from types import SimpleNamespace
+
+import arviz as az
+import numpy as np
+import pytest
+import xarray as xr
+from stanio.reshape import parse_header
+from dgfreg.fitting_mode import (
+    ApproximateFit,
+    fit_kfold,
+    fit_kfold_approximate,
+    fit_loo,
+    fit_pathfinder,
+)
+
+
+class FakeFit:
+    """Stands in for a CmdStanMCMC with one chain."""
+
+    def __init__(self, data: str):
+        with open(data, "r") as f:
+            self.data = json.load(f)
+
+    def draws_xr(self, vars):
+        """Get 'draws' of llik that identify the test observations."""
+        llik = np.tile(np.array(self.data["ix_test"], dtype=float), (3, 1, 1))
+        return xr.Dataset(
+            {"llik": (("draw", "chain", "llik_dim_0"), llik)},
+            coords={"chain": [1], "draw": np.arange(3)},
+        ).transpose("chain", "draw", ...)
+
+
+class FakeModel:
+    """Stands in for a CmdStanModel, recording the calls to sample."""
+
+    def __init__(self):
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def sample(self, data, **kwargs):
+        """Pretend to sample."""
+        with self.lock:
+            self.calls.append(kwargs)
+        return FakeFit(data)
+
+
+@pytest.mark.parametrize("n_workers", [2, 3])
+def test_fit_kfold_parallel_matches_serial(n_workers: int):
+    """Check that running folds at the same time gives the serial result."""
+    input_dict = {"ix_train": list(range(1, 11))}
+    serial_model, parallel_model = FakeModel(), FakeModel()
+    serial = fit_kfold(serial_model, input_dict, {"n_folds": 5})
+    parallel = fit_kfold(
+        parallel_model,
+        input_dict,
+        {"n_folds": 5, "n_workers": n_workers, "output_dir": "out"},
+    )
+    xr.testing.assert_identical(serial, parallel)
+    assert len(parallel_model.calls) == 5
+    assert all(
+        "n_workers" not in c and c["parallel_chains"] >= 1
+        for c in parallel_model.calls
+    )
+    assert len({c["output_dir"] for c in parallel_model.calls}) == 5
+
+
+def test_stan_input_dir_option(tmp_path):
+    """Check that Stan inputs go in the run's directory, one per fold."""
+    model = FakeModel()
+    kwargs = {"n_folds": 5, "stan_input_dir": str(tmp_path)}
+    fit_kfold(model, {"ix_train": list(range(1, 11))}, kwargs)
+    assert len(os.listdir(tmp_path)) == 5
+    assert all("stan_input_dir" not in c for c in model.calls)
+
+
+class RecordingModel(FakeModel):
+    """A FakeModel that also records the data it is given."""
+
+    def sample(self, data, **kwargs):
+        """Pretend to sample, recording the data."""
+        with open(data, "r") as f:
+            self.data = json.load(f)
+        return super().sample(data, **kwargs)
+
+
+@pytest.mark.parametrize(
+    "generated_quantities,expected",
+    [
+        (None, {"output_dgfC": 1, "output_dgr": 1, "output_yrep": 1}),
+        (["llik"], {"output_dgfC": 0, "output_dgr": 0, "output_yrep": 0}),
+        (
+            ["llik", "dgr"],
+            {"output_dgfC": 0, "output_dgr": 1, "output_yrep": 0},
+        ),
+    ],
+)
+def test_generated_quantities_option(generated_quantities, expected: dict):
+    """Check that the generated_quantities option sets the output flags."""
+    kwargs = {"n_folds": 2}
+    if generated_quantities is not None:
+        kwargs["generated_quantities"] = generated_quantities
+    model = RecordingModel()
+    fit_kfold(model, {"ix_train": [1, 2, 3, 4]}, kwargs)
+    assert {k: model.data[k] for k in expected.keys()} == expected
+    assert all("generated_quantities" not in c for c in model.calls)
+
+
+class FakePathfinder:
+    """Stands in for a CmdStanPathfinder, with llik identifying ix_test."""
+
+    def __init__(self, data: str, draws: int):
+        with open(data, "r") as f:
+            self.data = json.load(f)
+        ix_test = np.array(self.data["ix_test"], dtype=float)
+        columns = ["lp__", "lp_approx__", "sigma"] + [
+            f"llik.{i + 1}" for i in range(len(ix_test))
+        ]
+        variables = parse_header(",".join(columns))
+        self.metadata = SimpleNamespace(
+            method_vars={
+                k: v for k, v in variables.items() if k.endswith("__")
+            },
+            stan_vars={
+                k: v for k, v in variables.items() if not k.endswith("__")
+            },
+        )
+        self._draws = np.column_stack(
+            [
+                np.zeros((draws, 2)),
+                np.arange(draws),
+                np.tile(ix_test, (draws, 1)),
+            ]
+        )
+
+    def draws(self) -> np.ndarray:
+        """Get the draws as a (draws, columns) array."""
+        return self._draws
+
+
+class FakeApproximateModel:
+    """Stands in for a CmdStanModel with a pathfinder method."""
+
+    def __init__(self):
+        self.calls = []
+
+    def pathfinder(self, data, draws: int = 5, output_dir=None):
+        """Pretend to run pathfinder."""
+        self.calls.append({"draws": draws, "output_dir": output_dir})
+        return FakePathfinder(data, draws)
+
+
+def test_approximate_fit_to_arviz():
+    """Check that arviz can read an approximate fit as a single chain."""
+    model = FakeApproximateModel()
+    fit = fit_pathfinder(
+        model,
+        {"ix_test": [2, 4, 6]},
+        {"iter_warmup": 1000, "save_warmup": True, "draws": 7},
+    )
+    assert isinstance(fit, ApproximateFit)
+    assert model.calls == [{"draws": 7, "output_dir": None}]
+    idata = az.from_cmdstanpy(posterior=fit, log_likelihood="llik")
+    assert dict(idata.posterior.sizes) == {"chain": 1, "draw": 7}
+    np.testing.assert_array_equal(
+        idata.posterior["sigma"].values, [np.arange(7)]
+    )
+    assert idata.log_likelihood["llik"].shape == (1, 7, 3)
+    assert "lp" in idata.sample_stats
+
+
+def test_fit_kfold_approximate():
+    """Check that approximate kfold has the same shape as kfold."""
+    input_dict = {"ix_train": list(range(1, 11))}
+    kwargs = {"n_folds": 5, "chains": 1, "draws": 3}
+    expected = fit_kfold(FakeModel(), input_dict, kwargs)
+    model = FakeApproximateModel()
+    approximate = fit_kfold_approximate(model, input_dict, kwargs)
+    xr.testing.assert_identical(approximate, expected)
+    assert len(model.calls) == 5
+
+
+class FakeWarmStartFit(FakeFit):
+    """A FakeFit with the adaptation information of a two-chain CmdStanMCMC."""
+
+    chains = 2
+    metric_type = "diag_e"
+    step_size = np.array([0.1, 0.2])
+    inv_metric = np.array([[1.0, 2.0], [3.0, 4.0]])
+
+    def __init__(self, data: str):
+        super().__init__(data)
+        self.metadata = SimpleNamespace(stan_vars=parse_header("sigma,qC.1"))
+
+    def draws(self, concat_chains: bool):
+        """Get (draws, chains, columns) draws whose last values are known."""
+        return np.arange(12.0).reshape(3, 2, 2)
+
+
+class FakeWarmStartModel(FakeModel):
+    """A FakeModel whose fits can be used for warm starts."""
+
+    def sample(self, data, **kwargs):
+        """Pretend to sample."""
+        with self.lock:
+            self.calls.append(kwargs)
+        return FakeWarmStartFit(data)
+
+
+def test_fit_kfold_warm_start():
+    """Check that warm-started folds start where the full fit ended."""
+    input_dict = {"ix_train": list(range(1, 11))}
+    cold = fit_kfold(FakeModel(), input_dict, {"n_folds": 5})
+    model = FakeWarmStartModel()
+    warm = fit_kfold(
+        model,
+        input_dict,
+        {"n_folds": 5, "warm_start": True, "warm_start_warmup": 20},
+    )
+    xr.testing.assert_identical(warm, cold)
+    full_call, *fold_calls = model.calls
+    assert len(fold_calls) == 5 and "inits" not in full_call
+    for call in fold_calls:
+        assert call["iter_warmup"] == 20 and not call["adapt_engaged"]
+        assert call["step_size"] == [0.1, 0.2]
+        assert [init["sigma"] for init in call["inits"]] == [8.0, 10.0]
+        np.testing.assert_array_equal(call["inv_metric"][1], [3.0, 4.0])
+
+
+class FakeLooFit:
+    """Stands in for a CmdStanMCMC with two chains of 500 draws.
+
+    Reaction 3 has a heavy-tailed llik in the full fit, and llik is 7 in
+    fits with a single test reaction.
+    """
+
+    def __init__(self, data: str):
+        with open(data, "r") as f:
+            self.data = json.load(f)
+
+    def draws_xr(self, vars):
+        """Get draws of llik."""
+        ix_test = self.data["ix_test"]
+        rng = np.random.default_rng(0)
+        if len(ix_test) == 1:
+            llik = np.full((2, 500, 1), 7.0)
+        else:
+            llik = rng.normal(-1, 0.1, size=(2, 500, len(ix_test)))
+            llik[:, :, ix_test.index(3)] = -rng.pareto(0.5, size=(2, 500))
+        return xr.Dataset(
+            {"llik": (("chain", "draw", "llik_dim_0"), llik)},
+            coords={"chain": [1, 2], "draw": np.arange(500)},
+        )
+
+
+class FakeLooModel(FakeModel):
+    """A FakeModel whose fits are FakeLooFits."""
+
+    def sample(self, data, **kwargs):
+        """Pretend to sample."""
+        with self.lock:
+            self.calls.append(kwargs)
+        return FakeLooFit(data)
+
+
+def test_fit_loo():
+    """Check that loo refits only the reaction with a high Pareto k."""
+    model = FakeLooModel()
+    input_dict = {"ix_train": [1, 2, 3, 4, 5]}
+    llik = fit_loo(model, input_dict, {"pareto_k_threshold": 0.7})
+    assert llik.dims == ("chain", "draw", "llik_dim_0")
+    assert llik.shape == (2, 500, 5)
+    assert llik["refit"].values.tolist() == [False, False, True, False, False]
+    assert len(model.calls) == 2
+    assert (llik.values[:, :, 2] == 7.0).all()
+    assert (llik.values[:, :, [0, 1, 3, 4]] < 0).all()
@@ -0,0 +1,77 @@
+"""Unit tests for functions in src/gaussian_approximation.py."""
+
+import numpy as np
+import xarray as xr
+from scipy.sparse import csr_matrix
+from dgfreg.gaussian_approximation import (
+    LowRankGaussian,
+    LowRankPlusDiagonal,
+    get_low_rank_gaussian,
+    get_streaming_moments,
+)
+
+
+def test_get_streaming_moments():
+    """Check that merging chunks gives the ordinary sample moments."""
+    x = np.random.default_rng(0).normal(size=(103, 4))
+    n, mean, cov = get_streaming_moments([x[:10], x[10:11], x[11:]])
+    assert n == 103
+    np.testing.assert_allclose(mean, x.mean(axis=0))
+    np.testing.assert_allclose(cov, np.cov(x.T))
+
+
+def test_get_low_rank_gaussian(tmp_path):
+    """Check the approximation of rank-deficient draws and its artifact."""
+    rng = np.random.default_rng(1)
+    # 5 compounds whose draws only vary in 2 directions
+    draws = rng.normal(size=(2, 60, 2)) @ rng.normal(size=(2, 5)) + 3
+    da = xr.DataArray(
+        draws,
+        dims=["chain", "draw", "compound_id"],
+        coords={"compound_id": list("abcde")},
+    )
+    approximation = get_low_rank_gaussian(da, chunk_draws=7)
+    assert approximation.rank == 2
+    flat = draws.reshape(-1, 5)
+    np.testing.assert_allclose(approximation.mean, flat.mean(axis=0))
+    np.testing.assert_allclose(approximation.cov(), np.cov(flat.T), atol=1e-10)
+    truncated = get_low_rank_gaussian(da, rank=1)
+    np.testing.assert_allclose(
+        np.diag(truncated.cov()), np.diag(np.cov(flat.T))
+    )
+    path = tmp_path / "approximation.npz"
+    truncated.save(path)
+    loaded = LowRankGaussian.load(path)
+    assert loaded.ids.tolist() == list("abcde")
+    np.testing.assert_array_equal(loaded.factor, truncated.factor)
+
+
+def test_low_rank_plus_diagonal_linear_map():
+    """Check that linear maps of sparse and dense matrices match the cov."""
+    rng = np.random.default_rng(2)
+    x = LowRankPlusDiagonal(
+        ids=np.array(list("abcd")),
+        mean=rng.normal(size=4),
+        factor=rng.normal(size=(4, 2)),
+        diag=np.array([0.0, 0.5, 0.0, 2.0]),
+    )
+    A = np.array([[1.0, -1.0, 0.0, 0.0], [0.0, 2.0, 0.0, -1.0]])
+    B = np.array([[1.0, 1.0], [3.0, 0.0], [0.0, -2.0]])
+    for A_in, B_in in [(A, B), (csr_matrix(A), csr_matrix(B))]:
+        mapped = x.linear_map(A_in, ["r1", "r2"]).linear_map(B_in, list("xyz"))
+        expected_cov = B @ A @ x.cov() @ A.T @ B.T
+        np.testing.assert_allclose(mapped.mean, B @ A @ x.mean)
+        np.testing.assert_allclose(mapped.cov(), expected_cov)
+        np.testing.assert_allclose(mapped.sd, np.sqrt(np.diag(expected_cov)))
+    approximation = LowRankGaussian(
+        ids=x.ids,
+        mean=x.mean,
+        eigenvectors=np.linalg.qr(x.factor)[0],
+        eigenvalues=np.array([2.0, 0.5]),
+        residual=x.diag,
+    )
+    mean, sd = approximation.get_linear_moments(A)
+    np.testing.assert_allclose(mean, A @ x.mean)
+    np.testing.assert_allclose(
+        sd, np.sqrt(np.diag(A @ approximation.cov() @ A.T))
+    )
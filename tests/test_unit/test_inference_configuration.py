@@ -0,0 +1,81 @@
+"""Unit tests for functions in src/inference_configuration.py."""
+
+import pytest
+from dgfreg.inference_configuration import InferenceConfiguration
+
+BASE_CONFIG = {
+    "name": "test",
+    "stan_file": "new_threaded.stan",
+    "prepared_data_dir": "equilibrator",
+    "stan_input_function": "get_stan_input_threaded",
+    "modes": ["posterior"],
+}
+
+
+@pytest.mark.parametrize(
+    "extra,ok",
+    [
+        ({}, True),
+        ({"sample_kwargs": {"threads_per_chain": 4}}, False),
+        (
+            {
+                "sample_kwargs": {"threads_per_chain": 4},
+                "cpp_options": {"STAN_THREADS": True},
+            },
+            True,
+        ),
+        ({"mode_options": {"posterior": {"threads_per_chain": 2}}}, False),
+    ],
+)
+def test_check_threads(extra: dict, ok: bool):
+    """Check that threads per chain require a model compiled with threads."""
+    if ok:
+        InferenceConfiguration(**BASE_CONFIG, **extra)
+    else:
+        with pytest.raises(ValueError):
+            InferenceConfiguration(**BASE_CONFIG, **extra)
+
+
+def test_check_generated_quantities():
+    """Check that unknown generated quantities are rejected."""
+    InferenceConfiguration(**BASE_CONFIG, generated_quantities=["llik", "dgr"])
+    with pytest.raises(ValueError):
+        InferenceConfiguration(
+            **BASE_CONFIG,
+            mode_options={"posterior": {"generated_quantities": ["dgf"]}},
+        )
+
+
+def test_check_folds_kfold_approximate():
+    """Check that approximate kfold needs folds and a known approximation."""
+    config = BASE_CONFIG | {"modes": ["kfold_approximate"]}
+    with pytest.raises(ValueError):
+        InferenceConfiguration(**config)
+    InferenceConfiguration(
+        **config, mode_options={"kfold_approximate": {"n_folds": 5}}
+    )
+    with pytest.raises(ValueError):
+        InferenceConfiguration(
+            **config,
+            mode_options={
+                "kfold_approximate": {"n_folds": 5, "approximation": "nuts"}
+            },
+        )
+
+
+@pytest.mark.parametrize(
+    "stan_file,ok", [("new.stan", True), ("compound.stan", False)]
+)
+@pytest.mark.parametrize("mode", ["collapsed", "kfold_collapsed"])
+def test_check_collapsed_modes(stan_file: str, mode: str, ok: bool):
+    """Check that the collapsed modes are only used with new.stan."""
+    config = BASE_CONFIG | {
+        "stan_file": stan_file,
+        "modes": [mode],
+        "mode_options": {mode: {"n_folds": 5}},
+    }
+    if ok:
+        InferenceConfiguration(**config)
+    else:
+        with pytest.raises(ValueError, match="new.stan"):
+            InferenceConfiguration(**config)
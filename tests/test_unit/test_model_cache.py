@@ -0,0 +1,102 @@
+"""Unit tests for functions in src/model_cache.py."""
+
+import os
+import shutil
+
+import pytest
+from dgfreg import model_cache
+from dgfreg.model_cache import (
+    get_cached_model,
+    get_include_paths,
+    get_model_cache_key,
+    get_stan_sources,
+)
+
+HERE = os.path.dirname(__file__)
+STAN_DIR = os.path.join(HERE, "..", "..", "dgfreg", "stan")
+
+
+class FakeCmdStanModel:
+    """Stands in for CmdStanModel, 'compiling' by writing the executable."""
+
+    n_compiled = 0
+
+    def __init__(self, stan_file, exe_file=None, **kwargs):
+        """Initialise a FakeCmdStanModel."""
+        if exe_file is None:
+            FakeCmdStanModel.n_compiled += 1
+            exe_file = os.path.splitext(stan_file)[0] + model_cache.EXE_SUFFIX
+            with open(exe_file, "w") as f:
+                f.write("binary")
+        self.stan_file, self.exe_file, self.kwargs = stan_file, exe_file, kwargs
+
+
+@pytest.fixture
+def fake_cmdstan(monkeypatch):
+    """Replace cmdstan with FakeCmdStanModel."""
+    monkeypatch.setattr(model_cache.cmdstanpy, "CmdStanModel", FakeCmdStanModel)
+    monkeypatch.setattr(model_cache, "get_cmdstan_version", lambda: "2.36")
+    FakeCmdStanModel.n_compiled = 0
+
+
+def copy_checkout(tmp_path, name: str) -> str:
+    """Copy new.stan and its included file somewhere else."""
+    directory = tmp_path / name
+    directory.mkdir()
+    for f in ["new.stan", "custom_functions.stan"]:
+        shutil.copy(os.path.join(STAN_DIR, f), directory / f)
+    return str(directory / "new.stan")
+
+
+def test_get_model_cache_key(tmp_path):
+    """Check that the key depends on the included source and options."""
+    stan_file_a = copy_checkout(tmp_path, "a")
+    stan_file_b = copy_checkout(tmp_path, "b")
+    sources_a = get_stan_sources(stan_file_a, get_include_paths(stan_file_a))
+    sources_b = get_stan_sources(stan_file_b, get_include_paths(stan_file_b))
+    assert set(sources_a.keys()) == {"new.stan", "custom_functions.stan"}
+    key = get_model_cache_key(sources_a, cmdstan_version="2.36")
+    # the same source in another checkout gives the same key
+    assert get_model_cache_key(sources_b, cmdstan_version="2.36") == key
+    assert get_model_cache_key(sources_a, cmdstan_version="2.37") != key
+    assert (
+        get_model_cache_key(
+            sources_a, {"STAN_THREADS": True}, cmdstan_version="2.36"
+        )
+        != key
+    )
+    with open(os.path.join(tmp_path, "b", "custom_functions.stan"), "a") as f:
+        f.write("\n// a change\n")
+    sources_b = get_stan_sources(stan_file_b, get_include_paths(stan_file_b))
+    assert get_model_cache_key(sources_b, cmdstan_version="2.36") != key
+    os.remove(os.path.join(tmp_path, "b", "custom_functions.stan"))
+    with pytest.raises(ValueError):
+        get_stan_sources(stan_file_b, get_include_paths(stan_file_b))
+
+
+def test_get_cached_model(tmp_path, fake_cmdstan):
+    """Check that each variant is compiled once and shared by checkouts."""
+    cache_dir = str(tmp_path / "cache")
+    stan_file_a = copy_checkout(tmp_path, "a")
+    stan_file_b = copy_checkout(tmp_path, "b")
+    model = get_cached_model(stan_file_a, cache_dir=cache_dir)
+    assert FakeCmdStanModel.n_compiled == 1
+    assert os.path.dirname(model.exe_file).startswith(cache_dir)
+    assert os.path.exists(
+        os.path.join(os.path.dirname(model.exe_file), "custom_functions.stan")
+    )
+    again = get_cached_model(
+        stan_file_b,
+        stanc_options={"include-paths": [os.path.dirname(stan_file_b)]},
+        cache_dir=cache_dir,
+    )
+    assert FakeCmdStanModel.n_compiled == 1
+    assert again.exe_file == model.exe_file
+    threaded = get_cached_model(
+        stan_file_a, cpp_options={"STAN_THREADS": True}, cache_dir=cache_dir
+    )
+    assert FakeCmdStanModel.n_compiled == 2
+    assert threaded.exe_file != model.exe_file
+    assert threaded.kwargs["cpp_options"] == {"STAN_THREADS": True}
+    # only the two finished models are left in the cache
+    assert len(os.listdir(cache_dir)) == 2
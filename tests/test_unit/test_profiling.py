@@ -0,0 +1,152 @@
+"""Unit tests for functions in src/profiling.py."""
+
+import json
+import os
+import subprocess
+import sys
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+from dgfreg.fitting_mode import FittingMode, fit_kfold_collapsed
+from dgfreg.profiling import PROFILE_CSV_FILE, PROFILE_JSON_FILE, Profiler
+from dgfreg.sample import CoreBudget, run_job
+
+
+def test_profiler_stage():
+    """Check that stages are recorded, including ones that fail."""
+    profiler = Profiler()
+    with profiler.stage("compile", target="new.stan"):
+        sum(i * i for i in range(100000))
+    with pytest.raises(RuntimeError):
+        with profiler.stage("fit", "inf", "posterior"):
+            raise RuntimeError("oops")
+    compile_record, fit_record = profiler.stages
+    assert compile_record.status == "ok"
+    assert compile_record.wall_seconds > 0
+    assert compile_record.cpu_seconds > 0
+    assert compile_record.process_max_rss_so_far_mb > 0
+    assert (fit_record.inference, fit_record.mode) == ("inf", "posterior")
+    assert fit_record.status == "error"
+
+
+@pytest.mark.skipif(
+    not os.path.exists("/proc/self/status"), reason="needs /proc"
+)
+def test_profiler_stage_peak_rss():
+    """Check that each stage records its own peak memory."""
+    profiler = Profiler()
+    with profiler.stage("big"):
+        big = np.ones(50 * 2**20 // 8)
+        child = subprocess.Popen(
+            [
+                sys.executable,
+                "-c",
+                "import time; x = bytearray(50 * 2 ** 20); time.sleep(0.5)",
+            ]
+        )
+        child.wait()
+    del big
+    with profiler.stage("small"):
+        pass
+    big_record, small_record = profiler.stages
+    assert big_record.peak_rss_mb - small_record.peak_rss_mb > 40
+    assert big_record.peak_child_rss_mb > 40
+    assert small_record.peak_child_rss_mb == 0
+    assert (
+        small_record.process_max_rss_so_far_mb
+        >= big_record.process_max_rss_so_far_mb
+    )
+
+
+def test_record_fit_and_write_report(tmp_path):
+    """Check that chain timings and Stan profiles end up in the report."""
+    profile_file = tmp_path / "model-profile-1.csv"
+    pd.DataFrame(
+        {"name": ["likelihood"], "thread_id": [1], "total_time": [0.5]}
+    ).to_csv(profile_file, index=False)
+    fit = SimpleNamespace(
+        time=[
+            {"warmup": 1.0, "sampling": 2.0, "total": 3.0},
+            {"warmup": 1.5, "sampling": 2.5, "total": 4.0},
+        ],
+        runset=SimpleNamespace(
+            chain_ids=[1, 2], profile_files=[str(profile_file), ""]
+        ),
+    )
+    profiler = Profiler()
+    job = profiler.job("inf", "kfold")
+    job.record_fit(fit, fold=3)
+    job.record_fit(object())  # not a CmdStanMCMC, so ignored
+    with job.stage("fit", fold=3):
+        pass
+    with profiler.stage("load_data", target="data_dir"):
+        pass
+    with profiler.stage("load_data", target="other_data_dir"):
+        pass
+    with profiler.stage("fit", "other_inf", "kfold"):
+        pass
+    profiler.write_report(str(tmp_path), "inf", ["data_dir"])
+    with open(tmp_path / PROFILE_JSON_FILE) as f:
+        report = json.load(f)
+    assert [(s["stage"], s["fold"]) for s in report["stages"]] == [
+        ("fit", 3),
+        ("load_data", None),
+    ]
+    assert [c["sampling_seconds"] for c in report["chains"]] == [2.0, 2.5]
+    assert report["stan_profiles"] == [
+        {
+            "inference": "inf",
+            "mode": "kfold",
+            "fold": 3,
+            "chain": 1,
+            "name": "likelihood",
+            "thread_id": 1,
+            "total_time": 0.5,
+        }
+    ]
+    stages = pd.read_csv(os.path.join(tmp_path, PROFILE_CSV_FILE))
+    assert stages["stage"].tolist() == ["fit", "load_data"]
+
+
+def test_run_job_profiles_folds():
+    """Check that jobs and their folds are timed."""
+    rng = np.random.default_rng(0)
+    NC, NR, NG = 4, 9, 2
+    S = rng.integers(-1, 2, size=(NC, NR)).astype(float)
+    G = rng.integers(0, 3, size=(NC, NG)).astype(float)
+    input_dict = {
+        "NR": NR,
+        "NC": NC,
+        "NG": NG,
+        "S": S,
+        "G": G,
+        "y": rng.normal(size=NR),
+        "nobs": np.ones(NR, dtype=int),
+        "N_train": NR,
+        "N_test": NR,
+        "ix_train": np.arange(1, NR + 1),
+        "ix_test": np.arange(1, NR + 1),
+    }
+    mode = FittingMode(
+        name="kfold_collapsed",
+        idata_target="log_likelihood",
+        fit=fit_kfold_collapsed,
+    )
+    profiler = Profiler()
+    run_job(
+        mode,
+        None,
+        input_dict,
+        {"n_folds": 3, "chains": 1, "iter_sampling": 5, "n_grid": 3},
+        CoreBudget(1),
+        profiler.job("inf", "kfold_collapsed"),
+    )
+    stages = [(r.stage, r.fold) for r in profiler.stages]
+    assert stages[0] == ("wait_for_cores", None)
+    assert stages[-1] == ("fit", None)
+    for fold in range(3):
+        assert ("fit", fold) in stages
+        assert ("read_llik", fold) in stages
+    assert all(r.mode == "kfold_collapsed" for r in profiler.stages)
@@ -0,0 +1,43 @@
+"""Unit tests for functions in src/sample.py."""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from dgfreg.sample import CoreBudget, get_n_cores_needed
+
+
+@pytest.mark.parametrize(
+    "fit_kwargs,expected",
+    [
+        ({}, 4),
+        ({"chains": 2, "threads_per_chain": 3}, 6),
+        ({"chains": 4, "parallel_chains": 1}, 1),
+        ({"chains": 1, "n_workers": 5, "n_folds": 10}, 5),
+    ],
+)
+def test_get_n_cores_needed(fit_kwargs: dict, expected: int):
+    """Check that the function get_n_cores_needed works as expected."""
+    assert get_n_cores_needed(fit_kwargs) == expected
+
+
+def test_core_budget_is_respected():
+    """Check that jobs never hold more cores than the budget."""
+    budget = CoreBudget(4)
+    lock = threading.Lock()
+    in_use, max_in_use = [0], [0]
+
+    def job(n: int):
+        with budget.reserve(n):
+            with lock:
+                in_use[0] += min(n, 4)
+                max_in_use[0] = max(max_in_use[0], in_use[0])
+            time.sleep(0.01)
+            with lock:
+                in_use[0] -= min(n, 4)
+
+    with ThreadPoolExecutor(max_workers=6) as executor:
+        list(executor.map(job, [3, 2, 1, 4, 8, 2]))
+    assert max_in_use[0] <= 4
+    assert budget.n_free == 4
@@ -0,0 +1,114 @@
+"""Unit tests for functions in src/stan_csv.py."""
+
+import arviz as az
+import numpy as np
+import pytest
+import xarray as xr
+import zarr
+from dgfreg.stan_csv import read_stan_csv_variables, stan_csv_to_zarr
+
+COLUMNS = ["lp__", "accept_stat__", "sigma"] + [
+    f"M.{i}.{j}" for j in range(1, 4) for i in range(1, 3)
+]
+N_WARMUP = 7
+N_SAMPLES = 23
+
+
+def write_stan_csv(path, chain: int, lp_offset: int = 0):
+    """Write a Stan csv file whose draws identify their chain and position.
+
+    Warmup draws of sigma are negative. M is column-major, as in Stan. lp__
+    is lp_offset minus the draw's position.
+    """
+    lines = [
+        "# model = fake_model",
+        "# method = sample (Default)",
+        "#   sample",
+        f"#     num_samples = {N_SAMPLES}",
+        f"#     num_warmup = {N_WARMUP}",
+        "#     save_warmup = true",
+        "#     thin = 1 (Default)",
+        ",".join(COLUMNS),
+    ]
+    M = [10 * i + j for j in range(3) for i in range(2)]
+    for i in range(N_WARMUP):
+        lines.append(
+            ",".join(map(str, [lp_offset - i, 0.5, -(100 * chain + i)] + M))
+        )
+    lines += ["# Adaptation terminated", "# Step size = 0.5"]
+    for i in range(N_SAMPLES):
+        lines.append(
+            ",".join(map(str, [lp_offset - i, 0.9, 100 * chain + i] + M))
+        )
+    lines.append("#  Elapsed Time: 0.1 seconds (Total)")
+    path.write_text("\n".join(lines) + "\n")
+    return str(path)
+
+
+@pytest.fixture
+def csv_files(tmp_path):
+    """Two fake Stan csv files."""
+    return [write_stan_csv(tmp_path / f"chain_{c}.csv", c) for c in range(2)]
+
+
+def test_read_stan_csv_variables(csv_files):
+    """Check that chunked reading gets the sampling draws."""
+    ds = read_stan_csv_variables(csv_files, ["M", "sigma"], chunk_rows=4)
+    np.testing.assert_array_equal(
+        ds["sigma"], [np.arange(N_SAMPLES), 100 + np.arange(N_SAMPLES)]
+    )
+    assert ds["M"].shape == (2, N_SAMPLES, 2, 3)
+    np.testing.assert_array_equal(ds["M"][0, 0], [[0, 1, 2], [10, 11, 12]])
+
+
+def test_stan_csv_to_zarr(csv_files, tmp_path):
+    """Check that streamed draws load as an InferenceData."""
+    store = str(tmp_path / "idata.zarr")
+    stan_csv_to_zarr(
+        csv_files,
+        store,
+        "posterior",
+        var_groups={"sigma": "log_likelihood"},
+        dims={"M": ["row", "column"]},
+        coords={"column": ["a", "b", "c"]},
+        float32=True,
+        thin=5,
+        inc_warmup=True,
+        chunk_rows=4,
+    )
+    zarr.consolidate_metadata(store)
+    idata = az.InferenceData.from_datatree(xr.open_datatree(store))
+    expected_sigma = [
+        np.arange(0, N_SAMPLES, 5),
+        100 + np.arange(0, N_SAMPLES, 5),
+    ]
+    np.testing.assert_array_equal(idata.log_likelihood["sigma"], expected_sigma)
+    np.testing.assert_array_equal(
+        idata.warmup_log_likelihood["sigma"][1],
+        -100 - np.arange(0, N_WARMUP, 5),
+    )
+    assert idata.posterior["M"].dims == ("chain", "draw", "row", "column")
+    assert idata.posterior["M"].dtype == "float32"
+    assert idata.posterior["column"].values.tolist() == ["a", "b", "c"]
+    assert idata.sample_stats["lp"].dtype == "float64"
+    assert idata.sample_stats.sizes["draw"] == N_SAMPLES
+
+
+def test_stan_csv_to_zarr_prior_and_posterior(csv_files, tmp_path):
+    """Check that prior and posterior diagnostics go in separate groups."""
+    store = str(tmp_path / "idata.zarr")
+    prior_files = [
+        write_stan_csv(tmp_path / f"prior_{c}.csv", c, lp_offset=1000)
+        for c in range(2)
+    ]
+    stan_csv_to_zarr(prior_files, store, "prior", float32=True)
+    stan_csv_to_zarr(csv_files, store, "posterior", float32=True)
+    zarr.consolidate_metadata(store)
+    idata = az.InferenceData.from_datatree(xr.open_datatree(store))
+    expected_lp = -np.arange(N_SAMPLES)
+    np.testing.assert_array_equal(idata.sample_stats["lp"][0], expected_lp)
+    np.testing.assert_array_equal(
+        idata.sample_stats_prior["lp"][0], 1000 + expected_lp
+    )
+    assert idata.sample_stats_prior["lp"].dtype == "float64"
+    assert idata.prior["sigma"].dtype == "float32"
@@ -0,0 +1,66 @@
+"""Unit tests for functions in src/stan_input_functions.py."""
+
+import os
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+from dgfreg.data_preparation import PreparedData
+from dgfreg.stan_input_functions import (
+    get_csr,
+    get_qr_reparameterisation,
+    get_stan_input,
+    get_stan_input_sparse,
+)
+
+
+def test_get_csr():
+    """Check that the function get_csr matches Stan's csr_extract."""
+    long = pd.DataFrame(
+        {
+            "r": ["x", "z", "x"],
+            "c": [2, 1, 1],
+            "stoichiometric_coefficient": [3.0, 4.0, 5.0],
+        }
+    )
+    row_ids, col_ids = pd.Index(["x", "y", "z"]), pd.Index([1, 2])
+    w, v, u = get_csr(long, "r", "c", row_ids, col_ids)
+    assert w.tolist() == [5.0, 3.0, 4.0]
+    assert v.tolist() == [1, 2, 1]
+    assert u.tolist() == [1, 3, 3, 4]
+
+
+def test_get_stan_input_sparse(prepped: PreparedData):
+    """Check that the sparse Stan input agrees with the dense one."""
+    dense = get_stan_input(prepped)
+    sparse = get_stan_input_sparse(prepped)
+    for k in ["NR", "NC", "NG", "N_train", "N_test"]:
+        assert sparse[k] == dense[k]
+    St = csr_matrix(
+        (sparse["St_w"], sparse["St_v"] - 1, sparse["St_u"] - 1),
+        shape=(sparse["NR"], sparse["NC"]),
+    )
+    G = csr_matrix(
+        (sparse["G_w"], sparse["G_v"] - 1, sparse["G_u"] - 1),
+        shape=(sparse["NC"], sparse["NG"]),
+    )
+    assert sparse["N_St"] == len(prepped.S)
+    assert sparse["N_G"] == len(prepped.G)
+    np.testing.assert_array_equal(St.toarray(), dense["S"].T)
+    np.testing.assert_array_equal(G.toarray(), dense["G"])
+
+
+def test_get_qr_reparameterisation(tmp_path):
+    """Check the precomputed QR reparameterisation and its cache."""
+    SG = np.random.default_rng(1).normal(size=(10, 4))
+    Qstar, Rstar_inverse = get_qr_reparameterisation(SG, cache_dir=tmp_path)
+    Rstar = np.linalg.inv(Rstar_inverse)
+    np.testing.assert_allclose(Qstar @ Rstar, SG, atol=1e-10)
+    np.testing.assert_allclose(Qstar.T @ Qstar, 9 * np.eye(4), atol=1e-10)
+    assert (np.diag(Rstar) > 0).all()
+    assert len(os.listdir(tmp_path)) == 1
+    Qstar_cached, Rstar_inverse_cached = get_qr_reparameterisation(
+        SG, cache_dir=tmp_path
+    )
+    np.testing.assert_array_equal(Qstar_cached, Qstar)
+    np.testing.assert_array_equal(Rstar_inverse_cached, Rstar_inverse)
@@ -0,0 +1,109 @@
+"""Unit tests for functions in src/unobserved.py."""
+
+import arviz as az
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.sparse import csr_matrix
+from dgfreg.unobserved import PredictionEngine, get_reaction_samples
+
+
+@pytest.fixture
+def idata() -> az.InferenceData:
+    """A posterior with two chains, two groups and two seen compounds."""
+    rng = np.random.default_rng(0)
+    return az.from_dict(
+        posterior={
+            "dgfG": rng.normal(size=(2, 50, 2)),
+            "qC": rng.normal(size=(2, 50, 2)),
+            "tauC": np.abs(rng.normal(size=(2, 50))),
+        },
+        coords={"group_id": ["a", "b"], "compound_id": ["c1", "c2"]},
+        dims={"dgfG": ["group_id"], "qC": ["compound_id"]},
+    )
+
+
+G = pd.DataFrame(
+    [[1.0, 0.0], [2.0, 1.0], [0.0, 3.0]],
+    index=["c1", "c2", "new"],
+    columns=["a", "b"],
+)
+S = pd.DataFrame(
+    [[-1.0, 0.0], [1.0, -2.0], [0.0, 1.0]],
+    index=["c1", "c2", "new"],
+    columns=["r1", "r2"],
+)
+
+
+def test_prediction_engine_compounds(idata: az.InferenceData):
+    """Check compound predictions for seen and new compounds."""
+    engine = PredictionEngine(idata, seed=1)
+    out = engine.get_compound_samples(G[["b", "a"]])
+    assert out.dims == ("chain", "draw", "compound_id")
+    post = idata.posterior
+    expected_c2 = 2 * post["dgfG"][..., 0] + post["dgfG"][..., 1]
+    expected_c2 += post["qC"].sel(compound_id="c2")
+    np.testing.assert_allclose(out.sel(compound_id="c2"), expected_c2)
+    new_deviation = out.sel(compound_id="new") - 3 * post["dgfG"][..., 1]
+    assert (new_deviation != 0).all()
+    again = PredictionEngine(idata, seed=1).get_compound_samples(G)
+    np.testing.assert_array_equal(again.sel(compound_id="new"), out[..., 2])
+
+
+def test_prediction_engine_sparse_matches_dense(idata: az.InferenceData):
+    """Check that sparse queries match dense DataFrame queries."""
+    dense = PredictionEngine(idata, seed=2).get_reaction_samples(S, G)
+    sparse = PredictionEngine(idata, seed=2).get_reaction_samples(
+        csr_matrix(S.values),
+        csr_matrix(G.values),
+        reaction_ids=S.columns,
+        compound_ids=S.index,
+        group_ids=G.columns,
+    )
+    np.testing.assert_allclose(sparse, dense)
+    legacy = get_reaction_samples(idata, S, G, seed=2)
+    np.testing.assert_allclose(legacy, dense)
+
+
+def test_summarise_reactions(idata: az.InferenceData):
+    """Check Gaussian summaries against the sample moments."""
+    engine = PredictionEngine(idata)
+    seen_S = S.loc[["c1", "c2"]]
+    samples = engine.get_reaction_samples(seen_S, G.loc[["c1", "c2"]])
+    samples = samples.values.reshape(-1, 2)
+    summary = engine.summarise_reactions(seen_S, G.loc[["c1", "c2"]])
+    np.testing.assert_allclose(summary.mean, samples.mean(axis=0))
+    np.testing.assert_allclose(summary.cov(), np.cov(samples.T))
+    tauC_sq = (idata.posterior["tauC"] ** 2).mean().item()
+    new = engine.summarise_compounds(G.loc[["new"]])
+    gc_only = 3 * idata.posterior["dgfG"].sel(group_id="b").values.ravel()
+    np.testing.assert_allclose(new.sd**2, gc_only.var(ddof=1) + tauC_sq)
+    low_rank = PredictionEngine(idata, rank=1).summarise_reactions(S, G)
+    assert low_rank.factor.shape == (2, 1)
+    assert low_rank.quantiles().columns.tolist() == ["q0.01", "q0.5", "q0.99"]
+
+
+def test_summarise_reactions_unseen_compounds(idata: az.InferenceData):
+    """Check that unseen compounds' variance matches the dense covariance."""
+    engine = PredictionEngine(idata)
+    G_new = pd.concat(
+        [G, pd.DataFrame([[1.0, 1.0]], index=["new2"], columns=G.columns)]
+    )
+    S_new = pd.concat(
+        [S, pd.DataFrame([[1.0, 1.0]], index=["new2"], columns=S.columns)]
+    )
+    compounds = engine.summarise_compounds(G_new)
+    assert compounds.factor.shape == (4, 4)
+    np.testing.assert_allclose(
+        compounds.diag, np.array([0, 0, 1, 1]) * np.mean(engine.tauC**2)
+    )
+    dense_cov = compounds.factor @ compounds.factor.T + np.diag(compounds.diag)
+    np.testing.assert_allclose(compounds.cov(), dense_cov)
+    np.testing.assert_allclose(compounds.sd, np.sqrt(np.diag(dense_cov)))
+    reactions = engine.summarise_reactions(S_new, G_new)
+    expected_cov = S_new.values.T @ dense_cov @ S_new.values
+    np.testing.assert_allclose(reactions.cov(), expected_cov)
+    np.testing.assert_allclose(reactions.sd, np.sqrt(np.diag(expected_cov)))
+    np.testing.assert_allclose(
+        reactions.to_dataframe()["mean"], S_new.values.T @ compounds.mean
+    )
@@ -1,14 +1,22 @@
 """Unit tests for functions in src/util.py."""
 
+import json
+import os
+
+import arviz as az
 import numpy as np
 import pandas as pd
 import pytest
 from pandas.testing import assert_frame_equal, assert_series_equal
 from dgfreg.util import (
     StanInputDict,
+    get_stan_input_file,
+    load_idata,
     make_columns_lower_case,
     one_encode,
     stanify_dict,
+    write_idata,
+    write_stan_json,
 )
 
 
@@ -77,3 +85,56 @@ def test_make_columns_lower_case(df_in: pd.DataFrame, expected: pd.DataFrame):
 def test_stanify_dict(d_in: dict, expected: StanInputDict):
     """Check that the function stanify_dict works as expected."""
     assert stanify_dict(d_in) == expected
+
+
+@pytest.mark.parametrize(
+    "d_in",
+    [
+        {"a": pd.Series([1.5, 2.0, 3.25]), "b": 3},
+        {"a": pd.DataFrame([[1, 2, 3], [4, 5, 6]]), "b": [1.0, 2.0]},
+        {"a": np.array([[0.1, -2.0, 1e-300], [4.0, 5.0, 6.0]])},
+        {"a": np.arange(24).reshape(2, 3, 4) / 7, "b": np.array([True])},
+        {"a": np.zeros((2, 0)), "b": np.array([]), "c": np.int64(2)},
+        {"a": np.zeros((2, 3, 0)), "b": np.zeros((0, 2, 2))},
+    ],
+)
+def test_write_stan_json(d_in: dict, tmp_path):
+    """Check that write_stan_json writes the same values as stanify_dict."""
+    path = os.path.join(tmp_path, "input.json")
+    write_stan_json(d_in, path)
+    with open(path, "r") as f:
+        written = json.load(f)
+    expected = json.loads(json.dumps(stanify_dict(d_in), default=int))
+    assert written == expected
+
+
+def test_get_stan_input_file_reuses_files(tmp_path):
+    """Check that equal Stan inputs share a json file."""
+    d = {"a": np.array([1.0, 2.5]), "b": 1}
+    path = get_stan_input_file(d, tmp_path)
+    assert get_stan_input_file(d | {}, tmp_path) == path
+    assert get_stan_input_file(d | {"b": 2}, tmp_path) != path
+    assert len(os.listdir(tmp_path)) == 2
+
+
+@pytest.mark.parametrize("output_format", ["netcdf", "zarr", "json"])
+def test_write_idata(tmp_path, output_format: str):
+    """Check that saved InferenceData are compacted and load back."""
+    rng = np.random.default_rng(0)
+    idata = az.from_dict(
+        posterior={"sigma": rng.normal(size=(2, 250))},
+        posterior_predictive={"yrep": rng.normal(size=(2, 250, 4))},
+        observed_data={"y": rng.normal(size=4)},
+    )
+    (tmp_path / "idata.json").write_text("stale")
+    write_idata(idata, tmp_path, output_format, float32=True, thin=5)
+    assert len(os.listdir(tmp_path)) == 1
+    loaded = load_idata(tmp_path)
+    assert loaded.posterior_predictive.sizes["draw"] == 50
+    assert loaded.posterior.sizes["draw"] == 250
+    assert loaded.observed_data["y"].dtype == "float64"
+    np.testing.assert_allclose(
+        loaded.posterior["sigma"], idata.posterior["sigma"], rtol=1e-6
+    )
+    if output_format != "json":
+        assert loaded.posterior["sigma"].dtype == "float32"